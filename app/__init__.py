@@ -1,74 +1,162 @@
-# Marketing/app/__init__.py
-
-import os
-from flask import Flask, render_template, url_for, request
-from flask_mail import Mail
-from dotenv import load_dotenv
-from app.database import db
-from app.routes import bp
-from app.admin import bp as admin_bp
-from app.deutsche import bp as deut_bp
-from app.finapi import bp as fin_bp
-from app.mail import bp as mail_bp
-from app.google_ads.google_ads_routes import bp as google_ads_bp
-from app.bank_transactions import bp as bank_bp
-from app.data_analysis import bp as analysis_bp
-
-load_dotenv()
-
-mail = Mail()
-
-def create_app():
-    app = Flask(__name__)
-
-    app.config.from_prefixed_env()
-    
-    app.secret_key = os.getenv('FLASK_SECRET_KEY')
-    
-    # Set the SQLALCHEMY_DATABASE_URI
-    database_uri = os.getenv('FLASK_SQLALCHEMY_DATABASE_URI')
-    if not database_uri:
-        # If the environment variable is not set, use a default SQLite database
-        base_dir = os.path.abspath(os.path.dirname(__file__))
-        database_uri = f"sqlite:///{os.path.join(base_dir, 'app.db')}"
-        print(f"Using default SQLite database: {database_uri}")
-    
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-    app.config['ADMIN_LIST'] = os.getenv('FLASK_ADMIN_LIST', '').split(',')
-
-    # Email configuration
-    app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.googlemail.com')
-    app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', '587'))
-    app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', 'true').lower() in ['true', 'on', '1']
-    app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
-    app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
-    app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
-
-    # Initialize extensions
-    db.init_app(app)
-    mail.init_app(app)
-
-    # Register blueprints
-    app.register_blueprint(bp)
-    app.register_blueprint(admin_bp, url_prefix="/admin")
-    app.register_blueprint(deut_bp, url_prefix="/deutsche")
-    app.register_blueprint(fin_bp, url_prefix="/finapi")
-    app.register_blueprint(mail_bp, url_prefix="/mail")
-    app.register_blueprint(google_ads_bp, url_prefix="/google-ads")
-    app.register_blueprint(bank_bp, url_prefix="/bank")
-    app.register_blueprint(analysis_bp, url_prefix="/analysis")
-    
-    with app.app_context():
-        db.create_all()
-
-    @app.route("/")
-    def home():
-        return render_template("home.html")
-
-    @app.errorhandler(404)
-    def page_not_found(error):
-        return render_template('page_not_found.html'), 404
-
-    return app
+# Marketing/app/__init__.py
+
+import os
+from flask import Flask, render_template, url_for, request
+from flask_mail import Mail
+from dotenv import load_dotenv
+from app.database import db, schema_lock, enable_sqlite_wal
+from app.models import Email
+from app.routes import bp
+from app.admin import bp as admin_bp
+from app.deutsche import bp as deut_bp
+from app.finapi import bp as fin_bp
+from app.mail import bp as mail_bp
+from app.google_ads.google_ads_routes import bp as google_ads_bp
+from app.bank_transactions import bp as bank_bp
+from app.data_analysis import bp as analysis_bp
+from app.jobs import sync_worker_command, duplicate_active_jobs, add_heartbeat_column
+from app.mail.search import create_search_index, rebuild_search_index_command
+from app.mail.body_migration import add_body_column, migrate_email_bodies_command
+from app.mail.uid_migration import add_uid_columns
+from app.mail.attachment_cache import add_attachment_columns
+from app.google_ads.metrics import add_account_columns, scope_campaign_ids
+from app.helpers.columnar_export import export_agency_data_command
+from app.helpers.transaction_search import (
+    duplicate_transactions_pending, prepare_purpose_index, drop_duplicate_transactions_command,
+    create_purpose_index_command
+)
+from app.helpers.balance_ledger import (
+    balance_ledger_pending, add_opening_balance_column, rebuild_balance_ledger_command
+)
+from app.helpers.bank_purge import add_purge_column, add_cascading_foreign_keys
+from app.helpers.transaction_partitions import (
+    create_partitioned_table, create_upcoming_partitions, migrate_bank_transactions_command,
+    archive_bank_transactions_command
+)
+
+load_dotenv()
+
+mail = Mail()
+
+def create_app():
+    app = Flask(__name__)
+
+    app.config.from_prefixed_env()
+    
+    app.secret_key = os.getenv('FLASK_SECRET_KEY')
+    
+    # Set the SQLALCHEMY_DATABASE_URI
+    database_uri = os.getenv('FLASK_SQLALCHEMY_DATABASE_URI')
+    if not database_uri:
+        # If the environment variable is not set, use a default SQLite database
+        base_dir = os.path.abspath(os.path.dirname(__file__))
+        database_uri = f"sqlite:///{os.path.join(base_dir, 'app.db')}"
+        print(f"Using default SQLite database: {database_uri}")
+    
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if database_uri.startswith('sqlite'):
+        # Mail sync threads and web workers write to the same file; a writer
+        # waits this many seconds for the lock before "database is locked"
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+
+    app.config['ADMIN_LIST'] = os.getenv('FLASK_ADMIN_LIST', '').split(',')
+
+    # Maximum age in seconds of a cached DataAnalysis result
+    app.config['ANALYSIS_CACHE_MAX_AGE'] = int(os.getenv('ANALYSIS_CACHE_MAX_AGE', '300'))
+
+    # Email configuration
+    app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.googlemail.com')
+    app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', '587'))
+    app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', 'true').lower() in ['true', 'on', '1']
+    app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
+    app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
+    app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
+
+    # FinAPI server; the sandbox unless set to https://live.finapi.io
+    app.config['FINAPI_BASE_URL'] = os.getenv('FINAPI_BASE_URL', 'https://sandbox.finapi.io').rstrip('/')
+
+    # Number of mail accounts synced in parallel
+    app.config['MAIL_SYNC_WORKERS'] = int(os.getenv('MAIL_SYNC_WORKERS', '4'))
+
+    # Google Ads accounts fetched in parallel per agency sync
+    app.config['GOOGLE_ADS_SYNC_WORKERS'] = int(os.getenv('GOOGLE_ADS_SYNC_WORKERS', '8'))
+
+    # On-disk LRU cache for downloaded mail attachments
+    app.config['ATTACHMENT_CACHE_DIR'] = os.getenv(
+        'ATTACHMENT_CACHE_DIR', os.path.join(app.instance_path, 'attachments')
+    )
+    app.config['ATTACHMENT_CACHE_MAX_BYTES'] = int(os.getenv('ATTACHMENT_CACHE_MAX_BYTES', str(500 * 1024 * 1024)))
+
+    # Initialize extensions
+    db.init_app(app)
+    mail.init_app(app)
+
+    # Register blueprints
+    app.register_blueprint(bp)
+    app.register_blueprint(admin_bp, url_prefix="/admin")
+    app.register_blueprint(deut_bp, url_prefix="/deutsche")
+    app.register_blueprint(fin_bp, url_prefix="/finapi")
+    app.register_blueprint(mail_bp, url_prefix="/mail")
+    app.register_blueprint(google_ads_bp, url_prefix="/google-ads")
+    app.register_blueprint(bank_bp, url_prefix="/bank")
+    app.register_blueprint(analysis_bp, url_prefix="/analysis")
+
+    app.cli.add_command(sync_worker_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(migrate_email_bodies_command)
+    app.cli.add_command(export_agency_data_command)
+    app.cli.add_command(rebuild_balance_ledger_command)
+    app.cli.add_command(migrate_bank_transactions_command)
+    app.cli.add_command(archive_bank_transactions_command)
+    app.cli.add_command(drop_duplicate_transactions_command)
+    app.cli.add_command(create_purpose_index_command)
+    
+    # Workers start together; each checks and migrates the schema in turn
+    with app.app_context(), schema_lock():
+        enable_sqlite_wal()
+        create_partitioned_table()
+        db.create_all()
+        create_upcoming_partitions()
+        add_purge_column()
+        add_opening_balance_column()
+        add_heartbeat_column()
+        add_cascading_foreign_keys()
+        add_uid_columns()
+        add_attachment_columns()
+        add_account_columns()
+        scope_campaign_ids()
+        # create_all skips tables that already exist; add indexes declared since
+        skipped = set()
+        if duplicate_transactions_pending():
+            skipped.add('uq_bank_transaction_account_finapi')
+            app.logger.warning(
+                "bank_transaction has duplicate rows; run 'flask drop-duplicate-transactions' to add its unique index"
+            )
+        if duplicate_active_jobs():
+            # Left until the worker has finished the extra jobs
+            skipped.add('uq_sync_job_agency_type_active')
+            app.logger.warning("sync_job has several active jobs per agency; its unique index is added on a later start")
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in skipped:
+                    index.create(db.engine, checkfirst=True)
+        add_body_column()
+        if create_search_index() and db.session.execute(db.select(Email.id).limit(1)).first():
+            # Indexing every stored email is left to the CLI, not to each worker's start
+            app.logger.warning("email search index was created empty; run 'flask rebuild-search-index' to fill it")
+        # Both scan every stored transaction, so they are left to the CLI
+        if not prepare_purpose_index():
+            app.logger.warning("bank_transaction has no purpose index; run 'flask create-purpose-index' to add it")
+        if balance_ledger_pending():
+            app.logger.warning("the balance ledger is empty; run 'flask rebuild-balance-ledger' to build it")
+
+    @app.route("/")
+    def home():
+        return render_template("home.html")
+
+    @app.errorhandler(404)
+    def page_not_found(error):
+        return render_template('page_not_found.html'), 404
+
+    return app
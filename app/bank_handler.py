@@ -4,9 +4,13 @@ import plaid
 from plaid.api import plaid_api
 from plaid.model.transactions_get_request import TransactionsGetRequest
 from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
+from collections import defaultdict
 from datetime import datetime, timedelta
 from app.models import Agency, BankConnection, BankAccount, BankTransaction
 from app.database import db
+from app.data_analysis import invalidate_analysis
+from app.helpers.balance_ledger import apply_balance_changes
+from app.helpers.transaction_ingest import ingest_transactions
 import os
 from flask import current_app
 import logging
@@ -27,15 +31,28 @@ class BankHandler:
         return plaid_api.PlaidApi(api_client)
 
     def sync_transactions(self, agency_id):
-        bank_connections = BankConnection.query.filter_by(agency_id=agency_id).all()
+        """Sync every bank connection of an agency; returns one result dict per connection.
+
+        Each connection is stored in its own savepoint, so a failing one is
+        logged and reported without undoing the others.
+        """
+        bank_connections = BankConnection.query.filter_by(agency_id=agency_id, purge_requested_at=None).all()
+        results = []
         for connection in bank_connections:
+            result = {'connection_id': connection.id, 'transactions': 0, 'error': None}
             try:
                 transactions = self._fetch_transactions(connection.finapi_connection_id)
-                self._process_transactions(connection.id, transactions)
+                with db.session.begin_nested():
+                    self._process_transactions(connection.id, transactions)
+                result['transactions'] = len(transactions)
             except Exception as e:
-                current_app.logger.error(f"Error syncing transactions for connection {connection.id}: {str(e)}")
+                current_app.logger.error(f"Error syncing transactions for connection {result['connection_id']}: {str(e)}")
+                result['error'] = str(e)
+            results.append(result)
 
+        invalidate_analysis(agency_id, 'bank')
         db.session.commit()
+        return results
 
     def _fetch_transactions(self, connection_id):
         start_date = (datetime.now() - timedelta(days=30)).date()
@@ -55,36 +72,50 @@ class BankHandler:
         return response['transactions']
 
     def _process_transactions(self, connection_id, transactions):
-        for transaction in transactions:
-            account = BankAccount.query.filter_by(
-                connection_id=connection_id,
-                finapi_account_id=transaction['account_id']
-            ).first()
+        account_map = dict(db.session.execute(
+            db.select(BankAccount.finapi_account_id, BankAccount.id).filter_by(connection_id=connection_id)
+        ).all())
+        existing = {
+            (transaction.account_id, transaction.finapi_transaction_id): transaction
+            for transaction in db.session.execute(
+                db.select(BankTransaction).where(
+                    BankTransaction.account_id.in_(account_map.values()),
+                    BankTransaction.finapi_transaction_id.in_([t['transaction_id'] for t in transactions])
+                )
+            ).scalars()
+        }
 
-            if not account:
+        new_transactions = []
+        balance_changes = defaultdict(float)
+        for transaction in transactions:
+            account_id = account_map.get(transaction['account_id'])
+            if account_id is None:
                 current_app.logger.error(f"Account not found for transaction {transaction['transaction_id']}")
                 continue
 
-            existing_transaction = BankTransaction.query.filter_by(
-                finapi_transaction_id=transaction['transaction_id'],
-                account_id=account.id
-            ).first()
-
+            existing_transaction = existing.get((account_id, transaction['transaction_id']))
             if not existing_transaction:
-                new_transaction = BankTransaction(
-                    account_id=account.id,
-                    finapi_transaction_id=transaction['transaction_id'],
-                    amount=float(transaction['amount']),
-                    purpose=transaction['name'],
-                    booking_date=datetime.strptime(transaction['date'], '%Y-%m-%d'),
-                    value_date=datetime.strptime(transaction['date'], '%Y-%m-%d')  # Assuming same as booking_date
-                )
-                db.session.add(new_transaction)
+                # Stored through the shared ingest stage, which also updates the balance ledger
+                new_transactions.append({
+                    'id': transaction['transaction_id'],
+                    'accountId': transaction['account_id'],
+                    'amount': float(transaction['amount']),
+                    'purpose': transaction['name'],
+                    'bookingDate': transaction['date'],
+                    'valueDate': transaction['date']  # Assuming same as booking_date
+                })
             else:
-                # Update existing transaction if needed
-                existing_transaction.amount = float(transaction['amount'])
+                # Update existing transaction if needed, shifting the ledger by the difference
+                amount = float(transaction['amount'])
+                if amount != existing_transaction.amount:
+                    day = existing_transaction.booking_date.date()
+                    balance_changes[(account_id, day)] += amount - existing_transaction.amount
+                existing_transaction.amount = amount
                 existing_transaction.purpose = transaction['name']
 
+        apply_balance_changes(balance_changes)
+        ingest_transactions(new_transactions, account_map)
+
     def link_bank_account(self, agency_id, public_token):
         try:
             exchange_response = self.client.item_public_token_exchange(public_token)
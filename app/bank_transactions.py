@@ -5,15 +5,32 @@ from flask_login import login_required, current_user
 from app.models import Agency, BankConnection, BankAccount, BankTransaction
 from app.database import db
 from app.helpers.finapi_helper import FinAPIHelper
+from app.helpers.transaction_ingest import load_account_map, ingest_transactions, seed_finapi_balances
+from app.helpers.transaction_search import transaction_page
+from app.helpers.bank_purge import delete_bank_connection
+from app.helpers.balance_ledger import account_balances as account_balances_from_ledger, balance_history as balance_history_from_ledger
+from app.data_analysis import invalidate_analysis
+from collections import namedtuple
 from datetime import datetime, timedelta
 import os
 
 bp = Blueprint('bank', __name__)
 
+# Purposes are free text; reports show only the largest ones by default
+TRANSACTION_CATEGORY_LIMIT = 50
+# Most purposes a report can ask for with ?categories=
+MAX_CATEGORY_LIMIT = 500
+
+# Same shape as the (purpose, total) rows the templates have always received
+CategoryTotal = namedtuple('CategoryTotal', ['purpose', 'total'])
+
+# Default range of /balance_history when no start_date is given
+BALANCE_HISTORY_DAYS = 90
+
 @bp.route('/')
 @login_required
 def index():
-    bank_connections = BankConnection.query.filter_by(agency_id=current_user.agency_id).all()
+    bank_connections = BankConnection.query.filter_by(agency_id=current_user.agency_id, purge_requested_at=None).all()
     return render_template('bank/index.html', bank_connections=bank_connections)
 
 @bp.route('/sync')
@@ -21,7 +38,8 @@ def index():
 def sync():
     try:
         access_token = FinAPIHelper.get_access_token()
-        bank_connections = BankConnection.query.filter_by(agency_id=current_user.agency_id).all()
+        bank_connections = BankConnection.query.filter_by(agency_id=current_user.agency_id, purge_requested_at=None).all()
+        account_map = load_account_map(current_user.agency_id)
         
         for connection in bank_connections:
             accounts = BankAccount.query.filter_by(connection_id=connection.id).all()
@@ -30,23 +48,13 @@ def sync():
             from_date = (datetime.utcnow() - timedelta(days=30)).strftime('%Y-%m-%d')
             to_date = datetime.utcnow().strftime('%Y-%m-%d')
             
-            transactions = FinAPIHelper.get_transactions(access_token, account_ids, from_date, to_date)
-            
-            for transaction in transactions:
-                existing_transaction = BankTransaction.query.filter_by(finapi_transaction_id=transaction['id']).first()
-                if not existing_transaction:
-                    new_transaction = BankTransaction(
-                        account_id=BankAccount.query.filter_by(finapi_account_id=transaction['accountId']).first().id,
-                        finapi_transaction_id=transaction['id'],
-                        amount=transaction['amount'],
-                        purpose=transaction.get('purpose'),
-                        booking_date=datetime.strptime(transaction['bookingDate'], '%Y-%m-%d').date(),
-                        value_date=datetime.strptime(transaction['valueDate'], '%Y-%m-%d').date()
-                    )
-                    db.session.add(new_transaction)
+            transactions = FinAPIHelper.iter_transactions(access_token, account_ids, from_date, to_date)
+            ingest_transactions(transactions, account_map)
+            seed_finapi_balances(access_token, accounts)
             
             connection.last_sync = datetime.utcnow()
         
+        invalidate_analysis(current_user.agency_id, 'bank')
         db.session.commit()
         flash('Bank transactions synced successfully', 'success')
     except Exception as e:
@@ -63,8 +71,12 @@ def transactions(connection_id):
         return redirect(url_for('bank.index'))
     
     accounts = BankAccount.query.filter_by(connection_id=connection_id).all()
-    transactions = BankTransaction.query.filter(BankTransaction.account_id.in_([account.id for account in accounts])).order_by(BankTransaction.booking_date.desc()).all()
-    return render_template('bank/transactions.html', bank_connection=bank_connection, transactions=transactions)
+    try:
+        transactions, next_cursor = transaction_page([account.id for account in accounts], cursor=request.args.get('cursor'))
+    except ValueError:
+        flash('Invalid page cursor.', 'error')
+        return redirect(url_for('bank.transactions', connection_id=connection_id))
+    return render_template('bank/transactions.html', bank_connection=bank_connection, transactions=transactions, next_cursor=next_cursor)
 
 @bp.route('/link_account', methods=['POST'])
 @login_required
@@ -113,14 +125,42 @@ def account_balances(connection_id):
         return redirect(url_for('bank.index'))
 
     accounts = BankAccount.query.filter_by(connection_id=connection_id).all()
-    balances = []
-    for account in accounts:
-        latest_transaction = BankTransaction.query.filter_by(account_id=account.id).order_by(BankTransaction.booking_date.desc()).first()
-        balance = latest_transaction.amount if latest_transaction else 0
-        balances.append({'account_name': account.account_name, 'balance': balance})
+    latest_balances = account_balances_from_ledger([account.id for account in accounts])
+    balances = [
+        {'account_name': account.account_name, 'balance': latest_balances.get(account.id, 0)}
+        for account in accounts
+    ]
 
     return render_template('bank/account_balances.html', bank_connection=bank_connection, balances=balances)
 
+@bp.route('/balance_history/<int:connection_id>')
+@login_required
+def balance_history(connection_id):
+    bank_connection = BankConnection.query.get_or_404(connection_id)
+    if bank_connection.agency_id != current_user.agency_id:
+        return jsonify({'error': 'Forbidden'}), 403
+
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else None
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
+    if start_date is None:
+        start_date = (end_date or datetime.now().date()) - timedelta(days=BALANCE_HISTORY_DAYS)
+
+    accounts = BankAccount.query.filter_by(connection_id=connection_id).all()
+    return jsonify([
+        {
+            'account_id': account.id,
+            'account_name': account.account_name,
+            'balances': [
+                {'day': day.isoformat(), 'balance': balance}
+                for day, balance in balance_history_from_ledger(account.id, start_date, end_date)
+            ]
+        }
+        for account in accounts
+    ])
+
 @bp.route('/transaction_summary/<int:connection_id>')
 @login_required
 def transaction_summary(connection_id):
@@ -129,33 +169,7 @@ def transaction_summary(connection_id):
         flash('You do not have permission to view this summary.', 'error')
         return redirect(url_for('bank.index'))
 
-    accounts = BankAccount.query.filter_by(connection_id=connection_id).all()
-    account_ids = [account.id for account in accounts]
-
-    # Calculate summary statistics
-    total_income = db.session.query(db.func.sum(BankTransaction.amount)).filter(
-        BankTransaction.account_id.in_(account_ids),
-        BankTransaction.amount > 0
-    ).scalar() or 0
-
-    total_expenses = db.session.query(db.func.sum(BankTransaction.amount)).filter(
-        BankTransaction.account_id.in_(account_ids),
-        BankTransaction.amount < 0
-    ).scalar() or 0
-
-    category_breakdown = db.session.query(
-        BankTransaction.purpose,
-        db.func.sum(BankTransaction.amount).label('total')
-    ).filter(
-        BankTransaction.account_id.in_(account_ids)
-    ).group_by(BankTransaction.purpose).all()
-
-    summary = {
-        'total_income': total_income,
-        'total_expenses': abs(total_expenses),
-        'net_income': total_income + total_expenses,
-        'category_breakdown': category_breakdown
-    }
+    summary = get_transaction_statistics(connection_id, category_limit=requested_category_limit())
 
     return render_template('bank/transaction_summary.html', bank_connection=bank_connection, summary=summary)
 
@@ -179,16 +193,10 @@ def delete_connection(connection_id):
         access_token = FinAPIHelper.get_access_token()
         FinAPIHelper.delete_bank_connection(access_token, bank_connection.finapi_connection_id)
 
-        # Delete associated accounts and transactions
-        accounts = BankAccount.query.filter_by(connection_id=connection_id).all()
-        for account in accounts:
-            BankTransaction.query.filter_by(account_id=account.id).delete()
-        BankAccount.query.filter_by(connection_id=connection_id).delete()
-
-        db.session.delete(bank_connection)
-        db.session.commit()
-
-        flash('Bank connection deleted successfully', 'success')
+        if delete_bank_connection(bank_connection):
+            flash('Bank connection deleted successfully', 'success')
+        else:
+            flash('Bank connection is being deleted in the background', 'success')
     except Exception as e:
         current_app.logger.error(f"Error deleting bank connection: {str(e)}")
         flash('Error deleting bank connection. Please try again.', 'error')
@@ -232,46 +240,70 @@ def search_transactions(connection_id):
     accounts = BankAccount.query.filter_by(connection_id=connection_id).all()
     account_ids = [account.id for account in accounts]
 
-    transactions_query = BankTransaction.query.filter(BankTransaction.account_id.in_(account_ids))
+    try:
+        transactions, next_cursor = transaction_page(
+            account_ids,
+            term=query,
+            start_date=datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None,
+            end_date=datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None,
+            cursor=request.args.get('cursor')
+        )
+    except ValueError:
+        flash('Invalid search parameters.', 'error')
+        return redirect(url_for('bank.search_transactions', connection_id=connection_id))
+
+    return render_template('bank/search_transactions.html', bank_connection=bank_connection, transactions=transactions, query=query, start_date=start_date, end_date=end_date, next_cursor=next_cursor)
+
+def requested_category_limit():
+    """The ?categories= of the request, clamped to 1..MAX_CATEGORY_LIMIT.
+
+    0 would lift the limit, and a negative LIMIT is an error on PostgreSQL.
+    """
+    limit = request.args.get('categories', TRANSACTION_CATEGORY_LIMIT, type=int)
+    return min(max(limit, 1), MAX_CATEGORY_LIMIT)
+
+def get_transaction_statistics(connection_id, start_date=None, end_date=None, category_limit=None):
+    """Income, expenses and per-purpose totals of a connection in a single query.
+
+    Each purpose group carries its income and expense sums; window sums over
+    the groups give the totals before ``category_limit`` cuts the breakdown
+    down to the largest purposes by absolute total.
+    """
+    income = db.func.sum(db.case((BankTransaction.amount > 0, BankTransaction.amount), else_=0))
+    expenses = db.func.sum(db.case((BankTransaction.amount < 0, BankTransaction.amount), else_=0))
+    groups = db.select(
+        BankTransaction.purpose,
+        db.func.sum(BankTransaction.amount).label('total'),
+        income.label('income'),
+        expenses.label('expenses'),
+    ).join(BankAccount, BankTransaction.account_id == BankAccount.id).where(BankAccount.connection_id == connection_id)
 
-    if query:
-        transactions_query = transactions_query.filter(BankTransaction.purpose.ilike(f'%{query}%'))
-    
     if start_date:
-        transactions_query = transactions_query.filter(BankTransaction.booking_date >= datetime.strptime(start_date, '%Y-%m-%d').date())
-    
-    if end_date:
-        transactions_query = transactions_query.filter(BankTransaction.booking_date <= datetime.strptime(end_date, '%Y-%m-%d').date())
-
-    transactions = transactions_query.order_by(BankTransaction.booking_date.desc()).all()
+        groups = groups.where(BankTransaction.booking_date >= start_date)
 
-    return render_template('bank/search_transactions.html', bank_connection=bank_connection, transactions=transactions, query=query, start_date=start_date, end_date=end_date)
-
-def get_transaction_statistics(connection_id, start_date=None, end_date=None):
-    accounts = BankAccount.query.filter_by(connection_id=connection_id).all()
-    account_ids = [account.id for account in accounts]
-
-    transactions_query = BankTransaction.query.filter(BankTransaction.account_id.in_(account_ids))
-
-    if start_date:
-        transactions_query = transactions_query.filter(BankTransaction.booking_date >= start_date)
-    
     if end_date:
-        transactions_query = transactions_query.filter(BankTransaction.booking_date <= end_date)
-
-    total_income = transactions_query.filter(BankTransaction.amount > 0).with_entities(db.func.sum(BankTransaction.amount)).scalar() or 0
-    total_expenses = transactions_query.filter(BankTransaction.amount < 0).with_entities(db.func.sum(BankTransaction.amount)).scalar() or 0
-
-    category_breakdown = transactions_query.group_by(BankTransaction.purpose).with_entities(
-        BankTransaction.purpose,
-        db.func.sum(BankTransaction.amount).label('total')
-    ).all()
-
+        groups = groups.where(BankTransaction.booking_date <= end_date)
+
+    groups = groups.group_by(BankTransaction.purpose).subquery()
+    query = db.select(
+        groups.c.purpose,
+        groups.c.total,
+        db.func.sum(groups.c.income).over().label('total_income'),
+        db.func.sum(groups.c.expenses).over().label('total_expenses'),
+        db.func.count().over().label('category_count'),
+    ).order_by(db.func.abs(groups.c.total).desc(), groups.c.purpose)
+    if category_limit:
+        query = query.limit(category_limit)
+    rows = db.session.execute(query).all()
+
+    total_income = (rows[0].total_income or 0) if rows else 0
+    total_expenses = (rows[0].total_expenses or 0) if rows else 0
     return {
         'total_income': total_income,
         'total_expenses': abs(total_expenses),
         'net_income': total_income + total_expenses,
-        'category_breakdown': category_breakdown
+        'category_breakdown': [CategoryTotal(row.purpose, row.total) for row in rows],
+        'category_count': rows[0].category_count if rows else 0
     }
 
 @bp.route('/transaction_report/<int:connection_id>', methods=['GET', 'POST'])
@@ -289,6 +321,8 @@ def transaction_report(connection_id):
         end_date = datetime.now().date()
         start_date = end_date - timedelta(days=30)
 
-    statistics = get_transaction_statistics(connection_id, start_date, end_date)
+    statistics = get_transaction_statistics(
+        connection_id, start_date, end_date, category_limit=requested_category_limit()
+    )
 
     return render_template('bank/transaction_report.html', bank_connection=bank_connection, statistics=statistics, start_date=start_date, end_date=end_date)
@@ -1,12 +1,19 @@
-from flask import Blueprint, render_template, jsonify, request
-from app.models import Agency, LexAcc, Customer, Manual, BankConnection, BankAccount, BankTransaction, GoogleAdsAccount, GoogleAdsCampaign, MailUser, Email
+from flask import Blueprint, render_template, jsonify, request, current_app
+from app.models import Agency, LexAcc, Customer, Manual, BankConnection, BankAccount, BankTransaction, GoogleAdsAccount, GoogleAdsCampaign, GoogleAdsCampaignDay, MailUser, Email, DataAnalysis
 from app.database import db
-from sqlalchemy import func
-from datetime import datetime, timedelta
+from app.google_ads.metrics import agency_totals
+from sqlalchemy import and_, func, or_
+from datetime import date, datetime, timedelta
 from flask_login import login_required, current_user
+import json
+import threading
 
 bp = Blueprint('analysis', __name__)
 
+# Process-wide hit/miss counters for the DataAnalysis result cache
+_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_cache_stats_lock = threading.Lock()
+
 @bp.route('/')
 @login_required
 def index():
@@ -20,33 +27,95 @@ def analyze(agency_id):
         return jsonify({'error': 'Unauthorized'}), 403
     
     results = perform_analysis(agency_id)
+    db.session.commit()
     return jsonify(results)
 
-def perform_analysis(agency_id):
+@bp.route('/cache-stats')
+@login_required
+def cache_stats():
+    return jsonify(get_cache_stats())
+
+def perform_analysis(agency_id, use_cache=True):
     results = {}
     
-    # LexOffice and Sevdesk Analysis
-    results['lex_sev'] = analyze_lex_sev(agency_id)
-    
-    # Manual Entry Analysis
-    results['manual'] = analyze_manual(agency_id)
-    
-    # Bank Transaction Analysis
-    results['bank'] = analyze_bank(agency_id)
-    
-    # Google Ads Analysis
-    results['google_ads'] = analyze_google_ads(agency_id)
+    # Per-source results are served from the DataAnalysis cache when fresh
+    for analysis_type, analyze_func in ANALYSIS_SOURCES.items():
+        if use_cache:
+            results[analysis_type] = get_cached_analysis(agency_id, analysis_type, analyze_func)
+        else:
+            results[analysis_type] = analyze_func(agency_id)
     
     # Overall Comparison
     results['comparison'] = compare_all_sources(results)
     
     return results
 
+def get_cached_analysis(agency_id, analysis_type, analyze_func):
+    max_age = current_app.config.get('ANALYSIS_CACHE_MAX_AGE', 300)
+    cached = db.session.execute(
+        db.select(DataAnalysis).filter_by(agency_id=agency_id, analysis_type=analysis_type)
+        .order_by(DataAnalysis.created_at.desc())
+    ).scalars().first()
+
+    if cached and datetime.utcnow() - cached.created_at <= timedelta(seconds=max_age):
+        _record_cache_stat('hits')
+        return json.loads(cached.result)
+
+    _record_cache_stat('misses')
+    result = analyze_func(agency_id)
+    # The row is written in a savepoint, so a failure only undoes the cache
+    # write. It is stored when the caller commits; read-only views commit
+    # after the analysis for that.
+    try:
+        with db.session.begin_nested():
+            db.session.execute(
+                db.delete(DataAnalysis).filter_by(agency_id=agency_id, analysis_type=analysis_type)
+            )
+            db.session.add(DataAnalysis(
+                agency_id=agency_id,
+                analysis_type=analysis_type,
+                result=json.dumps(result),
+                created_at=datetime.utcnow()
+            ))
+    except Exception as e:
+        current_app.logger.error(f"Error caching {analysis_type} analysis for agency {agency_id}: {str(e)}")
+    return result
+
+def invalidate_analysis(agency_id, *analysis_types):
+    """Drop cached results for the given sources (all sources if none given).
+
+    The delete joins the caller's transaction, so the cache entry disappears
+    in the same commit that changes the underlying data. Cached
+    visualization series combine every source, so they are always dropped.
+    """
+    stmt = db.delete(DataAnalysis).filter_by(agency_id=agency_id)
+    if analysis_types:
+        stmt = stmt.where(or_(
+            DataAnalysis.analysis_type.in_(analysis_types),
+            DataAnalysis.analysis_type.startswith(VISUALIZATION_CACHE_PREFIX)
+        ))
+    db.session.execute(stmt)
+    _record_cache_stat('invalidations')
+
+def get_cache_stats():
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0
+    return stats
+
+def _record_cache_stat(key):
+    with _cache_stats_lock:
+        _cache_stats[key] += 1
+
 def analyze_lex_sev(agency_id):
-    lex_accounts = LexAcc.query.filter_by(agency_id=agency_id).all()
-    total_gross = sum(sum(c.totalGrossAmount for c in acc.customers) for acc in lex_accounts)
-    total_net = sum(sum(c.totalNetAmount for c in acc.customers) for acc in lex_accounts)
-    customer_count = sum(len(acc.customers) for acc in lex_accounts)
+    total_gross, total_net, customer_count = db.session.execute(
+        db.select(
+            func.coalesce(func.sum(Customer.totalGrossAmount), 0),
+            func.coalesce(func.sum(Customer.totalNetAmount), 0),
+            func.count(Customer.id)
+        ).join(LexAcc, Customer.lexAccId == LexAcc.id).where(LexAcc.agency_id == agency_id)
+    ).one()
     
     return {
         'total_gross': total_gross,
@@ -56,9 +125,12 @@ def analyze_lex_sev(agency_id):
     }
 
 def analyze_manual(agency_id):
-    manual_entries = Manual.query.filter_by(agency_id=agency_id).all()
-    total_amount = sum(entry.totalAmount for entry in manual_entries)
-    entry_count = len(manual_entries)
+    total_amount, entry_count = db.session.execute(
+        db.select(
+            func.coalesce(func.sum(Manual.totalAmount), 0),
+            func.count(Manual.id)
+        ).where(Manual.agency_id == agency_id)
+    ).one()
     
     return {
         'total_amount': total_amount,
@@ -67,16 +139,15 @@ def analyze_manual(agency_id):
     }
 
 def analyze_bank(agency_id):
-    bank_connections = BankConnection.query.filter_by(agency_id=agency_id).all()
-    total_transactions = 0
-    total_amount = 0
-    
-    for connection in bank_connections:
-        accounts = BankAccount.query.filter_by(connection_id=connection.id).all()
-        for account in accounts:
-            transactions = BankTransaction.query.filter_by(account_id=account.id).all()
-            total_transactions += len(transactions)
-            total_amount += sum(t.amount for t in transactions)
+    # Aggregate in the database instead of loading every transaction row
+    total_amount, total_transactions = db.session.execute(
+        db.select(
+            func.coalesce(func.sum(BankTransaction.amount), 0),
+            func.count(BankTransaction.id)
+        ).join(BankAccount, BankTransaction.account_id == BankAccount.id)
+        .join(BankConnection, BankAccount.connection_id == BankConnection.id)
+        .where(BankConnection.agency_id == agency_id, BankConnection.purge_requested_at.is_(None))
+    ).one()
     
     return {
         'total_transactions': total_transactions,
@@ -85,16 +156,32 @@ def analyze_bank(agency_id):
     }
 
 def analyze_google_ads(agency_id):
-    ads_accounts = GoogleAdsAccount.query.filter_by(agency_id=agency_id).all()
-    total_budget = sum(sum(c.budget for c in account.campaigns) for account in ads_accounts)
-    total_campaigns = sum(len(account.campaigns) for account in ads_accounts)
+    total_budget, total_campaigns = db.session.execute(
+        db.select(
+            func.coalesce(func.sum(GoogleAdsCampaign.budget), 0),
+            func.count(GoogleAdsCampaign.id)
+        ).join(GoogleAdsAccount, GoogleAdsCampaign.account_id == GoogleAdsAccount.id)
+        .where(GoogleAdsAccount.agency_id == agency_id)
+    ).one()
     
+    last_30_days = agency_totals(agency_id, date.today() - timedelta(days=29))
+
     return {
         'total_budget': total_budget,
         'total_campaigns': total_campaigns,
-        'average_budget_per_campaign': total_budget / total_campaigns if total_campaigns else 0
+        'average_budget_per_campaign': total_budget / total_campaigns if total_campaigns else 0,
+        'impressions_last_30_days': last_30_days['impressions'],
+        'clicks_last_30_days': last_30_days['clicks'],
+        'cost_last_30_days': last_30_days['cost']
     }
 
+ANALYSIS_SOURCES = {
+    'lex_sev': analyze_lex_sev,
+    'manual': analyze_manual,
+    'bank': analyze_bank,
+    'google_ads': analyze_google_ads,
+}
+
 def compare_all_sources(results):
     total_revenue = (
         results['lex_sev']['total_gross'] +
@@ -110,18 +197,155 @@ def compare_all_sources(results):
         'google_ads_budget_percentage': (results['google_ads']['total_budget'] / total_revenue * 100) if total_revenue else 0
     }
 
-def analyze_emails(agency):
-    mail_users = MailUser.query.filter_by(agency_id=agency.id).all()
-    total_emails = 0
-    last_week = datetime.now() - timedelta(days=7)
+VISUALIZATION_CACHE_PREFIX = 'visualize:'
+# Default range of a series, in buckets, when no start date is given
+VISUALIZATION_BUCKETS = {'day': 90, 'week': 52, 'month': 24}
+# Cached series kept per agency; writing a new one drops the oldest
+VISUALIZATION_CACHE_ENTRIES = 8
+
+def visualization_totals(agency_id):
+    """One value per Lexoffice account, manual entry and bank connection, each from a single grouped query."""
+    lex = db.session.execute(
+        db.select(LexAcc.name, func.coalesce(func.sum(Customer.totalGrossAmount), 0))
+        .outerjoin(Customer, Customer.lexAccId == LexAcc.id)
+        .where(LexAcc.agency_id == agency_id)
+        .group_by(LexAcc.id, LexAcc.name).order_by(LexAcc.id)
+    ).all()
+    manual = db.session.execute(
+        db.select(Manual.name, Manual.totalAmount).where(Manual.agency_id == agency_id).order_by(Manual.id)
+    ).all()
+    bank = db.session.execute(
+        db.select(BankConnection.bank_name, func.coalesce(func.sum(BankTransaction.amount), 0))
+        .outerjoin(BankAccount, BankAccount.connection_id == BankConnection.id)
+        .outerjoin(BankTransaction, BankTransaction.account_id == BankAccount.id)
+        .where(BankConnection.agency_id == agency_id, BankConnection.purge_requested_at.is_(None))
+        .group_by(BankConnection.id, BankConnection.bank_name).order_by(BankConnection.id)
+    ).all()
+    return {
+        source: [{'name': name, 'value': value} for name, value in rows]
+        for source, rows in (('lex', lex), ('manual', manual), ('bank', bank))
+    }
 
-    for mail_user in mail_users:
-        emails = Email.query.filter(
-            Email.mail_user_id == mail_user.id,
-            Email.date >= last_week
+def visualization_series(agency_id, bucket='month', start=None, end=None):
+    """Per-source totals per day, week (from Monday) or month between start and end.
+
+    Served from the DataAnalysis cache like the per-source analyses, so a
+    repeated request costs one lookup until the data changes or the entry
+    expires. The range is widened to whole buckets, so dates within the
+    same buckets share one entry, and only the VISUALIZATION_CACHE_ENTRIES
+    most recent series are kept per agency.
+    """
+    end = _bucket_end(bucket, end or date.today())
+    start = _bucket_start(bucket, start or _default_series_start(bucket, end))
+    analysis_type = f"{VISUALIZATION_CACHE_PREFIX}{bucket}:{start.isoformat()}:{end.isoformat()}"
+
+    def compute(agency_id):
+        _prune_series_cache(agency_id)
+        return _compute_series(agency_id, bucket, start, end)
+
+    return get_cached_analysis(agency_id, analysis_type, compute)
+
+def _bucket_start(bucket, day):
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+def _bucket_end(bucket, day):
+    if bucket == 'week':
+        return day + timedelta(days=6 - day.weekday())
+    if bucket == 'month':
+        return (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return day
+
+def _prune_series_cache(agency_id):
+    # Runs on a cache miss, before the new series is written
+    kept = (
+        db.select(DataAnalysis.id)
+        .where(DataAnalysis.agency_id == agency_id, DataAnalysis.analysis_type.startswith(VISUALIZATION_CACHE_PREFIX))
+        .order_by(DataAnalysis.created_at.desc(), DataAnalysis.id.desc())
+        .limit(VISUALIZATION_CACHE_ENTRIES - 1)
+    )
+    db.session.execute(
+        db.delete(DataAnalysis)
+        .where(DataAnalysis.agency_id == agency_id, DataAnalysis.analysis_type.startswith(VISUALIZATION_CACHE_PREFIX))
+        .where(DataAnalysis.id.not_in(kept))
+    )
+
+def _default_series_start(bucket, end):
+    if bucket == 'day':
+        return end - timedelta(days=VISUALIZATION_BUCKETS['day'] - 1)
+    if bucket == 'week':
+        return end - timedelta(days=end.weekday(), weeks=VISUALIZATION_BUCKETS['week'] - 1)
+    months = end.year * 12 + end.month - VISUALIZATION_BUCKETS['month']
+    return date(months // 12, months % 12 + 1, 1)
+
+def _compute_series(agency_id, bucket, start, end):
+    until = end + timedelta(days=1)
+
+    def series(column, value, *joins, where):
+        period = _bucket(column, bucket)
+        statement = db.select(period, func.coalesce(func.sum(value), 0))
+        for target, condition in joins:
+            statement = statement.join(target, condition)
+        rows = db.session.execute(
+            statement.where(where, column >= start, column < until).group_by(period).order_by(period)
         ).all()
-        total_emails += len(emails)
+        # PostgreSQL returns sums of BIGINT columns as Decimal, which json.dumps rejects
+        return [{'period': _period_label(period), 'value': float(total)} for period, total in rows]
 
     return {
-        'total_emails_last_week': total_emails
+        'bucket': bucket,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'series': {
+            'lex': series(
+                Customer.addedOn, Customer.totalGrossAmount,
+                (LexAcc, Customer.lexAccId == LexAcc.id),
+                where=LexAcc.agency_id == agency_id
+            ),
+            'manual': series(Manual.addedOn, Manual.totalAmount, where=Manual.agency_id == agency_id),
+            'bank': series(
+                BankTransaction.booking_date, BankTransaction.amount,
+                (BankAccount, BankTransaction.account_id == BankAccount.id),
+                (BankConnection, BankAccount.connection_id == BankConnection.id),
+                where=and_(BankConnection.agency_id == agency_id, BankConnection.purge_requested_at.is_(None))
+            ),
+            'google_ads_cost': [
+                {'period': point['period'], 'value': point['value'] / 1_000_000}
+                for point in series(
+                    GoogleAdsCampaignDay.day, GoogleAdsCampaignDay.cost_micros,
+                    (GoogleAdsAccount, GoogleAdsCampaignDay.account_id == GoogleAdsAccount.id),
+                    where=GoogleAdsAccount.agency_id == agency_id
+                )
+            ],
+        }
     }
+
+def _bucket(column, bucket):
+    # Start of the day, week (Monday) or month containing the value
+    if db.session.get_bind().dialect.name == 'sqlite':
+        if bucket == 'day':
+            return func.date(column)
+        if bucket == 'week':
+            return func.date(column, 'weekday 0', '-6 days')
+        return func.strftime('%Y-%m-01', column)
+    return func.date_trunc(bucket, column)
+
+def _period_label(period):
+    if isinstance(period, datetime):
+        period = period.date()
+    return period.isoformat() if isinstance(period, date) else str(period)
+
+def analyze_emails(agency):
+    last_week = datetime.now() - timedelta(days=7)
+    total_emails = db.session.execute(
+        db.select(func.count(Email.id))
+        .join(MailUser, Email.mail_user_id == MailUser.id)
+        .where(MailUser.agency_id == agency.id, Email.date >= last_week)
+    ).scalar_one()
+
+    return {
+        'total_emails_last_week': total_emails
+    }
\ No newline at end of file
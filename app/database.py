@@ -1,8 +1,21 @@
 # Marketing\app\database.py
 
+from contextlib import contextmanager
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
 from sqlalchemy.orm import DeclarativeBase, MappedAsDataclass
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# pg_advisory_lock key held while create_app changes the schema
+SCHEMA_LOCK_KEY = 0x5C4E3A
+# Transaction-scoped lock between reusing email bodies and deleting orphans
+EMAIL_BODY_LOCK_KEY = 0x5C4E3B
+
 
 class Base(DeclarativeBase, MappedAsDataclass):
     pass
@@ -10,3 +23,60 @@ class Base(DeclarativeBase, MappedAsDataclass):
 
 db = SQLAlchemy(model_class=Base)
 
+
+@contextmanager
+def schema_lock():
+    """Hold a lock shared by every process using the database while the schema is changed.
+
+    create_app checks the schema and alters it in each gunicorn worker and
+    in the sync worker; the lock keeps two processes from running the same
+    ALTER at once. PostgreSQL uses an advisory lock, SQLite a lock file
+    next to the database. Without fcntl (Windows) SQLite is not locked.
+    """
+    engine = db.engine
+    if engine.dialect.name == 'postgresql':
+        # Autocommit, so the lock's connection holds no open transaction
+        # that the DDL of other connections would wait for
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {'key': SCHEMA_LOCK_KEY})
+            try:
+                yield
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': SCHEMA_LOCK_KEY})
+        return
+    path = engine.url.database
+    if engine.dialect.name != 'sqlite' or fcntl is None or not path or path == ':memory:':
+        yield
+        return
+    with open(f"{path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def enable_sqlite_wal():
+    """Switch a SQLite database file to write-ahead logging.
+
+    Readers then no longer block the writer, so the mail sync threads and
+    the web workers wait less on each other. The mode is stored in the
+    file, so every later connection uses it.
+    """
+    path = db.engine.url.database
+    if db.engine.dialect.name == 'sqlite' and path and path != ':memory:':
+        db.session.execute(text("PRAGMA journal_mode=WAL"))
+        db.session.commit()
+
+
+def email_body_lock(exclusive=False):
+    """Lock email_body against the orphan sweep until the session's transaction ends.
+
+    Syncs take it shared before reusing a stored body, the sweep takes it
+    exclusively, so a body cannot be deleted between being looked up and
+    being linked to a new email. PostgreSQL only: on SQLite the sync's
+    insert holds the database's single write lock for the same span.
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        function = 'pg_advisory_xact_lock' if exclusive else 'pg_advisory_xact_lock_shared'
+        db.session.execute(text(f"SELECT {function}(:key)"), {'key': EMAIL_BODY_LOCK_KEY})
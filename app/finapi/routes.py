@@ -1,14 +1,18 @@
 # Marketing\app\finapi\routes.py
 
 from app.finapi import bp
-from app.models import Agency, BankConnection
+from app.models import Agency, BankConnection, BankAccount
 from app.database import db
-from flask import render_template, request, abort, session, flash, redirect, url_for
+from flask import render_template, request, abort, session, flash, redirect, url_for, jsonify
 import requests as rq
 from flask import current_app
 import os
 from datetime import datetime, timedelta
 from app.helpers.finapi_helper import FinAPIHelper
+from app.helpers.bank_purge import delete_bank_connection
+from app.helpers.transaction_ingest import load_account_map, ingest_transactions, seed_finapi_balances
+from app.helpers.transaction_search import transaction_page
+from app.data_analysis import invalidate_analysis
 
 @bp.route('/', methods=["GET", "POST"])
 def main():
@@ -17,7 +21,7 @@ def main():
         flash("Please log in first", "warning")
         return redirect(url_for('main.login'))
 
-    bank_connections = BankConnection.query.filter_by(agency_id=current_agency.get("id")).all()
+    bank_connections = BankConnection.query.filter_by(agency_id=current_agency.get("id"), purge_requested_at=None).all()
     return render_template("fin_main.html", bank_connections=bank_connections)
 
 @bp.route('/connect-bank', methods=["POST"])
@@ -71,15 +75,28 @@ def fetch_transactions():
             flash("Invalid bank connection", "danger")
             return redirect(url_for("finapi.main"))
 
-        transactions = FinAPIHelper.get_transactions(
+        # Every page of the range is stored the way /sync_transactions does
+        accounts = BankAccount.query.filter_by(connection_id=bank_connection.id).all()
+        transactions = FinAPIHelper.iter_transactions(
             access_token,
-            [bank_connection.finapi_connection_id],
+            [account.finapi_account_id for account in accounts],
             from_date=(datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d'),
             to_date=datetime.now().strftime('%Y-%m-%d')
         )
+        inserted = ingest_transactions(transactions, load_account_map(bank_connection.agency_id))
+        seed_finapi_balances(access_token, accounts)
+        bank_connection.last_sync = datetime.utcnow()
+        invalidate_analysis(bank_connection.agency_id, 'bank')
+        db.session.commit()
 
-        return render_template("transactions.html", transactions=transactions, bank_name=bank_connection.bank_name)
+        flash(f"Fetched {inserted} new transactions", "success")
+        transactions, next_cursor = transaction_page([account.id for account in accounts])
+        return render_template(
+            "bank/transactions.html", bank_connection=bank_connection, transactions=transactions,
+            next_cursor=next_cursor
+        )
     except Exception as e:
+        db.session.rollback()
         flash(f"Error fetching transactions: {str(e)}", "danger")
         return redirect(url_for("finapi.main"))
 
@@ -100,15 +117,21 @@ def delete_connection(connection_id):
         access_token = FinAPIHelper.get_access_token()
         FinAPIHelper.delete_bank_connection(access_token, bank_connection.finapi_connection_id)
 
-        db.session.delete(bank_connection)
-        db.session.commit()
-
-        flash("Bank connection deleted successfully", "success")
+        if delete_bank_connection(bank_connection):
+            flash("Bank connection deleted successfully", "success")
+        else:
+            flash("Bank connection is being deleted in the background", "success")
     except Exception as e:
         flash(f"Error deleting bank connection: {str(e)}", "danger")
 
     return redirect(url_for("finapi.main"))
 
+@bp.route("/stats")
+def stats():
+    if not session.get('currentAgency'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(FinAPIHelper.get_stats())
+
 @bp.errorhandler(500)
 def internal_server_error(error):
     db.session.rollback()
@@ -2,134 +2,275 @@
 
 from google.ads.googleads.client import GoogleAdsClient
 from google.ads.googleads.errors import GoogleAdsException
+from google.ads.googleads.config import load_from_yaml_file
 from app.models import GoogleAdsAccount, GoogleAdsCampaign
 from app.database import db
+from app.data_analysis import invalidate_analysis
+from app.google_ads.metrics import store_daily_metrics, account_totals, account_rollups
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
 from flask import current_app
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import logging
 import os
+import threading
+import time
+
+# Clients are created on the sync pool's threads, which have no app context
+logger = logging.getLogger(__name__)
 
 class GoogleAdsHandler:
-    def __init__(self):
-        self.client = self._create_google_ads_client()
+    CAMPAIGN_QUERY = """
+        SELECT
+          customer.descriptive_name,
+          campaign.id,
+          campaign.name,
+          campaign.status,
+          campaign_budget.amount_micros,
+          segments.date,
+          metrics.impressions,
+          metrics.clicks,
+          metrics.cost_micros
+        FROM campaign
+        WHERE segments.date BETWEEN '{start}' AND '{end}'
+        ORDER BY segments.date
+    """
+    # Days of metrics fetched on an account's first sync
+    METRICS_BACKFILL_DAYS = 30
+    # Google Ads keeps adjusting the last few days (late conversions,
+    # invalid click credits), so they are fetched again on every sync
+    METRICS_RESTATEMENT_DAYS = 3
+    PERFORMANCE_DAYS = 30
+    # Campaign rows written per INSERT .. ON CONFLICT statement
+    UPSERT_BATCH_SIZE = 500
+
+    # Clients and services are built once per process and credentials;
+    # both are safe to share between threads
+    _clients = {}
+    _services = {}
+    _clients_lock = threading.Lock()
+
+    @classmethod
+    def get_client(cls, refresh_token=None):
+        """Return the cached GoogleAdsClient for the configured YAML file and refresh token."""
+        key = (os.getenv('GOOGLE_ADS_YAML_FILE_PATH'), refresh_token)
+        client = cls._clients.get(key)
+        if client is None:
+            with cls._clients_lock:
+                client = cls._clients.get(key)
+                if client is None:
+                    client = cls._clients[key] = cls._create_google_ads_client(*key)
+        return client
+
+    @classmethod
+    def get_service(cls, refresh_token=None):
+        """Return the cached GoogleAdsService for the given refresh token."""
+        key = (os.getenv('GOOGLE_ADS_YAML_FILE_PATH'), refresh_token)
+        service = cls._services.get(key)
+        if service is None:
+            service = cls.get_client(refresh_token).get_service("GoogleAdsService")
+            with cls._clients_lock:
+                service = cls._services.setdefault(key, service)
+        return service
 
-    def _create_google_ads_client(self):
+    @staticmethod
+    def _create_google_ads_client(yaml_path, refresh_token):
         try:
-            return GoogleAdsClient.load_from_storage(os.getenv('GOOGLE_ADS_YAML_FILE_PATH'))
+            if refresh_token is None:
+                return GoogleAdsClient.load_from_storage(yaml_path)
+            config = load_from_yaml_file(yaml_path)
+            config['refresh_token'] = refresh_token
+            return GoogleAdsClient.load_from_dict(config)
         except Exception as e:
-            current_app.logger.error(f"Error initializing Google Ads client: {str(e)}")
+            logger.error(f"Error initializing Google Ads client: {str(e)}")
             raise
 
-    def sync_campaigns(self, agency_id):
-        google_ads_accounts = GoogleAdsAccount.query.filter_by(agency_id=agency_id).all()
-        for account in google_ads_accounts:
-            try:
-                self._sync_account_campaigns(account)
-            except GoogleAdsException as ex:
-                current_app.logger.error(
-                    f'Request with ID "{ex.request_id}" failed with status '
-                    f'"{ex.error.code().name}" and includes the following errors:'
-                )
-                for error in ex.failure.errors:
-                    current_app.logger.error(f'\tError with message "{error.message}".')
-                    if error.location:
-                        for field_path_element in error.location.field_path_elements:
-                            current_app.logger.error(f"\t\tOn field: {field_path_element.field_name}")
-            except Exception as e:
-                current_app.logger.error(f"Error syncing campaigns for account {account.id}: {str(e)}")
-
-    def _sync_account_campaigns(self, account):
-        customer_id = account.customer_id
-        ga_service = self.client.get_service("GoogleAdsService")
-        query = """
-            SELECT
-              campaign.id,
-              campaign.name,
-              campaign.status,
-              campaign_budget.amount_micros,
-              metrics.impressions,
-              metrics.clicks,
-              metrics.cost_micros
-            FROM campaign
-            WHERE segments.date DURING LAST_30_DAYS
+    def sync_campaigns(self, agency_id, max_workers=None):
+        """Sync the campaigns of every GoogleAdsAccount of an agency.
+
+        The search_stream calls run concurrently on a bounded pool, while
+        each account's rows are written from this thread as soon as they
+        arrive. A failing account is logged and does not affect the others.
+        Returns one result dict per account.
         """
-        stream = ga_service.search_stream(customer_id=customer_id, query=query)
+        max_workers = max_workers or current_app.config.get('GOOGLE_ADS_SYNC_WORKERS', 8)
+        google_ads_accounts = GoogleAdsAccount.query.filter_by(agency_id=agency_id).all()
+        if not google_ads_accounts:
+            return []
 
+        today = date.today()
+        ranges = {account.id: (self._metrics_start(account, today), today) for account in google_ads_accounts}
+        results = {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(google_ads_accounts))) as executor:
+            futures = {
+                executor.submit(
+                    self._fetch_account_campaigns, account.customer_id, account.refresh_token, *ranges[account.id]
+                ): account
+                for account in google_ads_accounts
+            }
+            for future in as_completed(futures):
+                account = futures[future]
+                result = {
+                    'account_id': account.id, 'customer_id': account.customer_id,
+                    'campaigns': 0, 'days': 0, 'error': None, 'duration': 0.0
+                }
+                try:
+                    fetched, result['duration'] = future.result()
+                    self._store_account_campaigns(account, fetched, *ranges[account.id])
+                    result['campaigns'] = len(fetched['campaigns'])
+                    result['days'] = (ranges[account.id][1] - ranges[account.id][0]).days + 1
+                except GoogleAdsException as ex:
+                    db.session.rollback()
+                    self._log_google_ads_exception(ex)
+                    result['error'] = f"Google Ads request {ex.request_id} failed"
+                except Exception as e:
+                    db.session.rollback()
+                    current_app.logger.error(f"Error syncing campaigns for account {account.id}: {str(e)}")
+                    result['error'] = str(e)
+                results[account.id] = result
+        return [results[account.id] for account in google_ads_accounts]
+
+    def _metrics_start(self, account, today):
+        if account.metrics_synced_through is None:
+            return today - timedelta(days=self.METRICS_BACKFILL_DAYS - 1)
+        return min(account.metrics_synced_through - timedelta(days=self.METRICS_RESTATEMENT_DAYS - 1), today)
+
+    def _fetch_account_campaigns(self, customer_id, refresh_token, start, end):
+        # Runs on a worker thread: API calls only, no database access
+        started = time.perf_counter()
+        ga_service = self.get_service(refresh_token)
+        stream = ga_service.search_stream(
+            customer_id=customer_id,
+            query=self.CAMPAIGN_QUERY.format(start=start.isoformat(), end=end.isoformat())
+        )
+        # The query is segmented by date, so a campaign comes back once per
+        # day; keep one entry per campaign (the latest day wins) and the
+        # metrics per campaign and day
+        fetched = {'name': None, 'campaigns': {}, 'days': {}}
         for batch in stream:
             for row in batch.results:
-                campaign = row.campaign
-                budget = row.campaign_budget
-                metrics = row.metrics
-                
-                existing_campaign = GoogleAdsCampaign.query.filter_by(
-                    campaign_id=str(campaign.id),
-                    account_id=account.id
-                ).first()
-                
-                if existing_campaign:
-                    self._update_campaign(existing_campaign, campaign, budget, metrics)
-                else:
-                    new_campaign = self._create_campaign(campaign, budget, metrics, account.id)
-                    db.session.add(new_campaign)
+                campaign_id = str(row.campaign.id)
+                fetched['name'] = row.customer.descriptive_name
+                fetched['campaigns'][campaign_id] = {
+                    'campaign_id': campaign_id,
+                    'name': row.campaign.name,
+                    'status': row.campaign.status.name,
+                    'budget': row.campaign_budget.amount_micros / 1_000_000
+                }
+                fetched['days'][(campaign_id, date.fromisoformat(row.segments.date))] = (
+                    row.metrics.impressions, row.metrics.clicks, row.metrics.cost_micros
+                )
+        fetched['campaigns'] = list(fetched['campaigns'].values())
+        return fetched, time.perf_counter() - started
+
+    def _store_account_campaigns(self, account, fetched, start, end):
+        """Write the campaigns and daily metrics fetched for one account.
+
+        Stored campaigns are loaded with one query so unchanged ones can be
+        skipped; the rest are written UPSERT_BATCH_SIZE rows per statement.
+        """
+        campaigns = fetched['campaigns']
+        existing = {
+            row.campaign_id: row for row in db.session.execute(
+                db.select(
+                    GoogleAdsCampaign.id, GoogleAdsCampaign.campaign_id, GoogleAdsCampaign.name,
+                    GoogleAdsCampaign.status, GoogleAdsCampaign.budget
+                ).where(
+                    GoogleAdsCampaign.account_id == account.id,
+                    GoogleAdsCampaign.campaign_id.in_([campaign['campaign_id'] for campaign in campaigns])
+                )
+            )
+        }
+        changed = []
+        for campaign in campaigns:
+            stored = existing.get(campaign['campaign_id'])
+            if stored and (stored.name, stored.status, stored.budget) == (
+                campaign['name'], campaign['status'], campaign['budget']
+            ):
+                continue
+            changed.append(dict(campaign, account_id=account.id))
+
+        for offset in range(0, len(changed), self.UPSERT_BATCH_SIZE):
+            batch = changed[offset:offset + self.UPSERT_BATCH_SIZE]
+            statement = self._upsert_statement()
+            if statement is not None:
+                db.session.execute(statement, batch)
+            else:
+                self._write_campaigns(batch, existing)
 
+        campaign_ids = dict(db.session.execute(
+            db.select(GoogleAdsCampaign.campaign_id, GoogleAdsCampaign.id).where(
+                GoogleAdsCampaign.account_id == account.id,
+                GoogleAdsCampaign.campaign_id.in_([campaign['campaign_id'] for campaign in campaigns])
+            )
+        ).all())
+        store_daily_metrics(account.id, start, end, {
+            (campaign_ids[campaign_id], day): values
+            for (campaign_id, day), values in fetched['days'].items()
+        })
+        if fetched['name']:
+            account.descriptive_name = fetched['name']
+        # Today is still accumulating, so it is fetched again next time
+        account.metrics_synced_through = end - timedelta(days=1)
+
+        invalidate_analysis(account.agency_id, 'google_ads')
         db.session.commit()
 
-    def _update_campaign(self, existing_campaign, campaign, budget, metrics):
-        existing_campaign.name = campaign.name
-        existing_campaign.status = campaign.status.name
-        existing_campaign.budget = budget.amount_micros / 1_000_000
-        existing_campaign.impressions = metrics.impressions
-        existing_campaign.clicks = metrics.clicks
-        existing_campaign.cost = metrics.cost_micros / 1_000_000
-
-    def _create_campaign(self, campaign, budget, metrics, account_id):
-        return GoogleAdsCampaign(
-            campaign_id=str(campaign.id),
-            name=campaign.name,
-            status=campaign.status.name,
-            budget=budget.amount_micros / 1_000_000,
-            impressions=metrics.impressions,
-            clicks=metrics.clicks,
-            cost=metrics.cost_micros / 1_000_000,
-            account_id=account_id
+    def _upsert_statement(self):
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            statement = pg_insert(GoogleAdsCampaign)
+        elif dialect == 'sqlite':
+            statement = sqlite_insert(GoogleAdsCampaign)
+        else:
+            return None
+        return statement.on_conflict_do_update(
+            index_elements=['account_id', 'campaign_id'],
+            set_={
+                'name': statement.excluded.name,
+                'status': statement.excluded.status,
+                'budget': statement.excluded.budget
+            }
+        )
+
+    def _write_campaigns(self, batch, existing):
+        # Databases without ON CONFLICT: bulk UPDATE by primary key plus one INSERT
+        updates = [dict(row, id=existing[row['campaign_id']].id) for row in batch if row['campaign_id'] in existing]
+        inserts = [row for row in batch if row['campaign_id'] not in existing]
+        if updates:
+            db.session.execute(db.update(GoogleAdsCampaign), updates)
+        if inserts:
+            db.session.execute(db.insert(GoogleAdsCampaign), inserts)
+
+    def _log_google_ads_exception(self, ex):
+        current_app.logger.error(
+            f'Request with ID "{ex.request_id}" failed with status '
+            f'"{ex.error.code().name}" and includes the following errors:'
         )
+        for error in ex.failure.errors:
+            current_app.logger.error(f'\tError with message "{error.message}".')
+            if error.location:
+                for field_path_element in error.location.field_path_elements:
+                    current_app.logger.error(f"\t\tOn field: {field_path_element.field_name}")
 
     def get_account_performance(self, account_id):
-        account = GoogleAdsAccount.query.get(account_id)
+        """Totals of the last PERFORMANCE_DAYS days plus weekly and monthly rollups, from synced data."""
+        account = db.session.get(GoogleAdsAccount, account_id)
         if not account:
             return None
 
-        try:
-            customer_id = account.customer_id
-            ga_service = self.client.get_service("GoogleAdsService")
-            query = """
-                SELECT
-                  customer.descriptive_name,
-                  metrics.impressions,
-                  metrics.clicks,
-                  metrics.cost_micros
-                FROM customer
-                WHERE segments.date DURING LAST_30_DAYS
-            """
-            response = ga_service.search(customer_id=customer_id, query=query)
-
-            for row in response:
-                return {
-                    'name': row.customer.descriptive_name,
-                    'impressions': row.metrics.impressions,
-                    'clicks': row.metrics.clicks,
-                    'cost': row.metrics.cost_micros / 1_000_000
-                }
-        except GoogleAdsException as ex:
-            current_app.logger.error(f"Google Ads API error occurred: {ex}")
-        except Exception as e:
-            current_app.logger.error(f"Error fetching account performance: {str(e)}")
-
-        return None
+        performance = account_totals(account.id, date.today() - timedelta(days=self.PERFORMANCE_DAYS - 1))
+        performance['name'] = account.descriptive_name or account.customer_id
+        performance['synced_through'] = account.metrics_synced_through
+        performance['weekly'] = account_rollups(account.id, 'week')
+        performance['monthly'] = account_rollups(account.id, 'month')
+        return performance
 
     def link_google_ads_account(self, agency_id, customer_id, refresh_token):
         try:
             # Validate the customer_id and refresh_token with Google Ads API
-            self.client.oauth2.refresh_token = refresh_token
-            self.client.get_service("GoogleAdsService").search(
+            self.get_service(refresh_token).search(
                 customer_id=customer_id,
                 query="SELECT customer.id FROM customer LIMIT 1"
             )
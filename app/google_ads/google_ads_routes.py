@@ -2,13 +2,20 @@
 
 from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app
 from flask_login import login_required, current_user
-from app.models import GoogleAdsAccount, GoogleAdsCampaign
+from app.models import GoogleAdsAccount, GoogleAdsCampaign, GoogleAdsCampaignDay
 from app.database import db
 from app.google_ads.google_ads_handler import GoogleAdsHandler
+from app.data_analysis import invalidate_analysis
+from app.helpers.streaming_export import iter_csv, streaming_response
+from datetime import date, timedelta
+from sqlalchemy import func
 
 
 bp = Blueprint('google_ads', __name__)
 
+# Rows fetched per round trip when exporting
+EXPORT_YIELD_PER = 1000
+
 @bp.route('/')
 @login_required
 def index():
@@ -20,8 +27,12 @@ def index():
 def sync():
     handler = GoogleAdsHandler()
     try:
-        handler.sync_campaigns(current_user.agency_id)
-        flash('Google Ads campaigns synced successfully', 'success')
+        results = handler.sync_campaigns(current_user.agency_id)
+        failed = [result for result in results if result['error']]
+        if failed:
+            flash(f'{len(failed)} of {len(results)} Google Ads accounts failed to sync. Please try again later.', 'error')
+        else:
+            flash('Google Ads campaigns synced successfully', 'success')
     except Exception as e:
         current_app.logger.error(f"Error syncing Google Ads campaigns: {str(e)}")
         flash('Error syncing Google Ads campaigns. Please try again later.', 'error')
@@ -89,6 +100,7 @@ def unlink_account(account_id):
     
     try:
         db.session.delete(account)
+        invalidate_analysis(account.agency_id, 'google_ads')
         db.session.commit()
         flash('Google Ads account unlinked successfully.', 'success')
     except Exception as e:
@@ -106,18 +118,39 @@ def export_campaigns(account_id):
         flash('You do not have permission to export these campaigns.', 'error')
         return redirect(url_for('google_ads.index'))
     
-    campaigns = GoogleAdsCampaign.query.filter_by(account_id=account_id).order_by(GoogleAdsCampaign.name).all()
-    
-    csv_data = "Campaign ID,Name,Status,Budget,Impressions,Clicks,Cost\n"
-    for campaign in campaigns:
-        csv_data += f"{campaign.campaign_id},{campaign.name},{campaign.status},{campaign.budget},{campaign.impressions},{campaign.clicks},{campaign.cost}\n"
-    
-    response = current_app.response_class(
-        csv_data,
+    # Impressions, clicks and cost cover the last 30 synced days
+    metrics = (
+        db.select(
+            GoogleAdsCampaignDay.campaign_id,
+            func.sum(GoogleAdsCampaignDay.impressions).label('impressions'),
+            func.sum(GoogleAdsCampaignDay.clicks).label('clicks'),
+            func.sum(GoogleAdsCampaignDay.cost_micros).label('cost_micros')
+        ).where(
+            GoogleAdsCampaignDay.account_id == account_id,
+            GoogleAdsCampaignDay.day >= date.today() - timedelta(days=29)
+        ).group_by(GoogleAdsCampaignDay.campaign_id)
+        .subquery()
+    )
+    query = (
+        db.select(
+            GoogleAdsCampaign.campaign_id, GoogleAdsCampaign.name, GoogleAdsCampaign.status, GoogleAdsCampaign.budget,
+            func.coalesce(metrics.c.impressions, 0), func.coalesce(metrics.c.clicks, 0),
+            func.coalesce(metrics.c.cost_micros, 0)
+        ).outerjoin(metrics, metrics.c.campaign_id == GoogleAdsCampaign.id)
+        .where(GoogleAdsCampaign.account_id == account_id)
+        .order_by(GoogleAdsCampaign.name)
+        .execution_options(yield_per=EXPORT_YIELD_PER)
+    )
+
+    def rows():
+        for campaign_id, name, status, budget, impressions, clicks, cost_micros in db.session.execute(query):
+            yield campaign_id, name, status, budget, impressions, clicks, f"{cost_micros / 1_000_000:.2f}"
+
+    return streaming_response(
+        iter_csv(('Campaign ID', 'Name', 'Status', 'Budget', 'Impressions', 'Clicks', 'Cost'), rows()),
         mimetype='text/csv',
-        headers={'Content-Disposition': f'attachment;filename=google_ads_campaigns_{account_id}.csv'}
+        filename=f'google_ads_campaigns_{account_id}.csv'
     )
-    return response
 
 @bp.errorhandler(404)
 def page_not_found(e):
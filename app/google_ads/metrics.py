@@ -0,0 +1,177 @@
+# app/google_ads/metrics.py
+
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import func, inspect, text
+
+from app.models import GoogleAdsAccount, GoogleAdsCampaignDay, GoogleAdsCampaignRollup
+from app.database import db
+
+ROLLUP_PERIODS = ('week', 'month')
+
+_CAMPAIGN_REBUILD = (
+    """CREATE TABLE google_ads_campaign_scoped (
+        id INTEGER NOT NULL PRIMARY KEY,
+        campaign_id VARCHAR(20) NOT NULL,
+        name VARCHAR(100) NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        budget FLOAT NOT NULL,
+        account_id INTEGER NOT NULL REFERENCES google_ads_account (id)
+    )""",
+    "INSERT INTO google_ads_campaign_scoped (id, campaign_id, name, status, budget, account_id) "
+    "SELECT id, campaign_id, name, status, budget, account_id FROM google_ads_campaign",
+    "DROP TABLE google_ads_campaign",
+    "ALTER TABLE google_ads_campaign_scoped RENAME TO google_ads_campaign",
+)
+
+
+def add_account_columns():
+    """Add the metrics sync columns to a google_ads_account table created before them."""
+    columns = {column['name'] for column in inspect(db.session.connection()).get_columns('google_ads_account')}
+    if 'descriptive_name' not in columns:
+        db.session.execute(text("ALTER TABLE google_ads_account ADD COLUMN descriptive_name VARCHAR(255)"))
+    if 'metrics_synced_through' not in columns:
+        db.session.execute(text("ALTER TABLE google_ads_account ADD COLUMN metrics_synced_through DATE"))
+    db.session.commit()
+
+
+def scope_campaign_ids():
+    """Drop the table-wide UNIQUE (campaign_id) of an older google_ads_campaign table.
+
+    Campaigns are unique per account now; the (account_id, campaign_id)
+    index is created by the startup index pass, so this has to run before
+    it. SQLite cannot drop a constraint, so the table is rebuilt there.
+    Returns True if anything changed.
+    """
+    inspector = inspect(db.session.connection())
+    constraints = [
+        constraint for constraint in inspector.get_unique_constraints('google_ads_campaign')
+        if constraint['column_names'] == ['campaign_id']
+    ]
+    if not constraints:
+        return False
+    if db.session.get_bind().dialect.name == 'postgresql':
+        for constraint in constraints:
+            db.session.execute(text(f'ALTER TABLE google_ads_campaign DROP CONSTRAINT "{constraint["name"]}"'))
+    else:
+        # Rebuilt under a new name and renamed, so the foreign keys of
+        # the metrics tables keep pointing at google_ads_campaign
+        for statement in _CAMPAIGN_REBUILD:
+            db.session.execute(text(statement))
+    db.session.commit()
+    return True
+
+
+def period_start(day, period):
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def store_daily_metrics(account_id, start, end, days):
+    """Replace an account's daily metrics between start and end (inclusive).
+
+    ``days`` maps (campaign pk, day) to (impressions, clicks, cost_micros)
+    and has to cover the whole range: days missing from it had no data.
+    Rollups of every period touched by the range are rebuilt.
+    """
+    db.session.execute(db.delete(GoogleAdsCampaignDay).where(
+        GoogleAdsCampaignDay.account_id == account_id,
+        GoogleAdsCampaignDay.day.between(start, end)
+    ))
+    if days:
+        db.session.execute(db.insert(GoogleAdsCampaignDay), [
+            {
+                'campaign_id': campaign_id, 'day': day, 'account_id': account_id,
+                'impressions': impressions, 'clicks': clicks, 'cost_micros': cost_micros
+            }
+            for (campaign_id, day), (impressions, clicks, cost_micros) in days.items()
+        ])
+    rebuild_rollups(account_id, start)
+
+
+def rebuild_rollups(account_id, since):
+    """Recompute the weekly and monthly rollups of every period from ``since`` on."""
+    starts = {period: period_start(since, period) for period in ROLLUP_PERIODS}
+    for period, start in starts.items():
+        db.session.execute(db.delete(GoogleAdsCampaignRollup).where(
+            GoogleAdsCampaignRollup.account_id == account_id,
+            GoogleAdsCampaignRollup.period == period,
+            GoogleAdsCampaignRollup.period_start >= start
+        ))
+
+    totals = defaultdict(lambda: [0, 0, 0])
+    rows = db.session.execute(
+        db.select(
+            GoogleAdsCampaignDay.campaign_id, GoogleAdsCampaignDay.day, GoogleAdsCampaignDay.impressions,
+            GoogleAdsCampaignDay.clicks, GoogleAdsCampaignDay.cost_micros
+        ).where(
+            GoogleAdsCampaignDay.account_id == account_id,
+            GoogleAdsCampaignDay.day >= min(starts.values())
+        )
+    )
+    for campaign_id, day, impressions, clicks, cost_micros in rows:
+        for period, start in starts.items():
+            if day >= start:
+                total = totals[(campaign_id, period, period_start(day, period))]
+                total[0] += impressions
+                total[1] += clicks
+                total[2] += cost_micros
+
+    if totals:
+        db.session.execute(db.insert(GoogleAdsCampaignRollup), [
+            {
+                'campaign_id': campaign_id, 'period': period, 'period_start': start, 'account_id': account_id,
+                'impressions': impressions, 'clicks': clicks, 'cost_micros': cost_micros
+            }
+            for (campaign_id, period, start), (impressions, clicks, cost_micros) in totals.items()
+        ])
+
+
+def account_totals(account_id, since):
+    """Impressions, clicks and cost of one account from ``since`` on."""
+    return _totals(GoogleAdsCampaignDay.account_id == account_id, since)
+
+
+def agency_totals(agency_id, since):
+    """Impressions, clicks and cost of all accounts of an agency from ``since`` on."""
+    return _totals(
+        GoogleAdsCampaignDay.account_id.in_(
+            db.select(GoogleAdsAccount.id).where(GoogleAdsAccount.agency_id == agency_id)
+        ),
+        since
+    )
+
+
+def account_rollups(account_id, period, limit=12):
+    """The latest ``limit`` weekly or monthly totals of an account, oldest first."""
+    rows = db.session.execute(
+        db.select(
+            GoogleAdsCampaignRollup.period_start,
+            func.sum(GoogleAdsCampaignRollup.impressions),
+            func.sum(GoogleAdsCampaignRollup.clicks),
+            func.sum(GoogleAdsCampaignRollup.cost_micros)
+        ).where(
+            GoogleAdsCampaignRollup.account_id == account_id,
+            GoogleAdsCampaignRollup.period == period
+        ).group_by(GoogleAdsCampaignRollup.period_start)
+        .order_by(GoogleAdsCampaignRollup.period_start.desc())
+        .limit(limit)
+    ).all()
+    # PostgreSQL sums BIGINT columns into NUMERIC, which comes back as Decimal
+    return [
+        {'period_start': start, 'impressions': int(impressions), 'clicks': int(clicks), 'cost': int(cost_micros) / 1_000_000}
+        for start, impressions, clicks, cost_micros in reversed(rows)
+    ]
+
+
+def _totals(condition, since):
+    impressions, clicks, cost_micros = db.session.execute(
+        db.select(
+            func.coalesce(func.sum(GoogleAdsCampaignDay.impressions), 0),
+            func.coalesce(func.sum(GoogleAdsCampaignDay.clicks), 0),
+            func.coalesce(func.sum(GoogleAdsCampaignDay.cost_micros), 0)
+        ).where(condition, GoogleAdsCampaignDay.day >= since)
+    ).one()
+    return {'impressions': int(impressions), 'clicks': int(clicks), 'cost': int(cost_micros) / 1_000_000}
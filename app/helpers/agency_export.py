@@ -0,0 +1,136 @@
+# app/helpers/agency_export.py
+
+import json
+
+from app.models import LexAcc, Customer, Manual, BankConnection, BankAccount, BankTransaction
+from app.database import db
+
+# Rows fetched per round trip; only this many are held at once
+EXPORT_YIELD_PER = 1000
+
+
+def iter_agency_json(agency_id):
+    """Yield the agency export as one JSON document, piece by piece.
+
+    The document has the shape {"lex": [...], "manual": [...], "bank": [...]}
+    with customers nested in their Lexoffice account and transactions in
+    their bank account. Only the (small) lists of accounts and connections
+    are loaded up front; customers, manual entries and transactions are
+    streamed from the database.
+    """
+    yield '{"lex":'
+    yield from _array(
+        _object({'name': name, 'orgID': org_id}, 'customers', ([_dumps(customer)] for customer in _customers(lex_id)))
+        for lex_id, name, org_id in _lex_accounts(agency_id)
+    )
+    yield ',"manual":'
+    yield from _array([_dumps(entry)] for entry in _manual_entries(agency_id))
+    yield ',"bank":'
+    yield from _array(
+        _object({'bank_name': bank_name}, 'accounts', (
+            _object({'account_name': account_name}, 'transactions', (
+                [_dumps(transaction)] for transaction in _transactions(account_id)
+            ))
+            for account_id, account_name in _bank_accounts(connection_id)
+        ))
+        for connection_id, bank_name in _bank_connections(agency_id)
+    )
+    yield '}'
+
+
+def iter_agency_ndjson(agency_id):
+    """Yield the agency export as newline-delimited JSON, one record per line.
+
+    Every record carries a "type" and the id of its parent, so consumers
+    can process the export line by line without nesting.
+    """
+    for lex_id, name, org_id in _lex_accounts(agency_id):
+        yield _line({'type': 'lex', 'id': lex_id, 'name': name, 'orgID': org_id})
+        for customer in _customers(lex_id):
+            yield _line({'type': 'customer', 'lex_id': lex_id, **customer})
+    for entry in _manual_entries(agency_id):
+        yield _line({'type': 'manual', **entry})
+    for connection_id, bank_name in _bank_connections(agency_id):
+        yield _line({'type': 'bank_connection', 'id': connection_id, 'bank_name': bank_name})
+        for account_id, account_name in _bank_accounts(connection_id):
+            yield _line({'type': 'bank_account', 'id': account_id, 'connection_id': connection_id, 'account_name': account_name})
+            for transaction in _transactions(account_id):
+                yield _line({'type': 'transaction', 'account_id': account_id, **transaction})
+
+
+def _lex_accounts(agency_id):
+    return db.session.execute(
+        db.select(LexAcc.id, LexAcc.name, LexAcc.orgID).where(LexAcc.agency_id == agency_id).order_by(LexAcc.id)
+    ).all()
+
+
+def _customers(lex_id):
+    rows = _stream(
+        db.select(Customer.name, Customer.totalGrossAmount, Customer.totalNetAmount)
+        .where(Customer.lexAccId == lex_id).order_by(Customer.id)
+    )
+    for name, gross, net in rows:
+        yield {'name': name, 'gross': gross, 'net': net}
+
+
+def _manual_entries(agency_id):
+    rows = _stream(
+        db.select(Manual.name, Manual.source, Manual.totalAmount, Manual.addedOn)
+        .where(Manual.agency_id == agency_id).order_by(Manual.id)
+    )
+    for name, source, amount, added_on in rows:
+        yield {'name': name, 'source': source, 'amount': amount, 'date': added_on}
+
+
+def _bank_connections(agency_id):
+    return db.session.execute(
+        db.select(BankConnection.id, BankConnection.bank_name)
+        .where(BankConnection.agency_id == agency_id, BankConnection.purge_requested_at.is_(None))
+        .order_by(BankConnection.id)
+    ).all()
+
+
+def _bank_accounts(connection_id):
+    return db.session.execute(
+        db.select(BankAccount.id, BankAccount.account_name)
+        .where(BankAccount.connection_id == connection_id).order_by(BankAccount.id)
+    ).all()
+
+
+def _transactions(account_id):
+    rows = _stream(
+        db.select(BankTransaction.amount, BankTransaction.purpose, BankTransaction.booking_date)
+        .where(BankTransaction.account_id == account_id).order_by(BankTransaction.id)
+    )
+    for amount, purpose, booking_date in rows:
+        yield {'amount': amount, 'purpose': purpose, 'booking_date': booking_date}
+
+
+def _stream(statement):
+    # Plain column rows, fetched in batches (a server-side cursor on PostgreSQL)
+    return db.session.execute(statement.execution_options(yield_per=EXPORT_YIELD_PER))
+
+
+def _array(elements):
+    # Each element is itself an iterable of text pieces
+    yield '['
+    for index, element in enumerate(elements):
+        if index:
+            yield ','
+        yield from element
+    yield ']'
+
+
+def _object(fields, key, elements):
+    # ``fields`` followed by one streamed array member named ``key``
+    yield _dumps(fields)[:-1] + f',{json.dumps(key)}:'
+    yield from _array(elements)
+    yield '}'
+
+
+def _dumps(value):
+    return json.dumps(value, default=str, separators=(',', ':'))
+
+
+def _line(record):
+    return _dumps(record) + '\n'
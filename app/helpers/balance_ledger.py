@@ -0,0 +1,214 @@
+# app/helpers/balance_ledger.py
+
+from datetime import date
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, inspect, text, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.models import BankAccount, BankBalanceDay, BankTransaction
+from app.database import db
+
+
+def add_opening_balance_column():
+    """Add bank_account.opening_balance to a database created before it existed."""
+    columns = {column['name'] for column in inspect(db.session.connection()).get_columns('bank_account')}
+    if 'opening_balance' not in columns:
+        db.session.execute(text("ALTER TABLE bank_account ADD COLUMN opening_balance FLOAT"))
+        db.session.commit()
+
+
+def apply_balance_changes(changes):
+    """Add newly stored transactions to the balance ledger.
+
+    ``changes`` maps (account_id, day) to the summed amount of the
+    transactions stored for that day. The day's row is upserted and the
+    closing balance of every later day of the account is shifted, so a
+    sync only touches the days it changed and the days after them. Two
+    syncs adding the same new day both land in the one row.
+    """
+    upsert = _upsert_statement()
+    for (account_id, day), amount in sorted(changes.items()):
+        db.session.execute(
+            db.update(BankBalanceDay)
+            .where(BankBalanceDay.account_id == account_id, BankBalanceDay.day > day)
+            .values(balance=BankBalanceDay.balance + amount)
+        )
+        if upsert is None:
+            updated = db.session.execute(
+                db.update(BankBalanceDay)
+                .where(BankBalanceDay.account_id == account_id, BankBalanceDay.day == day)
+                .values(amount=BankBalanceDay.amount + amount, balance=BankBalanceDay.balance + amount)
+            ).rowcount
+            if updated:
+                continue
+        row = {
+            'account_id': account_id, 'day': day, 'amount': amount,
+            'balance': _balance_before(account_id, day) + amount
+        }
+        db.session.execute(upsert if upsert is not None else db.insert(BankBalanceDay), row)
+
+
+def _upsert_statement():
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        statement = pg_insert(BankBalanceDay)
+    elif dialect == 'sqlite':
+        statement = sqlite_insert(BankBalanceDay)
+    else:
+        return None
+    # The stored row already carries the balance up to its day
+    return statement.on_conflict_do_update(
+        index_elements=['account_id', 'day'],
+        set_={
+            'amount': BankBalanceDay.amount + statement.excluded.amount,
+            'balance': BankBalanceDay.balance + statement.excluded.amount
+        }
+    )
+
+
+def _balance_before(account_id, day):
+    # Closing balance of the latest earlier day, or the opening balance
+    previous = db.session.execute(
+        db.select(BankBalanceDay.balance)
+        .where(BankBalanceDay.account_id == account_id, BankBalanceDay.day < day)
+        .order_by(BankBalanceDay.day.desc()).limit(1)
+    ).scalar()
+    if previous is not None:
+        return previous
+    return db.session.execute(
+        db.select(BankAccount.opening_balance).where(BankAccount.id == account_id)
+    ).scalar() or 0
+
+
+def seed_opening_balances(balances):
+    """Set the opening balance of accounts that have none from the balance their bank reports.
+
+    ``balances`` maps BankAccount.id to the current balance, which includes
+    every stored transaction. The opening balance is the part that
+    precedes them, and every ledger day of the account is shifted by it.
+    Seeded accounts are skipped, so a later difference to the bank stays
+    visible instead of being absorbed. The caller commits.
+    """
+    seeded = 0
+    for account_id, current_balance in balances.items():
+        account = db.session.get(BankAccount, account_id)
+        if account is None or account.opening_balance is not None:
+            continue
+        # Before seeding the ledger starts at 0, so its latest balance is
+        # the sum of every transaction it has seen, archived ones included
+        stored = db.session.execute(
+            db.select(BankBalanceDay.balance).where(BankBalanceDay.account_id == account_id)
+            .order_by(BankBalanceDay.day.desc()).limit(1)
+        ).scalar() or 0
+        account.opening_balance = current_balance - stored
+        db.session.execute(
+            db.update(BankBalanceDay).where(BankBalanceDay.account_id == account_id)
+            .values(balance=BankBalanceDay.balance + account.opening_balance)
+        )
+        seeded += 1
+    return seeded
+
+
+def rebuild_balance_ledger(account_ids=None):
+    """Recompute the ledger from the stored transactions. Returns the number of rebuilt day rows.
+
+    Days before an account's earliest stored transaction are kept: their
+    transactions were archived (see archive_partitions), so those rows are
+    all that is left of them. The rebuilt days continue from the last kept
+    balance, or from the opening balance. Rebuilds every account unless
+    ``account_ids`` is given. The caller commits.
+    """
+    day = func.date(BankTransaction.booking_date)
+    first_days = db.select(BankTransaction.account_id, func.min(day)).group_by(BankTransaction.account_id)
+    totals = db.select(BankTransaction.account_id, day, func.sum(BankTransaction.amount))
+    if account_ids is not None:
+        first_days = first_days.where(BankTransaction.account_id.in_(account_ids))
+        totals = totals.where(BankTransaction.account_id.in_(account_ids))
+
+    balances = {}
+    for account_id, first_day in db.session.execute(first_days):
+        first_day = _as_date(first_day)
+        db.session.execute(
+            db.delete(BankBalanceDay).where(BankBalanceDay.account_id == account_id, BankBalanceDay.day >= first_day)
+        )
+        balances[account_id] = _balance_before(account_id, first_day)
+
+    rows = []
+    for account_id, booking_day, amount in db.session.execute(
+        totals.group_by(BankTransaction.account_id, day).order_by(BankTransaction.account_id, day)
+    ):
+        balances[account_id] += amount
+        rows.append({
+            'account_id': account_id, 'day': _as_date(booking_day), 'amount': amount,
+            'balance': balances[account_id]
+        })
+    if rows:
+        db.session.execute(db.insert(BankBalanceDay), rows)
+    return len(rows)
+
+
+def _as_date(value):
+    # SQLite's date() returns text
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def balance_ledger_pending():
+    """Whether transactions are stored but the ledger has not been built for them yet."""
+    if db.session.execute(db.select(BankBalanceDay.account_id).limit(1)).first():
+        return False
+    return db.session.execute(db.select(BankTransaction.id).limit(1)).first() is not None
+
+
+def account_balances(account_ids):
+    """Return {account_id: balance} from the latest ledger day of each account."""
+    if not account_ids:
+        return {}
+    # One primary-key probe per account, sent as a single statement
+    latest = [
+        db.select(
+            db.select(BankBalanceDay.account_id, BankBalanceDay.balance)
+            .where(BankBalanceDay.account_id == account_id)
+            .order_by(BankBalanceDay.day.desc()).limit(1).subquery()
+        )
+        for account_id in account_ids
+    ]
+    rows = db.session.execute(union_all(*latest))
+    return {account_id: balance for account_id, balance in rows}
+
+
+def balance_history(account_id, start=None, end=None):
+    """Return [(day, balance)] for the days between start and end that have transactions.
+
+    When ``start`` is given the series begins with the balance carried into
+    it, so a chart can draw the whole range from ledger rows alone.
+    """
+    query = db.select(BankBalanceDay.day, BankBalanceDay.balance).where(BankBalanceDay.account_id == account_id)
+    history = []
+    if start:
+        opening = db.session.execute(
+            db.select(BankBalanceDay.balance)
+            .where(BankBalanceDay.account_id == account_id, BankBalanceDay.day < start)
+            .order_by(BankBalanceDay.day.desc()).limit(1)
+        ).scalar()
+        if opening is not None:
+            history.append((start, opening))
+        query = query.where(BankBalanceDay.day >= start)
+    if end:
+        query = query.where(BankBalanceDay.day <= end)
+    history.extend(db.session.execute(query.order_by(BankBalanceDay.day)).tuples())
+    if len(history) > 1 and history[0][0] == history[1][0]:
+        # start itself has transactions; its own row replaces the carried balance
+        del history[0]
+    return history
+
+
+@click.command("rebuild-balance-ledger")
+@with_appcontext
+def rebuild_balance_ledger_command():
+    """Recompute every account's daily balances from the stored transactions."""
+    count = rebuild_balance_ledger()
+    db.session.commit()
+    click.echo(f"Stored {count} balance days")
@@ -0,0 +1,153 @@
+# app/helpers/bank_purge.py
+
+from datetime import datetime
+import logging
+
+from sqlalchemy import inspect, text
+
+from app.models import BankConnection, BankAccount, BankTransaction, BankBalanceDay
+from app.database import db
+from app.data_analysis import invalidate_analysis
+
+# Transactions deleted per statement; every chunk is its own short transaction
+PURGE_BATCH_SIZE = 10_000
+# Connections with more transactions than this are purged by the sync worker
+INLINE_PURGE_LIMIT = 50_000
+
+_CASCADING_FOREIGN_KEYS = (
+    ('bank_account', 'connection_id', 'bank_connection'),
+    ('bank_transaction', 'account_id', 'bank_account'),
+)
+
+logger = logging.getLogger(__name__)
+
+
+def add_purge_column():
+    """Add bank_connection.purge_requested_at to a database created before it existed."""
+    columns = {column['name'] for column in inspect(db.engine).get_columns('bank_connection')}
+    if 'purge_requested_at' not in columns:
+        db.session.execute(text("ALTER TABLE bank_connection ADD COLUMN purge_requested_at TIMESTAMP"))
+        db.session.commit()
+
+
+def add_cascading_foreign_keys():
+    """Recreate the bank foreign keys of an older PostgreSQL database with ON DELETE CASCADE.
+
+    The constraint is added NOT VALID and validated separately, so existing
+    rows are checked without blocking writes. SQLite cannot alter
+    constraints (nor enforces them by default); the purge below deletes
+    children explicitly, so it works without them. Returns the number of
+    recreated constraints.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return 0
+    inspector = inspect(db.engine)
+    recreated = 0
+    for table, column, referred in _CASCADING_FOREIGN_KEYS:
+        for foreign_key in inspector.get_foreign_keys(table):
+            if foreign_key['constrained_columns'] != [column]:
+                continue
+            if (foreign_key['options'].get('ondelete') or '').upper() == 'CASCADE':
+                continue
+            name = foreign_key['name']
+            db.session.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+            db.session.execute(text(
+                f'ALTER TABLE {table} ADD CONSTRAINT "{name}" FOREIGN KEY ({column}) '
+                f'REFERENCES {referred} (id) ON DELETE CASCADE NOT VALID'
+            ))
+            db.session.commit()
+            db.session.execute(text(f'ALTER TABLE {table} VALIDATE CONSTRAINT "{name}"'))
+            db.session.commit()
+            recreated += 1
+    return recreated
+
+
+def delete_bank_connection(connection):
+    """Delete a connection with its accounts, transactions and balance ledger.
+
+    The connection is hidden at once. Connections with up to
+    INLINE_PURGE_LIMIT transactions are purged right away; larger ones are
+    left to the sync worker. Returns True if nothing is left to purge.
+    """
+    connection.purge_requested_at = datetime.utcnow()
+    # Hidden connections no longer count towards the cached totals
+    invalidate_analysis(connection.agency_id, 'bank')
+    db.session.commit()
+    transactions = db.session.execute(
+        db.select(db.func.count()).select_from(
+            db.select(BankTransaction.id)
+            .join(BankAccount, BankTransaction.account_id == BankAccount.id)
+            .where(BankAccount.connection_id == connection.id)
+            .limit(INLINE_PURGE_LIMIT + 1).subquery()
+        )
+    ).scalar_one()
+    if transactions > INLINE_PURGE_LIMIT:
+        return False
+    purge_bank_connection(connection.id)
+    return True
+
+
+def purge_bank_connection(connection_id, batch_size=PURGE_BATCH_SIZE):
+    """Purge one connection completely, committing after every chunk."""
+    while purge_chunk(connection_id, batch_size):
+        pass
+
+
+def purge_next_chunk(batch_size=PURGE_BATCH_SIZE):
+    """Purge one chunk of the oldest pending connection. Returns False if none is pending."""
+    connection_id = db.session.execute(
+        db.select(BankConnection.id)
+        .where(BankConnection.purge_requested_at.isnot(None))
+        .order_by(BankConnection.purge_requested_at, BankConnection.id).limit(1)
+    ).scalar()
+    if connection_id is None:
+        return False
+    purge_chunk(connection_id, batch_size)
+    return True
+
+
+def purge_chunk(connection_id, batch_size=PURGE_BATCH_SIZE):
+    """Delete up to ``batch_size`` transactions of a connection and commit.
+
+    Once no transactions are left, the ledger rows, accounts and the
+    connection itself are deleted. Returns the number of deleted
+    transactions, so 0 means the connection is gone.
+    """
+    account_ids = db.session.execute(
+        db.select(BankAccount.id).where(BankAccount.connection_id == connection_id)
+    ).scalars().all()
+    if account_ids:
+        chunk = (
+            db.select(BankTransaction.id)
+            .where(BankTransaction.account_id.in_(account_ids))
+            .limit(batch_size)
+        )
+        deleted = db.session.execute(
+            db.delete(BankTransaction).where(BankTransaction.id.in_(chunk))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if deleted:
+            return deleted
+
+    agency_id = db.session.execute(
+        db.select(BankConnection.agency_id).where(BankConnection.id == connection_id)
+    ).scalar()
+    if account_ids:
+        db.session.execute(
+            db.delete(BankBalanceDay).where(BankBalanceDay.account_id.in_(account_ids))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            db.delete(BankAccount).where(BankAccount.connection_id == connection_id)
+            .execution_options(synchronize_session=False)
+        )
+    db.session.execute(
+        db.delete(BankConnection).where(BankConnection.id == connection_id)
+        .execution_options(synchronize_session=False)
+    )
+    if agency_id is not None:
+        invalidate_analysis(agency_id, 'bank')
+    db.session.commit()
+    logger.info(f"Purged bank connection {connection_id}")
+    return 0
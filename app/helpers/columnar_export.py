@@ -0,0 +1,168 @@
+# app/helpers/columnar_export.py
+
+from datetime import datetime
+from decimal import Decimal
+import os
+
+import click
+from flask.cli import with_appcontext
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from app.models import (
+    LexAcc, Customer, Manual, BankConnection, BankAccount, BankTransaction, GoogleAdsAccount, GoogleAdsCampaign
+)
+from app.database import db
+
+# Rows per SQLAlchemy partition, and so per Arrow record batch / Parquet row group chunk
+EXPORT_BATCH_SIZE = 50_000
+
+FILE_FORMATS = {
+    'parquet': 'application/vnd.apache.parquet',
+    # Arrow IPC file format: uncompressed, so it can be memory-mapped
+    'arrow': 'application/vnd.apache.arrow.file',
+}
+
+# Amounts are stored as floats; exported as exact two-decimal fixed point
+AMOUNT = pa.decimal128(18, 2)
+_CENT = Decimal('0.01')
+
+
+def _amount(value):
+    # repr() is the shortest string that round-trips, so 0.1 stays 0.1
+    return None if value is None else Decimal(repr(value)).quantize(_CENT)
+
+
+def _day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _transactions(agency_id):
+    columns = [
+        (pa.field('id', pa.int64()), BankTransaction.id, None),
+        (pa.field('account_id', pa.int64()), BankTransaction.account_id, None),
+        (pa.field('account_name', pa.string()), BankAccount.account_name, None),
+        (pa.field('bank_name', pa.string()), BankConnection.bank_name, None),
+        (pa.field('finapi_transaction_id', pa.int64()), BankTransaction.finapi_transaction_id, None),
+        (pa.field('amount', AMOUNT), BankTransaction.amount, _amount),
+        (pa.field('purpose', pa.string()), BankTransaction.purpose, None),
+        (pa.field('booking_date', pa.date32()), BankTransaction.booking_date, _day),
+        (pa.field('value_date', pa.date32()), BankTransaction.value_date, _day),
+    ]
+    return columns, lambda statement: (
+        statement.join(BankAccount, BankTransaction.account_id == BankAccount.id)
+        .join(BankConnection, BankAccount.connection_id == BankConnection.id)
+        .where(BankConnection.agency_id == agency_id, BankConnection.purge_requested_at.is_(None))
+        .order_by(BankTransaction.id)
+    )
+
+
+def _customers(agency_id):
+    columns = [
+        (pa.field('id', pa.int64()), Customer.id, None),
+        (pa.field('lex_acc_id', pa.int64()), Customer.lexAccId, None),
+        (pa.field('lex_acc_name', pa.string()), LexAcc.name, None),
+        (pa.field('lex_id', pa.string()), Customer.lexID, None),
+        (pa.field('name', pa.string()), Customer.name, None),
+        (pa.field('total_gross_amount', AMOUNT), Customer.totalGrossAmount, _amount),
+        (pa.field('total_net_amount', AMOUNT), Customer.totalNetAmount, _amount),
+        (pa.field('added_on', pa.timestamp('us')), Customer.addedOn, None),
+    ]
+    return columns, lambda statement: (
+        statement.join(LexAcc, Customer.lexAccId == LexAcc.id)
+        .where(LexAcc.agency_id == agency_id)
+        .order_by(Customer.id)
+    )
+
+
+def _manual(agency_id):
+    columns = [
+        (pa.field('id', pa.int64()), Manual.id, None),
+        (pa.field('identifier', pa.string()), Manual.identifier, None),
+        (pa.field('source', pa.string()), Manual.source, None),
+        (pa.field('name', pa.string()), Manual.name, None),
+        (pa.field('total_amount', AMOUNT), Manual.totalAmount, _amount),
+        (pa.field('added_on', pa.timestamp('us')), Manual.addedOn, None),
+    ]
+    return columns, lambda statement: statement.where(Manual.agency_id == agency_id).order_by(Manual.id)
+
+
+def _google_ads_campaigns(agency_id):
+    columns = [
+        (pa.field('id', pa.int64()), GoogleAdsCampaign.id, None),
+        (pa.field('account_id', pa.int64()), GoogleAdsCampaign.account_id, None),
+        (pa.field('customer_id', pa.string()), GoogleAdsAccount.customer_id, None),
+        (pa.field('campaign_id', pa.string()), GoogleAdsCampaign.campaign_id, None),
+        (pa.field('name', pa.string()), GoogleAdsCampaign.name, None),
+        (pa.field('status', pa.string()), GoogleAdsCampaign.status, None),
+        (pa.field('budget', AMOUNT), GoogleAdsCampaign.budget, _amount),
+    ]
+    return columns, lambda statement: (
+        statement.join(GoogleAdsAccount, GoogleAdsCampaign.account_id == GoogleAdsAccount.id)
+        .where(GoogleAdsAccount.agency_id == agency_id)
+        .order_by(GoogleAdsCampaign.id)
+    )
+
+
+DATASETS = {
+    'transactions': _transactions,
+    'customers': _customers,
+    'manual': _manual,
+    'google_ads_campaigns': _google_ads_campaigns,
+}
+
+
+def iter_record_batches(dataset, agency_id, batch_size=EXPORT_BATCH_SIZE):
+    """Return (schema, batches) for one dataset of an agency.
+
+    Rows are fetched ``batch_size`` at a time and every partition becomes
+    one Arrow record batch, so memory stays bounded by the batch size.
+    """
+    columns, finish = DATASETS[dataset](agency_id)
+    schema = pa.schema([field for field, _, _ in columns])
+    statement = finish(db.select(*[column for _, column, _ in columns]))
+
+    def batches():
+        result = db.session.execute(statement.execution_options(yield_per=batch_size))
+        for rows in result.partitions():
+            arrays = []
+            for (field, _, convert), values in zip(columns, zip(*rows)):
+                if convert:
+                    values = [convert(value) for value in values]
+                arrays.append(pa.array(values, type=field.type))
+            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    return schema, batches()
+
+
+def write_dataset(dataset, agency_id, sink, file_format='parquet', batch_size=EXPORT_BATCH_SIZE):
+    """Write one dataset of an agency to ``sink`` (a path or binary file). Returns the row count."""
+    schema, batches = iter_record_batches(dataset, agency_id, batch_size)
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    elif file_format == 'arrow':
+        writer = pa.ipc.new_file(sink, schema)
+    else:
+        raise ValueError(f"Unknown export format: {file_format}")
+
+    rows = 0
+    with writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+@click.command("export-agency-data")
+@click.argument("agency_id", type=int)
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--format", "file_format", type=click.Choice(list(FILE_FORMATS)), default='parquet', show_default=True)
+@click.option("--batch-size", default=EXPORT_BATCH_SIZE, show_default=True)
+@with_appcontext
+def export_agency_data_command(agency_id, directory, file_format, batch_size):
+    """Write every dataset of an agency as Parquet or Arrow files into DIRECTORY."""
+    os.makedirs(directory, exist_ok=True)
+    for dataset in DATASETS:
+        path = os.path.join(directory, f"{dataset}.{file_format}")
+        rows = write_dataset(dataset, agency_id, path, file_format, batch_size)
+        click.echo(f"{path}: {rows} rows")
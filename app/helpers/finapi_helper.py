@@ -1,43 +1,119 @@
 # app/helpers/finapi_helper.py
 
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from flask import current_app
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 import logging
+import threading
+import time
 
 class FinAPIHelper:
-    BASE_URL = "https://sandbox.finapi.io"
     API_VERSION = "v1"
+    # Refresh the client-credentials token this many seconds before it expires
+    TOKEN_REFRESH_MARGIN = 60
+    POOL_SIZE = 10
+
+    _session = None
+    _session_lock = threading.Lock()
+    _tokens = {}
+    _token_lock = threading.Lock()
+    _stats = {'requests': 0, 'request_seconds': 0.0, 'last_request_seconds': 0.0, 'token_fetches': 0}
+    _stats_lock = threading.Lock()
+
+    @classmethod
+    def get_session(cls):
+        """Return the process-wide pooled session, creating it on first use."""
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    retry = Retry(
+                        total=3,
+                        backoff_factor=0.5,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(['GET', 'DELETE'])
+                    )
+                    adapter = HTTPAdapter(
+                        pool_connections=cls.POOL_SIZE,
+                        pool_maxsize=cls.POOL_SIZE,
+                        max_retries=retry
+                    )
+                    session = requests.Session()
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.hooks['response'].append(cls._record_response)
+                    cls._session = session
+        return cls._session
+
+    @classmethod
+    def base_url(cls):
+        return current_app.config['FINAPI_BASE_URL']
+
+    @classmethod
+    def get_stats(cls):
+        with cls._stats_lock:
+            stats = dict(cls._stats)
+        stats['average_request_seconds'] = (
+            stats['request_seconds'] / stats['requests'] if stats['requests'] else 0
+        )
+        return stats
+
+    @classmethod
+    def _record_response(cls, response, *args, **kwargs):
+        elapsed = response.elapsed.total_seconds()
+        with cls._stats_lock:
+            cls._stats['requests'] += 1
+            cls._stats['request_seconds'] += elapsed
+            cls._stats['last_request_seconds'] = elapsed
 
     @classmethod
     def get_access_token(cls):
-        url = f"{cls.BASE_URL}/oauth/token"
-        data = {
-            'grant_type': 'client_credentials',
-            'client_id': current_app.config['FINAPI_CLIENT_ID'],
-            'client_secret': current_app.config['FINAPI_CLIENT_SECRET']
-        }
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Accept': 'application/json'
-        }
-        try:
-            response = requests.post(url, data=data, headers=headers)
-            response.raise_for_status()
-            return response.json()['access_token']
-        except RequestException as e:
-            logging.error(f"Error getting access token: {str(e)}")
-            raise
+        client_id = current_app.config['FINAPI_CLIENT_ID']
+        client_secret = current_app.config['FINAPI_CLIENT_SECRET']
+        with cls._token_lock:
+            cached = cls._tokens.get(client_id)
+            if cached and cached['expires_at'] - cls.TOKEN_REFRESH_MARGIN > time.monotonic():
+                return cached['access_token']
+
+            url = f"{cls.base_url()}/oauth/token"
+            data = {
+                'grant_type': 'client_credentials',
+                'client_id': client_id,
+                'client_secret': client_secret
+            }
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Accept': 'application/json'
+            }
+            try:
+                response = cls.get_session().post(url, data=data, headers=headers)
+                response.raise_for_status()
+                token = response.json()
+            except RequestException as e:
+                logging.error(f"Error getting access token: {str(e)}")
+                raise
+
+            with cls._stats_lock:
+                cls._stats['token_fetches'] += 1
+            cls._tokens[client_id] = {
+                'access_token': token['access_token'],
+                'expires_at': time.monotonic() + token.get('expires_in', 0)
+            }
+            return token['access_token']
 
     @classmethod
     def get_bank_connections(cls, access_token):
-        url = f"{cls.BASE_URL}/api/{cls.API_VERSION}/bankConnections"
+        url = f"{cls.base_url()}/api/{cls.API_VERSION}/bankConnections"
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Accept': 'application/json'
         }
         try:
-            response = requests.get(url, headers=headers)
+            response = cls.get_session().get(url, headers=headers)
             response.raise_for_status()
             return response.json()['connections']
         except RequestException as e:
@@ -46,7 +122,7 @@ class FinAPIHelper:
 
     @classmethod
     def import_bank_connection(cls, access_token, bank_id, credentials):
-        url = f"{cls.BASE_URL}/api/{cls.API_VERSION}/bankConnections/import"
+        url = f"{cls.base_url()}/api/{cls.API_VERSION}/bankConnections/import"
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json',
@@ -58,16 +134,81 @@ class FinAPIHelper:
             'loginCredentials': credentials
         }
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = cls.get_session().post(url, headers=headers, json=data)
             response.raise_for_status()
             return response.json()
         except RequestException as e:
             logging.error(f"Error importing bank connection: {str(e)}")
             raise
 
+    @classmethod
+    def get_accounts(cls, access_token, account_ids):
+        url = f"{cls.base_url()}/api/{cls.API_VERSION}/accounts"
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Accept': 'application/json'
+        }
+        try:
+            response = cls.get_session().get(url, headers=headers, params={'ids': ','.join(map(str, account_ids))})
+            response.raise_for_status()
+            return response.json()['accounts']
+        except RequestException as e:
+            logging.error(f"Error getting accounts: {str(e)}")
+            raise
+
     @classmethod
     def get_transactions(cls, access_token, account_ids, from_date, to_date, page=1, per_page=100):
-        url = f"{cls.BASE_URL}/api/{cls.API_VERSION}/transactions"
+        try:
+            return cls._get_transactions_page(
+                cls.base_url(), access_token, account_ids, from_date, to_date, page, per_page
+            )['transactions']
+        except RequestException as e:
+            logging.error(f"Error getting transactions: {str(e)}")
+            raise
+
+    @classmethod
+    def iter_transactions(cls, access_token, account_ids, from_date, to_date, per_page=500, max_workers=4):
+        """Yield every transaction in the date range, page by page.
+
+        The first page is fetched to read FinAPI's paging metadata; the
+        remaining pages are fetched by a pool of ``max_workers`` threads. At
+        most ``max_workers`` pages are in flight or buffered at a time, and
+        transactions are yielded in page order.
+        """
+        # Read here: the pool's threads run without an app context
+        base_url = cls.base_url()
+        try:
+            first_page = cls._get_transactions_page(
+                base_url, access_token, account_ids, from_date, to_date, 1, per_page
+            )
+            yield from first_page['transactions']
+
+            page_count = first_page.get('paging', {}).get('pageCount', 1)
+            if page_count <= 1:
+                return
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                def submit(page):
+                    return executor.submit(
+                        cls._get_transactions_page, base_url, access_token, account_ids, from_date, to_date, page,
+                        per_page
+                    )
+
+                pages = iter(range(2, page_count + 1))
+                in_flight = deque(submit(page) for page in islice(pages, max_workers))
+                while in_flight:
+                    transactions = in_flight.popleft().result()['transactions']
+                    next_page = next(pages, None)
+                    if next_page is not None:
+                        in_flight.append(submit(next_page))
+                    yield from transactions
+        except RequestException as e:
+            logging.error(f"Error getting transactions: {str(e)}")
+            raise
+
+    @classmethod
+    def _get_transactions_page(cls, base_url, access_token, account_ids, from_date, to_date, page, per_page):
+        url = f"{base_url}/api/{cls.API_VERSION}/transactions"
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Accept': 'application/json'
@@ -80,23 +221,19 @@ class FinAPIHelper:
             'perPage': per_page,
             'order': 'date,desc'
         }
-        try:
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            return response.json()['transactions']
-        except RequestException as e:
-            logging.error(f"Error getting transactions: {str(e)}")
-            raise
+        response = cls.get_session().get(url, headers=headers, params=params)
+        response.raise_for_status()
+        return response.json()
 
     @classmethod
     def get_bank_details(cls, access_token, bank_id):
-        url = f"{cls.BASE_URL}/api/{cls.API_VERSION}/banks/{bank_id}"
+        url = f"{cls.base_url()}/api/{cls.API_VERSION}/banks/{bank_id}"
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Accept': 'application/json'
         }
         try:
-            response = requests.get(url, headers=headers)
+            response = cls.get_session().get(url, headers=headers)
             response.raise_for_status()
             return response.json()
         except RequestException as e:
@@ -105,13 +242,13 @@ class FinAPIHelper:
 
     @classmethod
     def delete_bank_connection(cls, access_token, connection_id):
-        url = f"{cls.BASE_URL}/api/{cls.API_VERSION}/bankConnections/{connection_id}"
+        url = f"{cls.base_url()}/api/{cls.API_VERSION}/bankConnections/{connection_id}"
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Accept': 'application/json'
         }
         try:
-            response = requests.delete(url, headers=headers)
+            response = cls.get_session().delete(url, headers=headers)
             response.raise_for_status()
             return True
         except RequestException as e:
@@ -0,0 +1,76 @@
+# app/helpers/streaming_export.py
+
+import csv
+import io
+import zlib
+
+from flask import current_app, request, stream_with_context
+
+# Bytes buffered before a chunk is handed to the WSGI server
+EXPORT_CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+
+
+def iter_csv(header, rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield ``header`` and ``rows`` as UTF-8 CSV in chunks of about ``chunk_size`` bytes.
+
+    ``rows`` may be any iterable of sequences, e.g. a yield_per result, so
+    only one chunk is held in memory at a time.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_text(pieces, chunk_size=EXPORT_CHUNK_SIZE):
+    """Join a stream of small text pieces into UTF-8 chunks of about ``chunk_size`` bytes."""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    """Compress a stream of byte chunks into a single gzip member."""
+    # wbits=31 selects the gzip container instead of raw zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+
+def streaming_response(chunks, mimetype, filename, compress=None):
+    """Stream byte chunks as a file download.
+
+    The body is gzip-encoded when ``compress`` is true, or by default when
+    the client sends ``Accept-Encoding: gzip``. The request and app context
+    stay available while the generator runs, so it may keep querying.
+    """
+    if compress is None:
+        compress = accepts_gzip()
+    headers = {'Content-Disposition': f'attachment; filename={filename}', 'Vary': 'Accept-Encoding'}
+    if compress:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return current_app.response_class(stream_with_context(chunks), mimetype=mimetype, headers=headers)
@@ -0,0 +1,140 @@
+# app/helpers/transaction_ingest.py
+
+from collections import defaultdict
+from datetime import datetime
+from itertools import islice
+import logging
+import time
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.models import BankConnection, BankAccount, BankTransaction
+from app.database import db
+from app.helpers.balance_ledger import apply_balance_changes, seed_opening_balances
+from app.helpers.finapi_helper import FinAPIHelper
+from app.helpers.transaction_partitions import ensure_partitions
+
+BATCH_SIZE = 1000
+
+
+def load_account_map(agency_id):
+    """Return {finapi_account_id: BankAccount.id} for all accounts of an agency."""
+    rows = db.session.execute(
+        db.select(BankAccount.finapi_account_id, BankAccount.id)
+        .join(BankConnection, BankAccount.connection_id == BankConnection.id)
+        .where(BankConnection.agency_id == agency_id, BankConnection.purge_requested_at.is_(None))
+    ).all()
+    return {finapi_account_id: account_id for finapi_account_id, account_id in rows}
+
+
+def ingest_transactions(transactions, account_map, batch_size=BATCH_SIZE):
+    """Insert FinAPI transactions that are not stored yet.
+
+    ``transactions`` may be any iterable of FinAPI transaction dicts. Rows
+    are handled in batches: one IN query finds the ids that already exist
+    and the remaining rows are written with a single bulk INSERT. The
+    balance ledger is updated once for all inserted rows. The caller owns
+    the transaction and is expected to commit.
+
+    Returns the number of inserted rows.
+    """
+    started = time.perf_counter()
+    seen = 0
+    inserted = 0
+    balance_changes = defaultdict(float)
+    iterator = iter(transactions)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+        seen += len(batch)
+        inserted += _ingest_batch(batch, account_map, balance_changes)
+    apply_balance_changes(balance_changes)
+
+    elapsed = time.perf_counter() - started
+    if seen:
+        logging.info(
+            f"Ingested {inserted} of {seen} transactions in {elapsed:.3f}s "
+            f"({seen / elapsed if elapsed else 0:.0f} rows/sec)"
+        )
+    return inserted
+
+
+def seed_finapi_balances(access_token, accounts):
+    """Seed the opening balance of the given BankAccounts that have none from FinAPI.
+
+    Call after ingesting their transactions, so the balance FinAPI reports
+    covers what the ledger holds. Returns the number of seeded accounts.
+    """
+    unseeded = {account.finapi_account_id: account.id for account in accounts if account.opening_balance is None}
+    if not unseeded:
+        return 0
+    return seed_opening_balances({
+        unseeded[finapi_account['id']]: finapi_account['balance']
+        for finapi_account in FinAPIHelper.get_accounts(access_token, list(unseeded))
+        if finapi_account['id'] in unseeded and finapi_account.get('balance') is not None
+    })
+
+
+def _ingest_batch(batch, account_map, balance_changes):
+    batch_ids = {transaction['id'] for transaction in batch}
+    account_ids = {account_map[transaction['accountId']] for transaction in batch if transaction['accountId'] in account_map}
+    # Served by the unique (account_id, finapi_transaction_id) index. On a
+    # partitioned table that index also contains booking_date, so only this
+    # lookup, which probes every partition, catches a transaction FinAPI
+    # has moved to another booking date
+    existing_ids = set(db.session.execute(
+        db.select(BankTransaction.account_id, BankTransaction.finapi_transaction_id).where(
+            BankTransaction.account_id.in_(account_ids),
+            BankTransaction.finapi_transaction_id.in_(batch_ids)
+        )
+    ).tuples())
+
+    rows = []
+    for transaction in batch:
+        account_id = account_map.get(transaction['accountId'])
+        if account_id is None:
+            logging.error(f"Account not found for transaction {transaction['id']}")
+            continue
+        if (account_id, transaction['id']) in existing_ids:
+            continue
+        # Guard against the same id showing up twice in one response
+        existing_ids.add((account_id, transaction['id']))
+        rows.append({
+            'account_id': account_id,
+            'finapi_transaction_id': transaction['id'],
+            'amount': transaction['amount'],
+            'purpose': transaction.get('purpose'),
+            'booking_date': datetime.strptime(transaction['bookingDate'], '%Y-%m-%d').date(),
+            'value_date': datetime.strptime(transaction['valueDate'], '%Y-%m-%d').date()
+        })
+
+    if not rows:
+        return 0
+    ensure_partitions({row['booking_date'] for row in rows})
+    statement = _insert_ignore_statement()
+    if db.session.get_bind().dialect.insert_executemany_returning:
+        # Rows skipped by ON CONFLICT (e.g. stored by a concurrent sync
+        # since the lookup) are not returned and stay out of the ledger
+        stored = db.session.execute(
+            statement.returning(BankTransaction.account_id, BankTransaction.booking_date, BankTransaction.amount),
+            rows
+        ).all()
+    else:
+        db.session.execute(statement, rows)
+        stored = [(row['account_id'], row['booking_date'], row['amount']) for row in rows]
+    for account_id, booking_date, amount in stored:
+        if isinstance(booking_date, datetime):
+            booking_date = booking_date.date()
+        balance_changes[(account_id, booking_date)] += amount
+    return len(stored)
+
+
+def _insert_ignore_statement():
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return pg_insert(BankTransaction).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite_insert(BankTransaction).on_conflict_do_nothing()
+    return db.insert(BankTransaction)
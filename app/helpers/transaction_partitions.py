@@ -0,0 +1,287 @@
+# app/helpers/transaction_partitions.py
+
+from datetime import date, timedelta
+import logging
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
+from app.database import db
+from app.helpers.transaction_search import trigram_extension_installed, create_trigram_index
+
+# Monthly partitions created in advance, counted from the current month
+PARTITION_MONTHS_AHEAD = 3
+# Rows copied per statement by migrate-bank-transactions
+MIGRATION_BATCH_SIZE = 50_000
+# Schema that archive-bank-transactions moves detached partitions into
+ARCHIVE_SCHEMA = 'bank_transaction_archive'
+
+_LEGACY_TABLE = 'bank_transaction_unpartitioned'
+_COLUMNS = "id, account_id, finapi_transaction_id, amount, purpose, booking_date, value_date"
+
+# On PostgreSQL bank_transaction is partitioned by booking_date month. The
+# columns match models.BankTransaction; the primary key and the unique
+# index also contain booking_date because PostgreSQL requires the partition
+# key in both. SQLite keeps the single table create_all makes, and every
+# function below is a no-op there.
+_PARENT_DDL = (
+    """CREATE TABLE bank_transaction (
+        id SERIAL NOT NULL,
+        account_id INTEGER NOT NULL REFERENCES bank_account (id) ON DELETE CASCADE,
+        finapi_transaction_id INTEGER NOT NULL,
+        amount FLOAT NOT NULL,
+        purpose VARCHAR(255) NOT NULL,
+        booking_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        value_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (id, booking_date)
+    ) PARTITION BY RANGE (booking_date)""",
+    "CREATE INDEX ix_bank_transaction_account_booking ON bank_transaction (account_id, booking_date, id)",
+    "CREATE UNIQUE INDEX uq_bank_transaction_account_finapi "
+    "ON bank_transaction (account_id, finapi_transaction_id, booking_date)",
+)
+# Names the legacy table's objects would otherwise clash with
+_LEGACY_RENAMES = (
+    "ALTER TABLE bank_transaction RENAME TO bank_transaction_unpartitioned",
+    "ALTER TABLE bank_transaction_unpartitioned RENAME CONSTRAINT bank_transaction_pkey TO bank_transaction_unpartitioned_pkey",
+    "ALTER SEQUENCE IF EXISTS bank_transaction_id_seq RENAME TO bank_transaction_unpartitioned_id_seq",
+    "ALTER INDEX IF EXISTS ix_bank_transaction_account_booking RENAME TO ix_bank_transaction_unpartitioned_account_booking",
+    "ALTER INDEX IF EXISTS uq_bank_transaction_account_finapi RENAME TO uq_bank_transaction_unpartitioned_account_finapi",
+    "ALTER INDEX IF EXISTS ix_bank_transaction_purpose_trgm RENAME TO ix_bank_transaction_unpartitioned_purpose_trgm",
+)
+
+# Per database URL: whether bank_transaction is partitioned, and the months
+# that have a partition
+_partitioned = {}
+_known_months = {}
+
+logger = logging.getLogger(__name__)
+
+
+def _month(day):
+    return date(day.year, day.month, 1)
+
+
+def _next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return f"bank_transaction_{month:%Y_%m}"
+
+
+def _is_postgresql():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def is_partitioned():
+    """Whether bank_transaction is a partitioned PostgreSQL table."""
+    url = str(db.engine.url)
+    if url not in _partitioned:
+        _partitioned[url] = _is_postgresql() and db.session.execute(text(
+            "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('bank_transaction')"
+        )).scalar() is True
+    return _partitioned[url]
+
+
+def create_partitioned_table():
+    """Create bank_transaction as a partitioned table on a new PostgreSQL database.
+
+    Has to run before db.create_all(), which would otherwise create the
+    plain table. The tables it references are created first.
+    """
+    if not _is_postgresql() or inspect(db.engine).has_table('bank_transaction'):
+        return False
+    db.metadata.create_all(db.engine, tables=[
+        table for table in db.metadata.sorted_tables if table.name != 'bank_transaction'
+    ])
+    for statement in _PARENT_DDL:
+        db.session.execute(text(statement))
+    db.session.commit()
+    _partitioned.pop(str(db.engine.url), None)
+    create_upcoming_partitions()
+    return True
+
+
+def _partition_months():
+    rows = db.session.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'bank_transaction'::regclass"
+    )).scalars()
+    months = set()
+    for name in rows:
+        year, _, month = name.removeprefix('bank_transaction_').partition('_')
+        if year.isdigit() and month.isdigit():
+            months.add(date(int(year), int(month), 1))
+    return months
+
+
+def ensure_partitions(days):
+    """Create the monthly partitions the given booking days fall into.
+
+    The DDL runs in the caller's transaction. It takes an ACCESS EXCLUSIVE
+    lock on bank_transaction, which a second connection could never get
+    while the caller's own transaction has read from or written to the
+    table. The lock is held until the caller commits; upcoming months are
+    created at startup, so during syncs this only happens for old booking
+    dates. Returns the number of partitions created.
+    """
+    if not days or not is_partitioned():
+        return 0
+    url = str(db.engine.url)
+    months = {_month(day) for day in days}
+    if months <= _known_months.get(url, set()):
+        return 0
+    _known_months[url] = _partition_months()
+
+    created = 0
+    for month in sorted(months - _known_months[url]):
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {_partition_name(month)} PARTITION OF bank_transaction "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+        ))
+        _known_months[url].add(month)
+        # Forgotten again if the caller rolls back (see _forget_rolled_back_partitions)
+        db.session.info.setdefault('new_partitions', set()).add((url, month))
+        created += 1
+        logger.info(f"Created partition {_partition_name(month)}")
+    return created
+
+
+@event.listens_for(Session, "after_commit")
+def _keep_committed_partitions(session):
+    session.info.pop('new_partitions', None)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_partitions(session):
+    for url, month in session.info.pop('new_partitions', ()):
+        _known_months.get(url, set()).discard(month)
+
+
+def create_upcoming_partitions(today=None):
+    """Create and commit partitions from last month to PARTITION_MONTHS_AHEAD months ahead."""
+    month = _month(_month(today or date.today()) - timedelta(days=1))
+    months = []
+    for _ in range(PARTITION_MONTHS_AHEAD + 2):
+        months.append(month)
+        month = _next_month(month)
+    created = ensure_partitions(months)
+    db.session.commit()
+    return created
+
+
+def archive_partitions(before, drop=False):
+    """Detach every partition that ends on or before ``before``.
+
+    Detached partitions are moved into ARCHIVE_SCHEMA, or dropped with
+    ``drop``. Their rows leave every query, while the balance ledger keeps
+    the balances they contributed. Returns the names of the partitions.
+    """
+    if not is_partitioned():
+        return []
+    archived = []
+    for month in sorted(_partition_months()):
+        if _next_month(month) > before:
+            continue
+        name = _partition_name(month)
+        db.session.execute(text(f"ALTER TABLE bank_transaction DETACH PARTITION {name}"))
+        if drop:
+            db.session.execute(text(f"DROP TABLE {name}"))
+        else:
+            db.session.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+            db.session.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+        db.session.commit()
+        archived.append(name)
+    _known_months.pop(str(db.engine.url), None)
+    return archived
+
+
+def migrate_to_partitions(batch_size=MIGRATION_BATCH_SIZE, keep_legacy=False):
+    """Move the rows of an unpartitioned PostgreSQL bank_transaction into a partitioned one.
+
+    Meant for a maintenance window with the app and workers stopped: the
+    old table is renamed, the partitioned table is created, rows are copied
+    ``batch_size`` at a time in id order and the id sequence is carried
+    over. Returns the number of copied rows.
+    """
+    if not _is_postgresql() or is_partitioned():
+        return 0
+    for statement in _LEGACY_RENAMES:
+        db.session.execute(text(statement))
+    for statement in _PARENT_DDL:
+        db.session.execute(text(statement))
+    db.session.commit()
+    url = str(db.engine.url)
+    _partitioned.pop(url, None)
+    _known_months.pop(url, None)
+
+    first, last = db.session.execute(text(
+        f"SELECT min(booking_date), max(booking_date) FROM {_LEGACY_TABLE}"
+    )).one()
+    months = []
+    if first is not None:
+        month = _month(first)
+        while month <= last.date():
+            months.append(month)
+            month = _next_month(month)
+    ensure_partitions(months)
+    create_upcoming_partitions()
+
+    copied = 0
+    last_id = 0
+    while True:
+        max_id = db.session.execute(text(
+            f"SELECT max(id) FROM (SELECT id FROM {_LEGACY_TABLE} WHERE id > :last_id ORDER BY id LIMIT :limit) AS batch"
+        ), {'last_id': last_id, 'limit': batch_size}).scalar()
+        if max_id is None:
+            break
+        copied += db.session.execute(text(
+            f"INSERT INTO bank_transaction ({_COLUMNS}) "
+            f"SELECT {_COLUMNS} FROM {_LEGACY_TABLE} WHERE id > :last_id AND id <= :max_id"
+        ), {'last_id': last_id, 'max_id': max_id}).rowcount
+        db.session.commit()
+        last_id = max_id
+        logger.info(f"Copied {copied} transactions")
+
+    db.session.execute(text(
+        "SELECT setval(pg_get_serial_sequence('bank_transaction', 'id'), "
+        "(SELECT coalesce(max(id), 0) + 1 FROM bank_transaction), false)"
+    ))
+    if not keep_legacy:
+        db.session.execute(text(f"DROP TABLE {_LEGACY_TABLE}"))
+    db.session.commit()
+    if trigram_extension_installed():
+        # The old table's purpose index stayed with it
+        create_trigram_index()
+    return copied
+
+
+@click.command("migrate-bank-transactions")
+@click.option("--batch-size", default=MIGRATION_BATCH_SIZE, show_default=True)
+@click.option("--keep-legacy", is_flag=True, help=f"Keep the old table as {_LEGACY_TABLE}.")
+@with_appcontext
+def migrate_bank_transactions_command(batch_size, keep_legacy):
+    """Partition an existing PostgreSQL bank_transaction table by booking month."""
+    if not _is_postgresql():
+        click.echo("Partitioning needs PostgreSQL; SQLite keeps a single table")
+        return
+    click.echo(f"Copied {migrate_to_partitions(batch_size, keep_legacy)} transactions")
+
+
+@click.command("archive-bank-transactions")
+@click.option("--keep-months", default=24, show_default=True, help="Months of history to keep attached.")
+@click.option("--drop", is_flag=True, help="Drop old partitions instead of moving them to the archive schema.")
+@with_appcontext
+def archive_bank_transactions_command(keep_months, drop):
+    """Detach bank_transaction partitions older than --keep-months."""
+    if not is_partitioned():
+        click.echo("bank_transaction is not partitioned; nothing to archive")
+        return
+    before = _month(date.today())
+    for _ in range(keep_months):
+        before = _month(before - timedelta(days=1))
+    for name in archive_partitions(before, drop):
+        click.echo(f"{'Dropped' if drop else 'Archived'} {name}")
@@ -0,0 +1,261 @@
+# app/helpers/transaction_search.py
+
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, inspect, text, tuple_, union_all
+
+from app.models import BankTransaction
+from app.database import db
+
+TRANSACTION_PAGE_SIZE = 50
+# Shortest search term the trigram indexes can answer
+TRIGRAM_MIN_LENGTH = 3
+# Purpose matches up to which SQLite looks rows up through the FTS index
+# rather than scanning the account/date index in order
+FTS_SELECTIVE_LIMIT = 20_000
+
+# The composite and unique indexes are declared on the model; the purpose
+# indexes depend on the database. PostgreSQL gets a pg_trgm GIN index,
+# which serves ILIKE '%term%' directly. Creating the extension needs a
+# privileged role, so that index is left to create-purpose-index. SQLite
+# gets an external-content FTS5 trigram table over
+# bank_transaction.purpose, kept in sync by triggers so bulk inserts and
+# deletes need no extra code. Until an index exists, purpose search scans
+# the matching accounts.
+_UNIQUE_INDEX = 'uq_bank_transaction_account_finapi'
+_POSTGRES_EXTENSION_DDL = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+_POSTGRES_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_bank_transaction_purpose_trgm "
+    "ON bank_transaction USING GIN (purpose gin_trgm_ops)"
+)
+_SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS bank_transaction_fts USING fts5("
+    "purpose, content='bank_transaction', content_rowid='id', tokenize='trigram')",
+    """CREATE TRIGGER IF NOT EXISTS bank_transaction_fts_insert AFTER INSERT ON bank_transaction BEGIN
+        INSERT INTO bank_transaction_fts (rowid, purpose) VALUES (new.id, new.purpose);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS bank_transaction_fts_delete AFTER DELETE ON bank_transaction BEGIN
+        INSERT INTO bank_transaction_fts (bank_transaction_fts, rowid, purpose) VALUES ('delete', old.id, old.purpose);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS bank_transaction_fts_update AFTER UPDATE OF purpose ON bank_transaction BEGIN
+        INSERT INTO bank_transaction_fts (bank_transaction_fts, rowid, purpose) VALUES ('delete', old.id, old.purpose);
+        INSERT INTO bank_transaction_fts (rowid, purpose) VALUES (new.id, new.purpose);
+    END""",
+)
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def duplicate_transactions_pending():
+    """Whether repeated (account_id, finapi_transaction_id) rows keep the unique index from being created."""
+    indexes = {index['name'] for index in inspect(db.session.connection()).get_indexes('bank_transaction')}
+    if _UNIQUE_INDEX in indexes:
+        return False
+    return db.session.execute(text(
+        "SELECT 1 FROM bank_transaction GROUP BY account_id, finapi_transaction_id HAVING count(*) > 1 LIMIT 1"
+    )).first() is not None
+
+
+def drop_duplicate_transactions():
+    """Delete repeated (account_id, finapi_transaction_id) rows, keeping the oldest.
+
+    Only needed once, on a database that predates the unique index; the
+    index is created afterwards. Returns the number of deleted rows.
+    """
+    if not duplicate_transactions_pending():
+        return 0
+    result = db.session.execute(text(
+        "DELETE FROM bank_transaction WHERE id NOT IN ("
+        "SELECT min(id) FROM bank_transaction GROUP BY account_id, finapi_transaction_id)"
+    ))
+    db.session.commit()
+    for index in BankTransaction.__table__.indexes:
+        if index.name == _UNIQUE_INDEX:
+            index.create(db.engine, checkfirst=True)
+    return result.rowcount
+
+
+def purpose_index_exists():
+    """Whether the purpose search index of the current database has been created."""
+    dialect = _dialect()
+    if dialect == 'sqlite':
+        name = 'bank_transaction_fts'
+        query = "SELECT 1 FROM sqlite_master WHERE name = :name"
+    elif dialect == 'postgresql':
+        name = 'ix_bank_transaction_purpose_trgm'
+        query = "SELECT 1 FROM pg_indexes WHERE indexname = :name"
+    else:
+        return True
+    return db.session.execute(text(query), {'name': name}).first() is not None
+
+
+def prepare_purpose_index():
+    """Create the SQLite purpose index at startup if that needs no indexing.
+
+    Only an empty bank_transaction table is indexed here; indexing stored
+    rows scans the whole table, so that is left to create-purpose-index.
+    Returns whether the index exists.
+    """
+    if purpose_index_exists():
+        return True
+    if _dialect() != 'sqlite' or db.session.execute(db.select(BankTransaction.id).limit(1)).first():
+        return False
+    create_purpose_index()
+    return True
+
+
+def create_purpose_index():
+    """Create the SQLite purpose search index and index every stored transaction.
+
+    The PostgreSQL index is created by create_trigram_index instead.
+    """
+    if _dialect() != 'sqlite':
+        return False
+    for statement in _SQLITE_DDL:
+        db.session.execute(text(statement))
+    # Indexes the rows stored before the table existed; safe to repeat
+    db.session.execute(text("INSERT INTO bank_transaction_fts (bank_transaction_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    return True
+
+
+def trigram_extension_installed():
+    """Whether pg_trgm is installed in the current PostgreSQL database."""
+    return _dialect() == 'postgresql' and db.session.execute(text(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+    )).first() is not None
+
+
+def create_trigram_index():
+    """Create the pg_trgm GIN purpose index on PostgreSQL.
+
+    Installs the extension first if needed, which requires a role allowed
+    to create extensions. Building the index locks bank_transaction against
+    writes until it is done.
+    """
+    if _dialect() != 'postgresql':
+        return False
+    if not trigram_extension_installed():
+        db.session.execute(text(_POSTGRES_EXTENSION_DDL))
+    db.session.execute(text(_POSTGRES_INDEX_DDL))
+    db.session.commit()
+    return True
+
+
+def transaction_page(account_ids, term=None, start_date=None, end_date=None, cursor=None,
+                     per_page=TRANSACTION_PAGE_SIZE):
+    """Return one page of transactions, newest first, and the cursor of the next page.
+
+    ``term`` is matched anywhere in the purpose, case-insensitively. The
+    cursor is the (booking_date, id) of the last row shown, so a page is a
+    range scan on ix_bank_transaction_account_booking however deep it is.
+    Raises ValueError for a malformed cursor.
+    """
+    if not account_ids:
+        return [], None
+    order = (BankTransaction.booking_date.desc(), BankTransaction.id.desc())
+    filters = _page_bounds(start_date, end_date, cursor)
+    selective = False
+    if term:
+        condition, selective = _purpose_filter(term)
+        filters.append(condition)
+
+    if selective or len(account_ids) == 1:
+        query = db.select(BankTransaction).where(BankTransaction.account_id.in_(account_ids), *filters)
+    else:
+        # Read each account's index range in order and merge the first
+        # rows of each, instead of sorting every row of every account
+        per_account = [
+            db.select(BankTransaction.id, BankTransaction.booking_date)
+            .where(BankTransaction.account_id == account_id, *filters)
+            .order_by(*order).limit(per_page + 1).subquery()
+            for account_id in account_ids
+        ]
+        merged = union_all(*[db.select(subquery) for subquery in per_account]).subquery()
+        query = db.select(BankTransaction).where(BankTransaction.id.in_(
+            db.select(merged.c.id).order_by(merged.c.booking_date.desc(), merged.c.id.desc()).limit(per_page + 1)
+        ))
+
+    transactions = db.session.execute(query.order_by(*order).limit(per_page + 1)).scalars().all()
+    if len(transactions) <= per_page:
+        return transactions, None
+    transactions = transactions[:per_page]
+    last = transactions[-1]
+    return transactions, f"{last.booking_date.isoformat()}|{last.id}"
+
+
+def _page_bounds(start_date, end_date, cursor):
+    bounds = []
+    if start_date:
+        bounds.append(BankTransaction.booking_date >= start_date)
+    if end_date:
+        # booking_date is a DateTime: include the whole end day
+        bounds.append(BankTransaction.booking_date < end_date + timedelta(days=1))
+    if cursor:
+        booking_date, _, transaction_id = cursor.rpartition("|")
+        bounds.append(
+            tuple_(BankTransaction.booking_date, BankTransaction.id)
+            < (datetime.fromisoformat(booking_date), int(transaction_id))
+        )
+    return bounds
+
+
+def _purpose_filter(term):
+    # Returns (condition, selective). A selective condition is cheap to
+    # evaluate first and sort; otherwise rows are filtered while reading
+    # the account/date index in order, which finds a page of a common term
+    # quickly.
+    pattern = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    substring = BankTransaction.purpose.ilike(f"%{pattern}%", escape='\\')
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        # The planner weighs the trigram index against the date index itself
+        return substring, True
+    if dialect != 'sqlite' or len(term) < TRIGRAM_MIN_LENGTH or not purpose_index_exists():
+        return substring, False
+
+    # A quoted phrase is a plain substring match for the trigram tokenizer.
+    # FTS5 returns matches in rowid order, so counting up to the limit
+    # stays cheap for terms that match millions of rows.
+    match = text("bank_transaction_fts MATCH :purpose_query").bindparams(
+        purpose_query='"{}"'.format(term.replace('"', '""'))
+    )
+    matches = db.select(text("rowid")).select_from(text("bank_transaction_fts")).where(match)
+    count = db.session.execute(
+        db.select(func.count()).select_from(matches.limit(FTS_SELECTIVE_LIMIT + 1).subquery())
+    ).scalar_one()
+    if count > FTS_SELECTIVE_LIMIT:
+        return substring, False
+    return BankTransaction.id.in_(matches), True
+
+
+@click.command("drop-duplicate-transactions")
+@with_appcontext
+def drop_duplicate_transactions_command():
+    """Delete repeated bank transactions so the unique index can be created."""
+    click.echo(f"Deleted {drop_duplicate_transactions()} duplicate transactions")
+
+
+@click.command("create-purpose-index")
+@with_appcontext
+def create_purpose_index_command():
+    """Create the index for bank transaction purpose search."""
+    if _dialect() == 'sqlite':
+        create_purpose_index()
+        click.echo("Indexed the purpose of every stored transaction")
+        return
+    if _dialect() != 'postgresql':
+        click.echo("Purpose search has no index on this database")
+        return
+    available = db.session.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).first()
+    if available is None:
+        click.echo("pg_trgm is not available on this server; install the PostgreSQL contrib package")
+        return
+    create_trigram_index()
+    click.echo("Created ix_bank_transaction_purpose_trgm")
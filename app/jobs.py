@@ -0,0 +1,244 @@
+# app/jobs.py
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from app.models import SyncJob
+from app.database import db
+from app.google_ads.google_ads_handler import GoogleAdsHandler
+from app.bank_handler import BankHandler
+from app.mail.email_handler import EmailHandler
+from app.helpers.bank_purge import purge_next_chunk
+
+ACTIVE_STATUSES = ("queued", "running")
+# Error recorded on a job whose worker stopped sending heartbeats on its last attempt
+LEASE_EXPIRED_ERROR = "The worker running this job stopped responding"
+
+logger = logging.getLogger(__name__)
+
+
+class SyncError(Exception):
+    """Raised by run_sync when a source reported errors; carries the results of every source."""
+
+    def __init__(self, errors, results):
+        super().__init__("; ".join(errors))
+        self.results = results
+
+
+def enqueue_sync(agency_id):
+    """Queue a sync for an agency, reusing its queued or running job if any.
+
+    uq_sync_job_agency_type_active allows one active job per agency, so of
+    two requests that both miss the lookup only one insert succeeds; the
+    other returns the job that won.
+    """
+    existing_job = _active_job(agency_id)
+    if existing_job:
+        return existing_job
+
+    job = SyncJob(agency_id=agency_id)
+    try:
+        with db.session.begin_nested():
+            db.session.add(job)
+    except IntegrityError:
+        return _active_job(agency_id)
+    db.session.commit()
+    return job
+
+
+def _active_job(agency_id):
+    return db.session.execute(
+        db.select(SyncJob).where(
+            SyncJob.agency_id == agency_id,
+            SyncJob.status.in_(ACTIVE_STATUSES)
+        ).order_by(SyncJob.id.desc())
+    ).scalars().first()
+
+
+def duplicate_active_jobs():
+    """Whether an agency has several active jobs of one type, as a database from before the unique index can."""
+    return db.session.execute(
+        db.select(SyncJob.agency_id)
+        .where(SyncJob.status.in_(ACTIVE_STATUSES))
+        .group_by(SyncJob.agency_id, SyncJob.job_type)
+        .having(db.func.count() > 1).limit(1)
+    ).first() is not None
+
+
+def add_heartbeat_column():
+    """Add sync_job.heartbeat_at to a database created before it existed."""
+    columns = {column['name'] for column in inspect(db.session.connection()).get_columns('sync_job')}
+    if 'heartbeat_at' not in columns:
+        db.session.execute(text("ALTER TABLE sync_job ADD COLUMN heartbeat_at TIMESTAMP"))
+        db.session.commit()
+
+
+def get_latest_job(agency_id):
+    return db.session.execute(
+        db.select(SyncJob).filter_by(agency_id=agency_id).order_by(SyncJob.id.desc())
+    ).scalars().first()
+
+
+def claim_next_job():
+    """Atomically move the next due job to "running" and return it.
+
+    Claiming is a conditional UPDATE on the job's current state, so several
+    workers can poll the same table (SQLite or PostgreSQL) without running a
+    job twice. A running job whose heartbeat is older than
+    SYNC_JOB_LEASE_SECONDS lost its worker (e.g. to a crash): it is claimed
+    again if attempts remain and marked failed otherwise.
+    """
+    now = datetime.utcnow()
+    lease_expired = now - timedelta(seconds=current_app.config.get('SYNC_JOB_LEASE_SECONDS', 300))
+    abandoned = (
+        (SyncJob.status == "running")
+        & (db.func.coalesce(SyncJob.heartbeat_at, SyncJob.started_at) < lease_expired)
+    )
+    db.session.execute(
+        db.update(SyncJob)
+        .where(abandoned, SyncJob.attempts >= SyncJob.max_attempts)
+        .values(status="failed", finished_at=now, error=LEASE_EXPIRED_ERROR)
+    )
+    db.session.commit()
+
+    due = (SyncJob.status == "queued") & (SyncJob.run_after <= now)
+    candidates = db.session.execute(
+        db.select(SyncJob.id, SyncJob.status).where(
+            due | (abandoned & (SyncJob.attempts < SyncJob.max_attempts))
+        ).order_by(SyncJob.run_after, SyncJob.id).limit(10)
+    ).all()
+
+    for job_id, status in candidates:
+        # Repeats the candidate's condition: of two workers re-claiming the
+        # same abandoned job, only the first finds its heartbeat still stale
+        claimed = db.session.execute(
+            db.update(SyncJob)
+            .where(SyncJob.id == job_id, due if status == "queued" else abandoned)
+            .values(status="running", started_at=now, heartbeat_at=now, attempts=SyncJob.attempts + 1)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(SyncJob, job_id, populate_existing=True)
+    return None
+
+
+def run_job(job):
+    """Run a claimed job and record success, a retry with backoff, or failure."""
+    try:
+        with _heartbeat(job.id):
+            result = run_sync(job.agency_id)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Sync job {job.id} for agency {job.agency_id} failed: {str(e)}")
+        job.error = str(e)
+        if isinstance(e, SyncError):
+            job.result = json.dumps(e.results, default=str)
+        if job.attempts < job.max_attempts:
+            backoff = current_app.config.get('SYNC_JOB_BACKOFF_SECONDS', 60) * 2 ** (job.attempts - 1)
+            job.status = "queued"
+            job.run_after = datetime.utcnow() + timedelta(seconds=backoff)
+        else:
+            job.status = "failed"
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+        return job
+
+    job.status = "succeeded"
+    job.error = None
+    job.result = json.dumps(result, default=str)
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+@contextmanager
+def _heartbeat(job_id):
+    """Refresh a running job's heartbeat_at from a background thread.
+
+    The thread uses its own connection, so the beat is not held back by the
+    sync's open transaction. A failed beat (e.g. SQLite busy) is logged and
+    tried again at the next interval.
+    """
+    interval = current_app.config.get('SYNC_JOB_HEARTBEAT_SECONDS', 30)
+    engine = db.engine
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(interval):
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        db.update(SyncJob)
+                        .where(SyncJob.id == job_id, SyncJob.status == "running")
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+            except OperationalError as e:
+                logger.warning(f"Heartbeat of sync job {job_id} failed: {str(e)}")
+
+    thread = threading.Thread(target=beat, name=f"sync-job-{job_id}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_sync(agency_id):
+    """The work formerly done inline by /sync-data.
+
+    The handlers catch the errors of single accounts and report them in
+    their results; if any did, SyncError is raised so the job is retried
+    (or failed) instead of recorded as succeeded. Accounts that synced
+    are already stored and are synced again on the retry.
+    """
+    results = {
+        'google_ads': GoogleAdsHandler().sync_campaigns(agency_id),
+        'bank': BankHandler().sync_transactions(agency_id),
+        'mail': EmailHandler().sync_emails(agency_id),
+    }
+    # Mail results list their errors, the others carry a single error
+    errors = [
+        f"{source}: {error}"
+        for source, source_results in results.items()
+        for result in source_results
+        for error in result.get('errors', [result.get('error')])
+        if error
+    ]
+    if errors:
+        raise SyncError(errors, results)
+    return results
+
+
+def work(poll_interval=5, once=False):
+    while True:
+        job = claim_next_job()
+        if job:
+            logger.info(f"Running sync job {job.id} for agency {job.agency_id} (attempt {job.attempts})")
+            run_job(job)
+            continue
+        # Deleted bank connections are purged in chunks while the queue is idle
+        if purge_next_chunk():
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+@click.command("sync-worker")
+@click.option("--poll-interval", default=5, show_default=True, help="Seconds to wait when the queue is empty.")
+@click.option("--once", is_flag=True, help="Exit once the queue is empty.")
+@with_appcontext
+def sync_worker_command(poll_interval, once):
+    """Process queued /sync-data jobs."""
+    work(poll_interval=poll_interval, once=once)
@@ -0,0 +1,160 @@
+# app/mail/attachment_cache.py
+
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+from flask import current_app
+from sqlalchemy import inspect, text
+
+from app.database import db
+
+_ATTACHMENT_COLUMNS = (
+    ('part_number', "VARCHAR(50) NOT NULL DEFAULT ''"),
+    ('size', 'INTEGER NOT NULL DEFAULT 0'),
+    ('encoding', 'VARCHAR(50)'),
+    ('content_hash', 'VARCHAR(64)'),
+)
+
+
+class AttachmentCache:
+    """Content-addressed on-disk store for downloaded attachments.
+
+    Files live at ``<directory>/<sha[:2]>/<sha>``. Reads bump the file's
+    mtime, and once the cache grows past ``max_bytes`` the least recently
+    used files are removed. The file just written is never evicted, so a
+    single attachment larger than ``max_bytes`` can still be served.
+
+    The directory is scanned once, into an index ordered by mtime that
+    reads and writes then keep up to date with a running total, so a
+    write only removes files when the total is over the cap. The index
+    belongs to one process: files another process writes are added when
+    read, and files it removes are dropped when found missing.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # path -> size, least recently used first; None until first used
+        self._entries = None
+        self._total = 0
+
+    def path(self, content_hash):
+        return os.path.join(self.directory, content_hash[:2], content_hash)
+
+    def get(self, content_hash):
+        """Return the path of a cached file, or None if it is not cached."""
+        if not content_hash:
+            return None
+        path = self.path(content_hash)
+        try:
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            with self._lock:
+                if self._entries is not None and path in self._entries:
+                    self._total -= self._entries.pop(path)
+            return None
+        with self._lock:
+            self._add(path, size)
+        return path
+
+    def put(self, chunks):
+        """Write an iterable of byte chunks to the cache and return its sha256."""
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+                    size += len(chunk)
+            content_hash = digest.hexdigest()
+            path = self.path(content_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._add(path, size)
+            if self._total > self.max_bytes:
+                self._evict(keep=path)
+        return content_hash
+
+    def _load(self):
+        # Called with the lock held
+        if self._entries is not None:
+            return
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+        self._entries = OrderedDict((path, size) for _, path, size in sorted(found))
+        self._total = sum(self._entries.values())
+
+    def _add(self, path, size):
+        # Called with the lock held; makes path the most recently used entry
+        self._load()
+        self._total += size - self._entries.pop(path, 0)
+        self._entries[path] = size
+
+    def _evict(self, keep):
+        # Called with the lock held; removes least recently used files first
+        while self._total > self.max_bytes:
+            path, size = next(iter(self._entries.items()))
+            if path == keep:
+                break
+            del self._entries[path]
+            self._total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def get_attachment_cache():
+    """Return the AttachmentCache configured for the current app."""
+    cache = current_app.extensions.get('attachment_cache')
+    if cache is None:
+        cache = current_app.extensions['attachment_cache'] = AttachmentCache(
+            current_app.config['ATTACHMENT_CACHE_DIR'],
+            current_app.config['ATTACHMENT_CACHE_MAX_BYTES']
+        )
+    return cache
+
+
+def add_attachment_columns():
+    """Bring an attachment table created before the disk cache up to date.
+
+    Adds the part columns and drops the old ``data BLOB NOT NULL`` column,
+    which would reject every new row. The sync before it never stored
+    attachments, so the column holds nothing worth keeping. Returns the
+    names of the columns that changed.
+    """
+    columns = {column['name'] for column in inspect(db.session.connection()).get_columns('attachment')}
+    changed = []
+    for column, definition in _ATTACHMENT_COLUMNS:
+        if column not in columns:
+            db.session.execute(text(f"ALTER TABLE attachment ADD COLUMN {column} {definition}"))
+            changed.append(column)
+    if 'data' in columns:
+        # SQLite supports DROP COLUMN since 3.35
+        db.session.execute(text("ALTER TABLE attachment DROP COLUMN data"))
+        changed.append('data')
+    db.session.commit()
+    return changed
@@ -0,0 +1,97 @@
+# app/mail/body_migration.py
+
+import logging
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+
+from app.models import EmailBody
+from app.database import db
+from app.mail.search import reset_search_index
+
+MIGRATION_BATCH_SIZE = 2000
+
+logger = logging.getLogger(__name__)
+
+
+def add_body_column():
+    """Add email.body_id to a database created before email_body existed.
+
+    Cheap enough to run at startup, so the ORM can query Email before
+    migrate_email_bodies has moved the old content over. The old NOT NULL
+    content column is relaxed on PostgreSQL and dropped from an empty
+    SQLite table; a SQLite table with emails keeps it, and mail sync
+    refuses to run (see body_migration_pending) until the migration has.
+    """
+    columns = {column['name'] for column in inspect(db.session.connection()).get_columns('email')}
+    if 'body_id' not in columns:
+        db.session.execute(text("ALTER TABLE email ADD COLUMN body_id INTEGER REFERENCES email_body (id)"))
+    if 'content' in columns:
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # New emails leave content empty until migrate_email_bodies drops it
+            db.session.execute(text("ALTER TABLE email ALTER COLUMN content DROP NOT NULL"))
+        elif not db.session.execute(text("SELECT 1 FROM email LIMIT 1")).first():
+            # Nothing to migrate; SQLite cannot relax NOT NULL, so drop the column
+            db.session.execute(text("ALTER TABLE email DROP COLUMN content"))
+            columns.discard('content')
+    db.session.commit()
+    return columns
+
+
+def body_migration_pending():
+    """Whether email still has the old NOT NULL content column, which rejects new rows."""
+    return any(
+        column['name'] == 'content' and not column['nullable']
+        for column in inspect(db.session.connection()).get_columns('email')
+    )
+
+
+def migrate_email_bodies(batch_size=MIGRATION_BATCH_SIZE, vacuum=False):
+    """Move email.content of an existing database into email_body.
+
+    Safe to run repeatedly: every email without a body is linked to one,
+    the old content column is dropped and the search index is rebuilt
+    from the new bodies. Returns the number of emails migrated.
+    """
+    if 'content' not in add_body_column():
+        return 0
+
+    migrated = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(text(
+            "SELECT id, content FROM email WHERE body_id IS NULL AND id > :last_id ORDER BY id LIMIT :limit"
+        ), {'last_id': last_id, 'limit': batch_size}).all()
+        if not rows:
+            break
+        bodies = EmailBody.for_texts(content or '' for _, content in rows)
+        db.session.flush()
+        db.session.execute(
+            text("UPDATE email SET body_id = :body_id WHERE id = :id"),
+            [{'id': email_id, 'body_id': bodies[content or ''].id} for email_id, content in rows]
+        )
+        db.session.commit()
+        db.session.expunge_all()
+        last_id = rows[-1][0]
+        migrated += len(rows)
+        logger.info(f"Migrated {migrated} email bodies")
+
+    db.session.execute(text("ALTER TABLE email DROP COLUMN content"))
+    db.session.commit()
+    reset_search_index()
+
+    if vacuum and db.engine.dialect.name == 'sqlite':
+        # SQLite only returns freed pages to the filesystem on VACUUM
+        with db.engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    return migrated
+
+
+@click.command("migrate-email-bodies")
+@click.option("--batch-size", default=MIGRATION_BATCH_SIZE, show_default=True)
+@click.option("--vacuum", is_flag=True, help="Compact the SQLite database file afterwards.")
+@with_appcontext
+def migrate_email_bodies_command(batch_size, vacuum):
+    """Move Email.content into the compressed, deduplicated email_body table."""
+    click.echo(f"Migrated {migrate_email_bodies(batch_size, vacuum)} emails")
@@ -2,73 +2,326 @@
 
 import imaplib
 import email
+import hashlib
 from email.header import decode_header
-from app.models import MailUser, Email
+from app.models import MailUser, Email, EmailBody, Attachment
 from app.database import db
+from app.mail.imap_utils import (
+    uid_set, parse_fetch_response, find_text_parts, find_attachments, iter_message_parts,
+    decode_part, decode_header_value, decode_transfer_stream
+)
+from app.mail.search import index_emails
+from app.mail.body_migration import body_migration_pending
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import OperationalError
 from datetime import datetime
 from flask import current_app
 import logging
+import threading
+import time
 
 class EmailHandler:
-    def __init__(self):
+    # Number of messages requested per UID FETCH and stored per commit
+    FETCH_BATCH_SIZE = 500
+    HEADER_FIELDS = "MESSAGE-ID SUBJECT FROM TO DATE"
+    # Bytes requested per partial FETCH when downloading an attachment
+    ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+    # "batched" pulls headers and BODYSTRUCTURE first and then only the
+    # text/plain parts of new messages; "full" downloads whole RFC822 messages
+    FETCH_MODES = ("batched", "full")
+    # Simultaneous IMAP connections per host across the sync workers of
+    # one process; other processes syncing the same host are not counted
+    SERVER_CONNECTION_LIMITS = {
+        "imap.gmail.com": 10,
+        "imap-mail.outlook.com": 8,
+        "secureimap.t-online.de": 3
+    }
+    DEFAULT_SERVER_CONNECTION_LIMIT = 2
+    # Times a batch is stored again when SQLite finds the database locked,
+    # and the seconds waited before the first retry (growing per retry)
+    LOCKED_RETRIES = 3
+    LOCKED_RETRY_DELAY = 1.0
+
+    _server_semaphores = {}
+    _server_semaphores_lock = threading.Lock()
+
+    def __init__(self, fetch_mode="batched"):
+        if fetch_mode not in self.FETCH_MODES:
+            raise ValueError(f"Unknown fetch mode: {fetch_mode}")
+        self.fetch_mode = fetch_mode
         self.logger = logging.getLogger(__name__)
 
-    def sync_emails(self, agency_id):
-        mail_users = MailUser.query.filter_by(agency_id=agency_id).all()
-        for mail_user in mail_users:
-            try:
-                self._fetch_emails(mail_user)
-            except Exception as e:
-                self.logger.error(f"Error syncing emails for user {mail_user.id}: {str(e)}")
+    def sync_emails(self, agency_id, max_workers=None):
+        """Sync every MailUser of an agency concurrently.
+
+        Each account runs in its own worker thread with its own app context,
+        and therefore its own DB session. Connections to the same IMAP host
+        are capped by SERVER_CONNECTION_LIMITS within this process. Returns
+        one result dict per account with fetched/new counts, errors and
+        duration.
+        """
+        app = current_app._get_current_object()
+        max_workers = max_workers or app.config.get('MAIL_SYNC_WORKERS', 4)
+        mail_user_ids = db.session.execute(
+            db.select(MailUser.id).filter_by(agency_id=agency_id)
+        ).scalars().all()
+        if not mail_user_ids:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(mail_user_ids))) as executor:
+            futures = [executor.submit(self._sync_account, app, mail_user_id) for mail_user_id in mail_user_ids]
+            return [future.result() for future in futures]
+
+    def _sync_account(self, app, mail_user_id):
+        started = time.perf_counter()
+        result = {'mail_user_id': mail_user_id, 'email': None, 'fetched': 0, 'new': 0, 'errors': [], 'duration': 0.0}
+        # A fresh app context gives this worker its own scoped DB session
+        with app.app_context():
+            mail_user = db.session.get(MailUser, mail_user_id)
+            if mail_user is None:
+                result['errors'].append("Mail user not found")
+            else:
+                result['email'] = mail_user.email
+                try:
+                    with self._server_slot(self._get_imap_server(mail_user.domain)):
+                        result['fetched'], result['new'] = self._fetch_emails(mail_user)
+                except Exception as e:
+                    self.logger.error(f"Error syncing emails for user {mail_user.id}: {str(e)}")
+                    result['errors'].append(str(e))
+        result['duration'] = time.perf_counter() - started
+        return result
+
+    @classmethod
+    def _server_slot(cls, imap_server):
+        with cls._server_semaphores_lock:
+            semaphore = cls._server_semaphores.get(imap_server)
+            if semaphore is None:
+                limit = cls.SERVER_CONNECTION_LIMITS.get(imap_server, cls.DEFAULT_SERVER_CONNECTION_LIMIT)
+                semaphore = cls._server_semaphores[imap_server] = threading.BoundedSemaphore(limit)
+        return semaphore
 
     def _fetch_emails(self, mail_user):
+        """Fetch new messages for one account; returns (fetched, new)."""
         imap_server = self._get_imap_server(mail_user.domain)
         if not imap_server:
             self.logger.error(f"Unsupported email domain for user: {mail_user.email}")
-            return
+            return 0, 0
+        if body_migration_pending():
+            raise RuntimeError("Email bodies are not migrated yet, run 'flask migrate-email-bodies' first")
 
+        fetched = 0
+        new = 0
         try:
-            with imaplib.IMAP4_SSL(imap_server) as imap:
+            with self._connect(imap_server) as imap:
                 imap.login(mail_user.email, mail_user.password)
-                imap.select(mail_user.folder)
-                _, message_numbers = imap.search(None, 'ALL')
-                
-                for num in message_numbers[0].split():
-                    _, msg_data = imap.fetch(num, '(RFC822)')
-                    email_body = msg_data[0][1]
-                    email_message = email.message_from_bytes(email_body)
-
-                    subject = self._decode_header(email_message['subject'])
-                    sender = self._decode_header(email_message['from'])
-                    recipient = self._decode_header(email_message['to'])
-                    date = self._parse_date(email_message['date'])
-                    content = self._get_email_content(email_message)
-
-                    existing_email = Email.query.filter_by(
-                        subject=subject,
-                        sender=sender,
-                        recipient=recipient,
-                        date=date,
-                        mail_user_id=mail_user.id
-                    ).first()
-
-                    if not existing_email:
-                        new_email = Email(
-                            subject=subject,
-                            sender=sender,
-                            recipient=recipient,
-                            date=date,
-                            content=content,
-                            mail_user_id=mail_user.id
-                        )
-                        db.session.add(new_email)
+                imap.select(mail_user.folder, readonly=True)
+
+                uid_validity = self._get_uid_validity(imap)
+                if uid_validity != mail_user.uid_validity:
+                    self._commit_retrying(lambda: self._reset_uids(mail_user, uid_validity))
+                last_uid = mail_user.last_uid or 0
+
+                _, data = imap.uid('search', None, f'UID {last_uid + 1}:*')
+                # "n:*" always matches the newest message, even when its UID is below n
+                uids = sorted(int(uid) for uid in data[0].split() if int(uid) > last_uid)
 
+                for start in range(0, len(uids), self.FETCH_BATCH_SIZE):
+                    chunk = uids[start:start + self.FETCH_BATCH_SIZE]
+                    new += self._commit_retrying(lambda: self._store_chunk(imap, mail_user, chunk))
+                    fetched += len(chunk)
+
+                # Every message of the folder has now been through _claim_legacy_emails
+                mail_user.legacy_emails_claimed = True
                 db.session.commit()
 
         except Exception as e:
+            db.session.rollback()
             self.logger.error(f"Error fetching emails for {mail_user.email}: {str(e)}")
             raise
 
+        return fetched, new
+
+    def _reset_uids(self, mail_user, uid_validity):
+        # UIDs of a previous UIDVALIDITY are meaningless, rescan the folder
+        mail_user.uid_validity = uid_validity
+        mail_user.last_uid = 0
+
+    def _store_chunk(self, imap, mail_user, chunk):
+        """Fetch and add the new messages among chunk; returns how many were new."""
+        if self.fetch_mode == "full":
+            new_emails = self._sync_full(imap, mail_user, chunk)
+        else:
+            new_emails = self._sync_batched(imap, mail_user, chunk)
+        db.session.flush()
+        index_emails(new_emails)
+        mail_user.last_uid = chunk[-1]
+        return len(new_emails)
+
+    def _commit_retrying(self, store):
+        """Run store() and commit, running both again while SQLite reports the database locked.
+
+        Account workers commit to the same SQLite file from several threads.
+        The busy timeout lets a writer wait for the others, but a transaction
+        that read before another thread committed fails at once; it is
+        rolled back and stored again after a pause.
+        """
+        for attempt in range(self.LOCKED_RETRIES + 1):
+            try:
+                result = store()
+                db.session.commit()
+                return result
+            except OperationalError as e:
+                if 'database is locked' not in str(e) or attempt == self.LOCKED_RETRIES:
+                    raise
+                db.session.rollback()
+                self.logger.warning(f"Database locked, storing the batch again (attempt {attempt + 2})")
+                time.sleep(self.LOCKED_RETRY_DELAY * (attempt + 1))
+
+    def _sync_full(self, imap, mail_user, uids):
+        _, data = imap.uid('fetch', uid_set(uids), '(UID RFC822)')
+        messages = {
+            uid: email.message_from_bytes(items['RFC822'])
+            for uid, items in parse_fetch_response(data).items()
+        }
+        new_messages = self._new_messages(mail_user, messages)
+        contents = {uid: self._get_email_content(email_message) for uid, email_message in new_messages.items()}
+        bodies = EmailBody.for_texts(contents.values())
+        return [
+            self._add_email(
+                mail_user, uid, email_message, bodies[contents[uid]],
+                self._get_message_attachments(email_message)
+            )
+            for uid, email_message in new_messages.items()
+        ]
+
+    def _sync_batched(self, imap, mail_user, uids):
+        # First pass: headers and structure only, no bodies or attachments
+        _, data = imap.uid(
+            'fetch', uid_set(uids), f'(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({self.HEADER_FIELDS})])'
+        )
+        headers = {}
+        text_parts = {}
+        attachments = {}
+        for uid, items in parse_fetch_response(data).items():
+            header = next(value for name, value in items.items() if name.startswith('BODY[HEADER'))
+            headers[uid] = email.message_from_bytes(header or b'')
+            text_parts[uid] = find_text_parts(items['BODYSTRUCTURE'])
+            attachments[uid] = find_attachments(items['BODYSTRUCTURE'])
+
+        new_messages = self._new_messages(mail_user, headers)
+
+        # Second pass: fetch the text/plain parts of new messages, one
+        # request per distinct part layout
+        layouts = {}
+        for uid in new_messages:
+            layouts.setdefault(tuple(text_parts[uid]), []).append(uid)
+        contents = {}
+        for parts, layout_uids in layouts.items():
+            if not parts:
+                continue
+            sections = ' '.join(f'BODY.PEEK[{number}]' for number, _, _ in parts)
+            _, data = imap.uid('fetch', uid_set(sorted(layout_uids)), f'(UID {sections})')
+            for uid, items in parse_fetch_response(data).items():
+                contents[uid] = ''.join(
+                    decode_part(items.get(f'BODY[{number}]') or b'', encoding, charset)
+                    for number, encoding, charset in parts
+                )
+
+        bodies = EmailBody.for_texts(contents.get(uid, '') for uid in new_messages)
+        return [
+            self._add_email(mail_user, uid, header, bodies[contents.get(uid, '')], attachments[uid])
+            for uid, header in new_messages.items()
+        ]
+
+    def _new_messages(self, mail_user, messages):
+        """Drop messages already stored for this user, keyed by Message-ID."""
+        keyed = {}
+        for uid, email_message in messages.items():
+            keyed.setdefault(self._message_key(email_message), uid)
+
+        existing_ids = set(db.session.execute(
+            db.select(Email.message_id).where(
+                Email.mail_user_id == mail_user.id,
+                Email.message_id.in_(keyed.keys())
+            )
+        ).scalars())
+
+        new_messages = {
+            uid: messages[uid]
+            for message_id, uid in keyed.items()
+            if message_id not in existing_ids
+        }
+        return self._claim_legacy_emails(mail_user, new_messages)
+
+    def _claim_legacy_emails(self, mail_user, messages):
+        """Link messages to emails stored before Message-IDs were recorded.
+
+        Such emails have no message_id, so they are matched on the headers
+        the old sync compared and get their message_id and uid filled in
+        instead of being stored a second time. Returns the messages that
+        are still new. Skipped once a sync has covered the whole folder:
+        legacy emails left then belong to no message on the server, and
+        would otherwise cost a lookup per message on every sync.
+        """
+        if mail_user.legacy_emails_claimed:
+            return messages
+        has_legacy = db.session.execute(
+            db.select(Email.id).where(Email.mail_user_id == mail_user.id, Email.message_id.is_(None)).limit(1)
+        ).first()
+        if not has_legacy:
+            return messages
+
+        remaining = {}
+        for uid, email_message in messages.items():
+            legacy_email = db.session.execute(
+                db.select(Email).where(
+                    Email.mail_user_id == mail_user.id,
+                    Email.message_id.is_(None),
+                    Email.subject == self._decode_header(email_message['subject']),
+                    Email.sender == self._decode_header(email_message['from']),
+                    Email.recipient == self._decode_header(email_message['to']),
+                    Email.date == self._parse_date(email_message['date'])
+                ).limit(1)
+            ).scalar()
+            if legacy_email is None:
+                remaining[uid] = email_message
+            else:
+                legacy_email.message_id = self._message_key(email_message)
+                legacy_email.uid = uid
+        return remaining
+
+    def _add_email(self, mail_user, uid, email_message, body, attachments=()):
+        new_email = Email(
+            subject=self._decode_header(email_message['subject']),
+            sender=self._decode_header(email_message['from']),
+            recipient=self._decode_header(email_message['to']),
+            date=self._parse_date(email_message['date']),
+            mail_user_id=mail_user.id,
+            mail_user=mail_user,
+            message_id=self._message_key(email_message),
+            uid=uid,
+            attachments=[Attachment(**attachment) for attachment in attachments],
+            body=body
+        )
+        db.session.add(new_email)
+        return new_email
+
+    def _message_key(self, email_message):
+        message_id = (email_message['message-id'] or '').strip()
+        if message_id:
+            return message_id[:255]
+        # No Message-ID: fall back to a digest of the headers the old dedup compared
+        headers = '\n'.join(str(email_message[name] or '') for name in ('subject', 'from', 'to', 'date'))
+        return f"<{hashlib.sha1(headers.encode('utf-8', 'replace')).hexdigest()}@no-message-id>"
+
+    def _connect(self, imap_server):
+        return imaplib.IMAP4_SSL(imap_server)
+
+    def _get_uid_validity(self, imap):
+        # SELECT always returns UIDVALIDITY as an untagged response
+        _, data = imap.response('UIDVALIDITY')
+        return int(data[0]) if data and data[0] else None
+
     def _get_imap_server(self, domain):
         imap_servers = {
             "gmail.com": "imap.gmail.com",
@@ -106,6 +359,22 @@ class EmailHandler:
                 self.logger.error(f"Error decoding email content: {str(e)}")
         return content
 
+    def _get_message_attachments(self, email_message):
+        attachments = []
+        for number, part in iter_message_parts(email_message):
+            filename = part.get_filename()
+            if not filename:
+                continue
+            payload = part.get_payload()
+            attachments.append({
+                'part_number': number,
+                'filename': decode_header_value(filename),
+                'content_type': part.get_content_type(),
+                'size': len(payload) if isinstance(payload, str) else 0,
+                'encoding': part.get('Content-Transfer-Encoding', '7bit').strip().lower()
+            })
+        return attachments
+
     def check_email_connection(self, email, password, server):
         imap_server = self._get_imap_server(server)
         if not imap_server:
@@ -122,32 +391,43 @@ class EmailHandler:
             self.logger.error(f"Error checking email connection for {email}: {str(e)}")
             return False, "Unable to connect to email server"
 
-    def get_email_attachments(self, mail_user_id, email_id):
-        mail_user = MailUser.query.get(mail_user_id)
-        if not mail_user:
+    def fetch_attachment(self, email_record, attachment, cache):
+        """Download one attachment part into the cache and return its content hash.
+
+        Only the attachment's body section is fetched, ATTACHMENT_CHUNK_SIZE
+        bytes at a time, and decoded while it is written to disk.
+        """
+        mail_user = email_record.mail_user
+        if email_record.uid is None:
+            # Synced before UIDs were recorded, the message cannot be addressed
             return None
 
         try:
-            with imaplib.IMAP4_SSL(self._get_imap_server(mail_user.domain)) as imap:
+            with self._connect(self._get_imap_server(mail_user.domain)) as imap:
                 imap.login(mail_user.email, mail_user.password)
-                imap.select(mail_user.folder)
-                _, msg_data = imap.fetch(str(email_id), '(RFC822)')
-                email_body = msg_data[0][1]
-                email_message = email.message_from_bytes(email_body)
-
-                attachments = []
-                for part in email_message.walk():
-                    if part.get_content_maintype() == 'multipart':
-                        continue
-                    if part.get('Content-Disposition') is None:
-                        continue
-                    filename = part.get_filename()
-                    if filename:
-                        attachments.append({
-                            'filename': filename,
-                            'content': part.get_payload(decode=True)
-                        })
-                return attachments
+                imap.select(mail_user.folder, readonly=True)
+                if self._get_uid_validity(imap) != mail_user.uid_validity:
+                    self.logger.warning(f"UIDVALIDITY changed for {mail_user.email}, attachment UIDs are stale")
+                    return None
+
+                chunks = self._iter_part_chunks(imap, email_record.uid, attachment.part_number)
+                return cache.put(decode_transfer_stream(chunks, attachment.encoding))
         except Exception as e:
-            self.logger.error(f"Error fetching email attachments for user {mail_user_id}, email {email_id}: {str(e)}")
+            self.logger.error(f"Error fetching attachment {attachment.id} of email {email_record.id}: {str(e)}")
             return None
+
+    def _iter_part_chunks(self, imap, uid, part_number):
+        section = f'BODY[{part_number}]'
+        offset = 0
+        while True:
+            _, data = imap.uid(
+                'fetch', str(uid), f'(UID BODY.PEEK[{part_number}]<{offset}.{self.ATTACHMENT_CHUNK_SIZE}>)'
+            )
+            items = parse_fetch_response(data).get(uid)
+            if items is None:
+                raise ValueError(f"Message {uid} not found")
+            chunk = next((value for name, value in items.items() if name.startswith(section)), None) or b''
+            yield chunk
+            if len(chunk) < self.ATTACHMENT_CHUNK_SIZE:
+                return
+            offset += len(chunk)
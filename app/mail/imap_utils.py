@@ -0,0 +1,223 @@
+# app/mail/imap_utils.py
+
+import base64
+import quopri
+import re
+from email.header import decode_header, make_header
+
+_LITERAL = re.compile(rb'\{(\d+)\}$')
+
+
+def uid_set(uids):
+    """Compress sorted UIDs into an IMAP sequence set, e.g. "1:500,502"."""
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+def parse_fetch_response(data):
+    """Parse imaplib FETCH output into {uid: {item_name: value}}.
+
+    Item names are upper-cased strings such as "UID", "BODYSTRUCTURE" or
+    "BODY[1.2]". Literals come back as bytes, parenthesized values as
+    nested lists and NIL as None.
+    """
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            tokens.extend(_tokenize(_LITERAL.sub(b'', prefix.rstrip())))
+            tokens.append(literal)
+        elif item:
+            tokens.extend(_tokenize(item))
+
+    messages = {}
+    position = 0
+    while position < len(tokens):
+        # Each message is "<seq> (<name> <value> ...)"
+        position += 1
+        attributes, position = _parse_list(tokens, position + 1)
+        items = {}
+        for name, value in zip(attributes[::2], attributes[1::2]):
+            items[name.decode().upper()] = value
+        if 'UID' not in items:
+            # Unsolicited FETCH responses (e.g. flag updates) carry no UID
+            continue
+        messages[int(items['UID'])] = items
+    return messages
+
+
+def find_text_parts(structure):
+    """Return (part_number, encoding, charset) for each text/plain part of a BODYSTRUCTURE."""
+    parts = []
+    for number, leaf in _leaf_parts(structure):
+        maintype, subtype = (leaf[0] or b'').lower(), (leaf[1] or b'').lower()
+        if maintype != b'text' or subtype != b'plain':
+            continue
+        charset = (_pairs(leaf[2]).get(b'charset') or b'utf-8').decode('ascii', 'replace')
+        parts.append((number, _encoding(leaf), charset))
+    return parts
+
+
+def find_attachments(structure):
+    """Return a dict per BODYSTRUCTURE part that carries a filename."""
+    attachments = []
+    for number, leaf in _leaf_parts(structure):
+        maintype, subtype = (leaf[0] or b'').lower(), (leaf[1] or b'').lower()
+        # Extension data (md5, disposition) follows the type-specific fields
+        if maintype == b'text':
+            disposition_index = 9
+        elif (maintype, subtype) == (b'message', b'rfc822'):
+            disposition_index = 11
+        else:
+            disposition_index = 8
+        disposition = leaf[disposition_index] if len(leaf) > disposition_index else None
+        disposition_params = _pairs(disposition[1]) if isinstance(disposition, list) and len(disposition) > 1 else {}
+        filename = disposition_params.get(b'filename') or _pairs(leaf[2]).get(b'name')
+        if not filename:
+            continue
+        attachments.append({
+            'part_number': number,
+            'filename': decode_header_value(filename.decode('utf-8', 'replace')),
+            'content_type': f"{maintype.decode()}/{subtype.decode()}",
+            'size': int(leaf[6] or 0),
+            'encoding': _encoding(leaf)
+        })
+    return attachments
+
+
+def iter_message_parts(message, number=None):
+    """Yield (part_number, part) for the leaf parts of an email.message.Message."""
+    # An attached message/rfc822 is one part, as in BODYSTRUCTURE numbering
+    if message.get_content_maintype() == 'multipart':
+        for index, part in enumerate(message.get_payload(), start=1):
+            yield from iter_message_parts(part, f"{number}.{index}" if number else str(index))
+    else:
+        yield number or '1', message
+
+
+def decode_header_value(value):
+    return str(make_header(decode_header(value)))
+
+
+def decode_part(payload, encoding, charset):
+    if encoding == 'base64':
+        payload = base64.b64decode(payload)
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset, 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
+
+
+def decode_transfer_stream(chunks, encoding):
+    """Decode a body part that arrives as arbitrarily split byte chunks."""
+    if encoding == 'base64':
+        return decode_base64_stream(chunks)
+    if encoding == 'quoted-printable':
+        return _decode_quoted_printable_stream(chunks)
+    return (chunk for chunk in chunks if chunk)
+
+
+def decode_base64_stream(chunks):
+    """Decode base64 chunks whose boundaries do not fall on 4-byte groups."""
+    pending = b''
+    for chunk in chunks:
+        pending += b''.join(chunk.split())
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            yield base64.b64decode(pending[:usable])
+            pending = pending[usable:]
+    if pending:
+        yield base64.b64decode(pending + b'=' * (-len(pending) % 4))
+
+
+def _decode_quoted_printable_stream(chunks):
+    # Soft line breaks and =XX escapes never span a newline
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        end = pending.rfind(b'\n') + 1
+        if end:
+            yield quopri.decodestring(pending[:end])
+            pending = pending[end:]
+    if pending:
+        yield quopri.decodestring(pending)
+
+
+def _leaf_parts(structure, number=None):
+    if structure and isinstance(structure[0], list):
+        for index, child in enumerate(structure, start=1):
+            if not isinstance(child, list):
+                # The subtype and extension data follow the child parts
+                break
+            yield from _leaf_parts(child, f"{number}.{index}" if number else str(index))
+    else:
+        yield number or '1', structure
+
+
+def _pairs(values):
+    values = values if isinstance(values, list) else []
+    return {key.lower(): value for key, value in zip(values[::2], values[1::2]) if isinstance(key, bytes)}
+
+
+def _encoding(leaf):
+    return (leaf[5] or b'7bit').decode('ascii', 'replace').lower()
+
+
+def _parse_list(tokens, position):
+    values = []
+    while position < len(tokens):
+        token = tokens[position]
+        if token == '(':
+            value, position = _parse_list(tokens, position + 1)
+            values.append(value)
+        elif token == ')':
+            return values, position + 1
+        else:
+            values.append(token)
+            position += 1
+    return values, position
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    length = len(text)
+    while position < length:
+        char = text[position:position + 1]
+        if char in (b' ', b'\r', b'\n'):
+            position += 1
+        elif char in (b'(', b')'):
+            tokens.append(char.decode())
+            position += 1
+        elif char == b'"':
+            value = bytearray()
+            position += 1
+            while position < length and text[position:position + 1] != b'"':
+                if text[position:position + 1] == b'\\':
+                    position += 1
+                value += text[position:position + 1]
+                position += 1
+            tokens.append(bytes(value))
+            position += 1
+        else:
+            start = position
+            depth = 0
+            while position < length:
+                char = text[position:position + 1]
+                if char == b'[':
+                    depth += 1
+                elif char == b']':
+                    depth -= 1
+                elif depth == 0 and char in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                position += 1
+            atom = text[start:position]
+            tokens.append(None if atom.upper() == b'NIL' else atom)
+    return tokens
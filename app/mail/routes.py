@@ -1,11 +1,18 @@
 # app/mail/routes.py
 
 from app.mail import bp
-from app.models import MailUser, Agency, Email
+from app.models import MailUser, Agency, Email, EmailBody, Attachment
 from app.utils import login_required
 from app.database import db
-from flask import render_template, request, session, flash, redirect, url_for, Response, jsonify
+from datetime import datetime
+from sqlalchemy import tuple_
+from sqlalchemy.orm import load_only, selectinload
+from flask import render_template, request, session, flash, redirect, url_for, send_file, jsonify, abort
 from app.mail.email_handler import EmailHandler
+from app.mail.attachment_cache import get_attachment_cache
+from app.mail import search
+
+MAIL_PAGE_SIZE = 30
 
 @bp.route("/", methods=["GET", "POST"])
 @login_required
@@ -64,14 +71,71 @@ def main():
 @bp.route("/get-mails")
 @login_required
 def get_mail():
-    existingUser = db.get_or_404(MailUser, request.args.get("user_id"))
-    emails = Email.query.filter_by(mail_user_id=existingUser.id).order_by(Email.date.desc()).limit(30).all()
+    existingUser = _get_agency_mail_user(request.args.get("user_id"))
+    emails, next_cursor = _email_page(existingUser.id)
     return render_template(
             "show_mail.html",
             emails=emails,
-            user_id=existingUser.id
+            mail_user=existingUser,
+            user_id=existingUser.id,
+            next_cursor=next_cursor
             )
 
+@bp.route("/get-mails/more")
+@login_required
+def get_more_mails():
+    existingUser = _get_agency_mail_user(request.args.get("user_id"))
+    try:
+        emails, next_cursor = _email_page(existingUser.id, request.args.get("cursor"))
+    except ValueError:
+        return "<p>Invalid cursor</p>", 400
+    return render_template(
+            "mail_rows.html",
+            emails=emails,
+            user_id=existingUser.id,
+            next_cursor=next_cursor
+            )
+
+@bp.route("/mail-body/<int:email_id>")
+@login_required
+def get_mail_body(email_id):
+    email_record = db.get_or_404(Email, email_id)
+    _get_agency_mail_user(email_record.mail_user_id)
+    return render_template("mail_body.html", email=email_record, user_id=email_record.mail_user_id)
+
+def _get_agency_mail_user(user_id):
+    mail_user = db.get_or_404(MailUser, user_id)
+    if mail_user.agency_id != session.get('currentAgency').get("id"):
+        abort(404)
+    return mail_user
+
+def _email_page(mail_user_id, cursor=None):
+    """Return one page of a mailbox, newest first, and the cursor of the next page.
+
+    The cursor is the (date, id) of the last row shown, so every page is an
+    index range scan on ix_email_mail_user_date_id no matter how deep it is.
+    The content column is not loaded; mail_body renders it on demand.
+    """
+    query = (
+        db.select(Email)
+        .options(
+            load_only(Email.id, Email.subject, Email.sender, Email.date, Email.mail_user_id),
+            selectinload(Email.attachments)
+        )
+        .where(Email.mail_user_id == mail_user_id)
+        .order_by(Email.date.desc(), Email.id.desc())
+        .limit(MAIL_PAGE_SIZE + 1)
+    )
+    if cursor:
+        date, _, email_id = cursor.rpartition("|")
+        query = query.where(tuple_(Email.date, Email.id) < (datetime.fromisoformat(date), int(email_id)))
+
+    emails = db.session.execute(query).scalars().all()
+    if len(emails) <= MAIL_PAGE_SIZE:
+        return emails, None
+    emails = emails[:MAIL_PAGE_SIZE]
+    return emails, f"{emails[-1].date.isoformat()}|{emails[-1].id}"
+
 @bp.route("/check-email")
 def check_mail():
     email = request.args.get("email")
@@ -89,23 +153,38 @@ def check_mail():
 @bp.route("/mail-att/<int:user_id>/<int:email_id>/<filename>")
 @login_required
 def get_att(user_id, email_id, filename):
-    email_handler = EmailHandler()
-    attachments = email_handler.get_email_attachments(user_id, email_id)
-    
-    if attachments is None:
-        flash("Failed to retrieve attachments", "danger")
+    mail_user = db.get_or_404(MailUser, user_id)
+    if mail_user.agency_id != session.get('currentAgency').get("id"):
+        flash("You don't have permission to view this attachment", "danger")
         return redirect(url_for("mail.main"))
-    
-    for att in attachments:
-        if att['filename'] == filename:
-            res = Response(att['content'])
-            res.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
-            res.headers["filename"] = filename
-            res.headers["content-type"] = "application/octet-stream"
-            return res
-    
-    flash("Attachment not found", "danger")
-    return redirect(url_for("mail.main"))
+
+    email_record = db.session.execute(
+        db.select(Email).filter_by(id=email_id, mail_user_id=user_id)
+    ).scalar_one_or_none()
+    attachment = email_record and db.session.execute(
+        db.select(Attachment).filter_by(email_id=email_record.id, filename=filename)
+    ).scalars().first()
+    if attachment is None:
+        flash("Attachment not found", "danger")
+        return redirect(url_for("mail.main"))
+
+    cache = get_attachment_cache()
+    path = cache.get(attachment.content_hash)
+    if path is None:
+        content_hash = EmailHandler().fetch_attachment(email_record, attachment, cache)
+        if content_hash is None:
+            flash("Failed to retrieve attachment", "danger")
+            return redirect(url_for("mail.main"))
+        attachment.content_hash = content_hash
+        db.session.commit()
+        path = cache.get(content_hash)
+
+    return send_file(
+        path,
+        mimetype=attachment.content_type or "application/octet-stream",
+        as_attachment=True,
+        download_name=filename
+    )
 
 @bp.route("/sync-emails")
 @login_required
@@ -113,8 +192,16 @@ def sync_emails():
     currentAgency = session.get('currentAgency')
     email_handler = EmailHandler()
     try:
-        email_handler.sync_emails(currentAgency.get("id"))
-        flash("Emails synced successfully", "success")
+        results = email_handler.sync_emails(currentAgency.get("id"))
+        for result in results:
+            if result['errors']:
+                flash(f"{result['email']}: sync failed after {result['duration']:.1f}s "
+                      f"({'; '.join(result['errors'])})", "danger")
+            else:
+                flash(f"{result['email']}: {result['new']} new of {result['fetched']} fetched "
+                      f"in {result['duration']:.1f}s", "success")
+        if not results:
+            flash("No email accounts to sync", "warning")
     except Exception as e:
         flash(f"Error syncing emails: {str(e)}", "danger")
     return redirect(url_for("mail.main"))
@@ -128,7 +215,12 @@ def delete_email_account(user_id):
         return redirect(url_for("mail.main"))
     
     try:
+        db.session.execute(db.delete(Attachment).where(
+            Attachment.email_id.in_(db.select(Email.id).filter_by(mail_user_id=user_id))
+        ))
+        search.remove_mail_user(user_id)
         Email.query.filter_by(mail_user_id=user_id).delete()
+        EmailBody.delete_orphans()
         db.session.delete(mail_user)
         db.session.commit()
         flash("Email account deleted successfully", "success")
@@ -143,14 +235,21 @@ def delete_email_account(user_id):
 def search_emails():
     if request.method == "POST":
         search_term = request.form.get("search_term")
-        user_id = request.form.get("user_id")
-        
-        emails = Email.query.filter(
-            Email.mail_user_id == user_id,
-            (Email.subject.ilike(f"%{search_term}%") | Email.content.ilike(f"%{search_term}%"))
-        ).order_by(Email.date.desc()).all()
-        
-        return render_template("search_results.html", emails=emails, user_id=user_id)
+        user_id = request.form.get("user_id", type=int)
+        page = request.form.get("page", 1, type=int)
+        mail_user = db.get_or_404(MailUser, user_id)
+        if mail_user.agency_id != session.get('currentAgency').get("id"):
+            return "<h4>You don't have permission to search this email account</h4>", 403
+
+        emails, has_next = search.search_emails(user_id, search_term, page=page)
+
+        return render_template(
+            "search_results.html",
+            emails=emails,
+            user_id=user_id,
+            page=page,
+            has_next=has_next
+        )
     
     users = MailUser.query.filter_by(agency_id=session.get('currentAgency').get("id")).all()
     return render_template("search_emails.html", users=users)
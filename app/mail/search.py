@@ -0,0 +1,198 @@
+# app/mail/search.py
+
+import re
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import selectinload
+
+from app.models import Email
+from app.database import db
+
+SEARCH_PAGE_SIZE = 20
+REBUILD_BATCH_SIZE = 5000
+
+# PostgreSQL keeps one tsvector per email in a side table with a GIN index;
+# SQLite keeps an FTS5 table whose rowid is the email id. Both are written
+# by index_emails() from the sync path rather than by triggers.
+_POSTGRES_DDL = (
+    """CREATE TABLE IF NOT EXISTS email_search (
+        email_id INTEGER PRIMARY KEY REFERENCES email (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_email_search_document ON email_search USING GIN (document)",
+)
+_POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('simple', coalesce(:subject, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(:content, '')), 'B')"
+)
+# Contentless: the text already lives (compressed) in email_body, so FTS5
+# only keeps its index. Rows are removed with the 'delete' command, which
+# has to be given the values that were indexed.
+_SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS email_fts USING fts5(subject, content, content='', tokenize='unicode61')",
+)
+# Subject matches rank above body matches, as with the 'A'/'B' weights above
+_SQLITE_BM25_WEIGHTS = "10.0, 1.0"
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def create_search_index():
+    """Create the search structures for the current database if missing.
+
+    Returns True when they were newly created, in which case existing
+    emails still have to be indexed (see rebuild_search_index).
+    """
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        table = 'email_search'
+        statements = _POSTGRES_DDL
+    elif dialect == 'sqlite':
+        table = 'email_fts'
+        statements = _SQLITE_DDL
+    else:
+        return False
+
+    created = table not in inspect(db.session.get_bind()).get_table_names()
+    for statement in statements:
+        db.session.execute(text(statement))
+    db.session.commit()
+    return created
+
+
+def index_emails(emails):
+    """Add search entries for the given (flushed) emails."""
+    rows = _document_rows(emails)
+    if not rows:
+        return
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        db.session.execute(text(
+            f"INSERT INTO email_search (email_id, document) VALUES (:id, {_POSTGRES_DOCUMENT}) "
+            "ON CONFLICT (email_id) DO UPDATE SET document = excluded.document"
+        ), rows)
+    elif dialect == 'sqlite':
+        db.session.execute(text(
+            "INSERT INTO email_fts (rowid, subject, content) VALUES (:id, :subject, :content)"
+        ), rows)
+
+
+def remove_mail_user(mail_user_id, batch_size=REBUILD_BATCH_SIZE):
+    """Drop the search entries of every email of a mail account."""
+    # PostgreSQL entries go with their email rows (ON DELETE CASCADE)
+    if _dialect() != 'sqlite':
+        return
+    last_id = 0
+    while True:
+        emails = db.session.execute(
+            db.select(Email).options(selectinload(Email.body))
+            .where(Email.mail_user_id == mail_user_id, Email.id > last_id)
+            .order_by(Email.id).limit(batch_size)
+        ).scalars().all()
+        if not emails:
+            break
+        db.session.execute(text(
+            "INSERT INTO email_fts (email_fts, rowid, subject, content) VALUES ('delete', :id, :subject, :content)"
+        ), _document_rows(emails))
+        last_id = emails[-1].id
+
+
+def reset_search_index():
+    """Drop and rebuild the search index from the stored emails."""
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        db.session.execute(text("DROP TABLE IF EXISTS email_search"))
+    elif dialect == 'sqlite':
+        db.session.execute(text("DROP TABLE IF EXISTS email_fts"))
+    db.session.commit()
+    create_search_index()
+    return rebuild_search_index()
+
+
+def rebuild_search_index(batch_size=REBUILD_BATCH_SIZE):
+    """Index every stored email, in batches of ``batch_size``."""
+    last_id = 0
+    total = 0
+    while True:
+        emails = db.session.execute(
+            db.select(Email).options(selectinload(Email.body))
+            .where(Email.id > last_id).order_by(Email.id).limit(batch_size)
+        ).scalars().all()
+        if not emails:
+            break
+        index_emails(emails)
+        db.session.commit()
+        last_id = emails[-1].id
+        total += len(emails)
+        db.session.expunge_all()
+    return total
+
+
+def search_emails(mail_user_id, term, page=1, per_page=SEARCH_PAGE_SIZE):
+    """Return (emails, has_next) for one page of ranked results.
+
+    Every word of ``term`` has to match (in the subject or the content).
+    Results are ordered by relevance, then by date.
+    """
+    words = _TOKEN.findall(term or '')
+    if not words:
+        return [], False
+    offset = (max(page, 1) - 1) * per_page
+    params = {'mail_user_id': mail_user_id, 'limit': per_page + 1, 'offset': offset}
+
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        params['query'] = ' '.join(words)
+        ids = db.session.execute(text(
+            "SELECT email.id FROM email_search "
+            "JOIN email ON email.id = email_search.email_id, "
+            "plainto_tsquery('simple', :query) AS query "
+            "WHERE email.mail_user_id = :mail_user_id AND email_search.document @@ query "
+            "ORDER BY ts_rank(email_search.document, query) DESC, email.date DESC "
+            "LIMIT :limit OFFSET :offset"
+        ), params).scalars().all()
+    elif dialect == 'sqlite':
+        # Quote every word so FTS5 operators in user input are taken literally
+        params['query'] = ' '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+        ids = db.session.execute(text(
+            "SELECT email.id FROM email_fts "
+            "JOIN email ON email.id = email_fts.rowid "
+            "WHERE email_fts MATCH :query AND email.mail_user_id = :mail_user_id "
+            f"ORDER BY bm25(email_fts, {_SQLITE_BM25_WEIGHTS}), email.date DESC "
+            "LIMIT :limit OFFSET :offset"
+        ), params).scalars().all()
+    else:
+        # Bodies are stored compressed, so only subjects can be matched here
+        ids = db.session.execute(
+            db.select(Email.id).where(
+                Email.mail_user_id == mail_user_id,
+                Email.subject.ilike(f"%{term}%")
+            ).order_by(Email.date.desc()).limit(per_page + 1).offset(offset)
+        ).scalars().all()
+
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    emails = {email.id: email for email in db.session.execute(
+        db.select(Email).options(selectinload(Email.body)).where(Email.id.in_(ids))
+    ).scalars()}
+    return [emails[email_id] for email_id in ids if email_id in emails], has_next
+
+
+@click.command("rebuild-search-index")
+@with_appcontext
+def rebuild_search_index_command():
+    """Re-index every stored email for /mail/search-emails."""
+    click.echo(f"Indexed {reset_search_index()} emails")
+
+
+def _document_rows(emails):
+    return [
+        {'id': email.id, 'subject': email.subject or '', 'content': email.content or ''}
+        for email in emails
+    ]
@@ -0,0 +1,41 @@
+# app/mail/uid_migration.py
+
+from sqlalchemy import inspect, text
+
+from app.database import db
+
+_UID_COLUMNS = (
+    ('mail_user', 'uid_validity', 'BIGINT'),
+    ('mail_user', 'last_uid', 'BIGINT'),
+    ('mail_user', 'legacy_emails_claimed', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+    ('email', 'message_id', 'VARCHAR(255)'),
+    ('email', 'uid', 'BIGINT'),
+)
+
+
+def add_uid_columns():
+    """Add the IMAP UID columns to a database created before incremental sync.
+
+    Emails stored before have no message_id; the syncs of each account
+    match them by their headers and fill it in until one sync has covered
+    the whole folder (see EmailHandler._claim_legacy_emails). Returns the
+    number of added columns.
+    """
+    # Inspect on the connection the ALTERs run on; another pooled SQLite
+    # connection can still hold the schema from before a change
+    inspector = inspect(db.session.connection())
+    columns = {
+        table: {column['name'] for column in inspector.get_columns(table)}
+        for table in ('mail_user', 'email')
+    }
+    added = 0
+    for table, column, column_type in _UID_COLUMNS:
+        if column not in columns[table]:
+            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+            added += 1
+    # create_all only adds the constraint to new tables; NULL message_ids never collide
+    db.session.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_email_mail_user_message_id ON email (mail_user_id, message_id)"
+    ))
+    db.session.commit()
+    return added
@@ -1,14 +1,18 @@
 # Marketing\app\models.py
 
-from datetime import datetime
+from datetime import date, datetime
 from typing import List, Optional
+import hashlib
+import zlib
 
 from sqlalchemy import ForeignKey
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Mapped, WriteOnlyMapped, mapped_column, relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlalchemy as sa
 
-from app.database import db
+from app.database import db, email_body_lock
 from app.errors import UserAlreadyExist, UserDoesntExist, CustomerAlreadyExist
 
 class Agency(db.Model):
@@ -121,44 +125,91 @@ class BankConnection(db.Model):
     finapi_connection_id: Mapped[int] = mapped_column(nullable=False)
     bank_name: Mapped[str] = mapped_column(sa.String(100), nullable=False)
     last_sync: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    agency: Mapped["Agency"] = relationship(back_populates="bank_connections", init=False)
+    # Children are removed by the database (ON DELETE CASCADE) or, for large
+    # connections, in chunks by helpers/bank_purge.py; never loaded to delete
+    accounts: Mapped[List["BankAccount"]] = relationship(
+            back_populates="connection", cascade="all, delete-orphan", passive_deletes=True, default_factory=list
+            )
+    # Set when the connection was deleted and its rows are still being purged
+    purge_requested_at: Mapped[Optional[datetime]] = mapped_column(default=None)
 
 class BankAccount(db.Model):
     id: Mapped[int] = mapped_column(primary_key=True)
-    connection_id: Mapped[int] = mapped_column(ForeignKey("bank_connection.id"), nullable=False)
+    connection_id: Mapped[int] = mapped_column(ForeignKey("bank_connection.id", ondelete="CASCADE"), nullable=False)
     finapi_account_id: Mapped[int] = mapped_column(nullable=False)
     account_name: Mapped[str] = mapped_column(sa.String(100), nullable=False)
     iban: Mapped[str] = mapped_column(sa.String(34))
+    connection: Mapped["BankConnection"] = relationship(back_populates="accounts", init=False)
+    # Balance before the first transaction the ledger has seen; set once from
+    # the bank's reported balance (see helpers/balance_ledger.py)
+    opening_balance: Mapped[Optional[float]] = mapped_column(default=None)
+    # Write-only: accounts can hold millions of transactions, query them through .select()
+    transactions: WriteOnlyMapped["BankTransaction"] = relationship(
+            back_populates="account", cascade="all, delete-orphan", passive_deletes=True, init=False
+            )
 
 class BankTransaction(db.Model):
+    __table_args__ = (
+        # Date-range filters and keyset pages per account (helpers/transaction_search.py)
+        sa.Index("ix_bank_transaction_account_booking", "account_id", "booking_date", "id"),
+        sa.Index("uq_bank_transaction_account_finapi", "account_id", "finapi_transaction_id", unique=True),
+    )
+
     id: Mapped[int] = mapped_column(primary_key=True)
-    account_id: Mapped[int] = mapped_column(ForeignKey("bank_account.id"), nullable=False)
+    account_id: Mapped[int] = mapped_column(ForeignKey("bank_account.id", ondelete="CASCADE"), nullable=False)
     finapi_transaction_id: Mapped[int] = mapped_column(nullable=False)
     amount: Mapped[float] = mapped_column(nullable=False)
     purpose: Mapped[str] = mapped_column(sa.String(255))
     booking_date: Mapped[datetime] = mapped_column(nullable=False)
     value_date: Mapped[datetime] = mapped_column(nullable=False)
+    account: Mapped["BankAccount"] = relationship(back_populates="transactions", init=False)
+
+class BankBalanceDay(db.Model):
+    # One row per account and booking day that has transactions: the day's
+    # net amount and the closing balance (the account's opening balance plus
+    # every transaction up to and including that day). Kept current by
+    # helpers/balance_ledger.py as transactions are ingested.
+    account_id: Mapped[int] = mapped_column(
+        ForeignKey("bank_account.id", ondelete="CASCADE"), primary_key=True
+    )
+    day: Mapped[date] = mapped_column(primary_key=True)
+    amount: Mapped[float] = mapped_column(default=0)
+    balance: Mapped[float] = mapped_column(default=0)
 
 
 class MailUser(db.Model):
-    id: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
     email: Mapped[str] = mapped_column(sa.String(120), unique=True)
     password: Mapped[str] = mapped_column(sa.String(255))
     domain: Mapped[str] = mapped_column(sa.String(50))
     folder: Mapped[str] = mapped_column(sa.String(50))
     agency_id: Mapped[int] = mapped_column(sa.ForeignKey('agency.id'))
     agency: Mapped["Agency"] = relationship(back_populates="mail_users")
-    emails: Mapped[List["Email"]] = relationship(back_populates="mail_user", cascade="all, delete-orphan")
+    emails: Mapped[List["Email"]] = relationship(back_populates="mail_user", cascade="all, delete-orphan", default_factory=list)
+    # IMAP sync state: UIDVALIDITY of the folder and the highest UID stored so far
+    uid_validity: Mapped[Optional[int]] = mapped_column(sa.BigInteger, default=None)
+    last_uid: Mapped[Optional[int]] = mapped_column(sa.BigInteger, default=None)
+    # Set once a sync has gone through every message of the folder; emails
+    # stored before Message-IDs that are still unclaimed then never match
+    legacy_emails_claimed: Mapped[bool] = mapped_column(default=False)
 
     def __repr__(self):
         return f'<MailUser {self.email}>'
 
 
 class Attachment(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(255), nullable=False)
-    content_type = db.Column(db.String(100), nullable=False)
-    data = db.Column(db.LargeBinary, nullable=False)
-    email_id = db.Column(db.Integer, db.ForeignKey('email.id'), nullable=False)
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    email_id: Mapped[int] = mapped_column(sa.ForeignKey("email.id", ondelete="CASCADE"), init=False)
+    filename: Mapped[str] = mapped_column(sa.String(255))
+    content_type: Mapped[str] = mapped_column(sa.String(100))
+    # IMAP body section (e.g. "2" or "1.3") used to fetch only this part
+    part_number: Mapped[str] = mapped_column(sa.String(50))
+    # Transfer-encoded size as reported by the server
+    size: Mapped[int] = mapped_column(default=0)
+    encoding: Mapped[Optional[str]] = mapped_column(sa.String(50), default=None)
+    # sha256 of the decoded content once it is in the attachment disk cache
+    content_hash: Mapped[Optional[str]] = mapped_column(sa.String(64), default=None)
 
     def __repr__(self):
         return f'<Attachment {self.filename}>'
@@ -170,38 +221,196 @@ class GoogleAdsAccount(db.Model):
     agency_id: Mapped[int] = mapped_column(sa.ForeignKey("agency.id"))
     agency: Mapped["Agency"] = relationship(back_populates="google_ads_accounts")
     campaigns: Mapped[List["GoogleAdsCampaign"]] = relationship(back_populates="account", cascade="all, delete-orphan")
+    descriptive_name: Mapped[Optional[str]] = mapped_column(sa.String(255), default=None)
+    # Last day whose metrics were complete when fetched; the next sync resumes here
+    metrics_synced_through: Mapped[Optional[date]] = mapped_column(default=None)
 
 class GoogleAdsCampaign(db.Model):
+    __table_args__ = (
+        # Campaigns are stored and upserted per account
+        sa.Index("uq_google_ads_campaign_account_campaign", "account_id", "campaign_id", unique=True),
+    )
+
     id: Mapped[int] = mapped_column(primary_key=True)
-    campaign_id: Mapped[str] = mapped_column(sa.String(20), unique=True)
+    campaign_id: Mapped[str] = mapped_column(sa.String(20))
     name: Mapped[str] = mapped_column(sa.String(100))
     status: Mapped[str] = mapped_column(sa.String(20))
     budget: Mapped[float]
     account_id: Mapped[int] = mapped_column(sa.ForeignKey("google_ads_account.id"))
     account: Mapped["GoogleAdsAccount"] = relationship(back_populates="campaigns")
 
+class GoogleAdsCampaignDay(db.Model):
+    # Daily metrics per campaign; cost stays in integer micros as the API reports it
+    __table_args__ = (
+        sa.Index("ix_google_ads_campaign_day_account_day", "account_id", "day"),
+    )
+
+    campaign_id: Mapped[int] = mapped_column(
+        sa.ForeignKey("google_ads_campaign.id", ondelete="CASCADE"), primary_key=True
+    )
+    day: Mapped[date] = mapped_column(primary_key=True)
+    account_id: Mapped[int] = mapped_column(sa.ForeignKey("google_ads_account.id", ondelete="CASCADE"))
+    impressions: Mapped[int] = mapped_column(sa.BigInteger, default=0)
+    clicks: Mapped[int] = mapped_column(sa.BigInteger, default=0)
+    cost_micros: Mapped[int] = mapped_column(sa.BigInteger, default=0)
+
+class GoogleAdsCampaignRollup(db.Model):
+    # Weekly (from Monday) and monthly totals of GoogleAdsCampaignDay
+    __table_args__ = (
+        sa.Index("ix_google_ads_campaign_rollup_account_period", "account_id", "period", "period_start"),
+    )
+
+    campaign_id: Mapped[int] = mapped_column(
+        sa.ForeignKey("google_ads_campaign.id", ondelete="CASCADE"), primary_key=True
+    )
+    period: Mapped[str] = mapped_column(sa.String(5), primary_key=True)
+    period_start: Mapped[date] = mapped_column(primary_key=True)
+    account_id: Mapped[int] = mapped_column(sa.ForeignKey("google_ads_account.id", ondelete="CASCADE"))
+    impressions: Mapped[int] = mapped_column(sa.BigInteger, default=0)
+    clicks: Mapped[int] = mapped_column(sa.BigInteger, default=0)
+    cost_micros: Mapped[int] = mapped_column(sa.BigInteger, default=0)
+
 
 
 class Email(db.Model):
-    id: Mapped[int] = mapped_column(primary_key=True)
+    __table_args__ = (
+        sa.UniqueConstraint("mail_user_id", "message_id", name="uq_email_mail_user_message_id"),
+        # Mailbox listing: newest first, keyset-paginated on (date, id)
+        sa.Index("ix_email_mail_user_date_id", "mail_user_id", "date", "id"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
     subject: Mapped[str] = mapped_column(sa.String(255))
     sender: Mapped[str] = mapped_column(sa.String(100))
     recipient: Mapped[str] = mapped_column(sa.String(100))
     date: Mapped[datetime]
-    content: Mapped[str] = mapped_column(sa.Text)
     mail_user_id: Mapped[int] = mapped_column(sa.ForeignKey("mail_user.id"))
     mail_user: Mapped["MailUser"] = relationship(back_populates="emails")
+    # Message-ID header, or a header digest when the message has none
+    message_id: Mapped[Optional[str]] = mapped_column(sa.String(255), default=None)
+    uid: Mapped[Optional[int]] = mapped_column(sa.BigInteger, default=None)
+    attachments: Mapped[List["Attachment"]] = relationship(cascade="all, delete-orphan", default_factory=list)
+    # Loaded on first access only; listings never touch the body
+    body_id: Mapped[Optional[int]] = mapped_column(sa.ForeignKey("email_body.id"), default=None)
+    body: Mapped[Optional["EmailBody"]] = relationship(default=None)
+
+    @property
+    def content(self):
+        return self.body.text if self.body else ''
 
     def __repr__(self):
         return f'<Email {self.subject}>'
 
+class EmailBody(db.Model):
+    # One row per distinct plain-text body, shared by every Email with the
+    # same text (Sent folders repeat the same quoted threads a lot)
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    content_hash: Mapped[str] = mapped_column(sa.String(64), unique=True)
+    # zlib-compressed UTF-8 text
+    data: Mapped[bytes] = mapped_column(sa.LargeBinary)
+    size: Mapped[int]
+
+    @property
+    def text(self):
+        return zlib.decompress(self.data).decode('utf-8')
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def for_texts(texts):
+        """Return {text: EmailBody}, storing the bodies that are missing.
+
+        Every body is inserted with ON CONFLICT DO NOTHING and then read
+        back, so sync workers storing the same text at once share one row
+        instead of one failing on the unique content_hash. Until the caller
+        commits, delete_orphans cannot remove the bodies returned.
+        """
+        hashes = {EmailBody.hash_text(text): text for text in texts}
+        if not hashes:
+            return {}
+        email_body_lock()
+        rows = []
+        for content_hash, text in hashes.items():
+            encoded = text.encode('utf-8')
+            rows.append({'content_hash': content_hash, 'data': zlib.compress(encoded), 'size': len(encoded)})
+        db.session.execute(_insert_ignore_statement(EmailBody), rows)
+        bodies = {body.content_hash: body for body in db.session.execute(
+            db.select(EmailBody).where(EmailBody.content_hash.in_(hashes.keys()))
+        ).scalars()}
+        return {text: bodies[content_hash] for content_hash, text in hashes.items()}
+
+    @staticmethod
+    def delete_orphans():
+        email_body_lock(exclusive=True)
+        db.session.execute(db.delete(EmailBody).where(
+            ~EmailBody.id.in_(db.select(Email.body_id).where(Email.body_id.is_not(None)))
+        ))
+
+def _insert_ignore_statement(model):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return pg_insert(model).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite_insert(model).on_conflict_do_nothing()
+    return db.insert(model)
+
 class DataAnalysis(db.Model):
-    id: Mapped[int] = mapped_column(primary_key=True)
+    __table_args__ = (
+        sa.Index("ix_data_analysis_agency_type", "agency_id", "analysis_type"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
     agency_id: Mapped[int] = mapped_column(sa.ForeignKey("agency.id"))
-    agency: Mapped["Agency"] = relationship()
+    agency: Mapped["Agency"] = relationship(init=False)
     analysis_type: Mapped[str] = mapped_column(sa.String(50))
     result: Mapped[str] = mapped_column(sa.Text)
-    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(default_factory=datetime.utcnow)
+
 
+# A queued /sync-data run, executed outside the request cycle by app/jobs.py
+class SyncJob(db.Model):
+    __table_args__ = (
+        sa.Index("ix_sync_job_status_run_after", "status", "run_after"),
+        sa.Index("ix_sync_job_agency_status", "agency_id", "status"),
+        # At most one queued or running job per agency and job type
+        sa.Index(
+            "uq_sync_job_agency_type_active", "agency_id", "job_type", unique=True,
+            sqlite_where=sa.text("status IN ('queued', 'running')"),
+            postgresql_where=sa.text("status IN ('queued', 'running')"),
+        ),
+    )
 
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    agency_id: Mapped[int] = mapped_column(sa.ForeignKey("agency.id"))
+    job_type: Mapped[str] = mapped_column(sa.String(50), default="sync_data")
+    # queued -> running -> succeeded | failed (re-queued while attempts remain)
+    status: Mapped[str] = mapped_column(sa.String(20), default="queued")
+    attempts: Mapped[int] = mapped_column(default=0)
+    max_attempts: Mapped[int] = mapped_column(default=3)
+    run_after: Mapped[datetime] = mapped_column(default_factory=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(default_factory=datetime.utcnow)
+    started_at: Mapped[Optional[datetime]] = mapped_column(default=None)
+    # Refreshed by the worker while the job runs; a stale value means the worker died
+    heartbeat_at: Mapped[Optional[datetime]] = mapped_column(default=None)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(default=None)
+    error: Mapped[Optional[str]] = mapped_column(sa.Text, default=None)
+    result: Mapped[Optional[str]] = mapped_column(sa.Text, default=None)
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'agency_id': self.agency_id,
+            'job_type': self.job_type,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'run_after': self.run_after.isoformat() if self.run_after else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'heartbeat_at': self.heartbeat_at.isoformat() if self.heartbeat_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'error': self.error,
+            'result': self.result
+        }
@@ -1,20 +1,21 @@
 # Marketing\app\routes.py
 
-from flask import Blueprint, request, render_template, redirect, flash, url_for, session, jsonify, current_app, Response
+from flask import Blueprint, request, render_template, redirect, flash, url_for, session, jsonify, current_app, abort, send_file
 from app.models import Agency, LexAcc, Customer, Manual, BankConnection, BankAccount, BankTransaction, MailUser, GoogleAdsAccount
 from app.database import db
 from app.utils import login_required, admin_required, is_admin, add_invoice, fetch_sev_invoice, subscribe_to_invoice_event, unsubscribe_invoice_event
-from app.google_ads.google_ads_handler import GoogleAdsHandler
-from app.bank_handler import BankHandler
-from app.mail.email_handler import EmailHandler
 from app.helpers.finapi_helper import FinAPIHelper
-from app.data_analysis import perform_analysis
+from app.helpers.transaction_ingest import load_account_map, ingest_transactions, seed_finapi_balances
+from app.helpers.streaming_export import iter_text, streaming_response
+from app.helpers.agency_export import iter_agency_json, iter_agency_ndjson
+from app.helpers.columnar_export import DATASETS, FILE_FORMATS, write_dataset
+from app.data_analysis import perform_analysis, invalidate_analysis, visualization_totals, visualization_series, VISUALIZATION_BUCKETS
+from app.jobs import enqueue_sync, get_latest_job
 from app.errors import CustomerAlreadyExist
-import os
+import tempfile
 from flask_login import current_user, login_required
 import requests as rq
-from datetime import datetime, timedelta
-import json
+from datetime import date, datetime, timedelta
 
 bp = Blueprint('main', __name__, template_folder="templates", static_folder="static")
 
@@ -61,7 +62,8 @@ def connect_bank():
 def sync_transactions():
     access_token = FinAPIHelper.get_access_token()
     
-    bank_connections = BankConnection.query.filter_by(agency_id=current_user.agency_id).all()
+    bank_connections = BankConnection.query.filter_by(agency_id=current_user.agency_id, purge_requested_at=None).all()
+    account_map = load_account_map(current_user.agency_id)
     for connection in bank_connections:
         accounts = BankAccount.query.filter_by(connection_id=connection.id).all()
         account_ids = [account.finapi_account_id for account in accounts]
@@ -69,22 +71,12 @@ def sync_transactions():
         from_date = (datetime.utcnow() - timedelta(days=30)).strftime('%Y-%m-%d')
         to_date = datetime.utcnow().strftime('%Y-%m-%d')
         
-        transactions = FinAPIHelper.get_transactions(access_token, account_ids, from_date, to_date)
-        
-        for transaction in transactions:
-            existing_transaction = BankTransaction.query.filter_by(finapi_transaction_id=transaction['id']).first()
-            if not existing_transaction:
-                new_transaction = BankTransaction(
-                    account_id=BankAccount.query.filter_by(finapi_account_id=transaction['accountId']).first().id,
-                    finapi_transaction_id=transaction['id'],
-                    amount=transaction['amount'],
-                    purpose=transaction.get('purpose'),
-                    booking_date=datetime.strptime(transaction['bookingDate'], '%Y-%m-%d').date(),
-                    value_date=datetime.strptime(transaction['valueDate'], '%Y-%m-%d').date()
-                )
-                db.session.add(new_transaction)
+        transactions = FinAPIHelper.iter_transactions(access_token, account_ids, from_date, to_date)
+        ingest_transactions(transactions, account_map)
+        seed_finapi_balances(access_token, accounts)
         
         connection.last_sync = datetime.utcnow()
+        invalidate_analysis(connection.agency_id, 'bank')
         db.session.commit()
     
     return jsonify({'message': 'Transactions synced successfully'}), 200
@@ -97,6 +89,7 @@ def get_transactions():
     
     transactions = BankTransaction.query.join(BankAccount).join(BankConnection).filter(
         BankConnection.agency_id == current_user.agency_id,
+        BankConnection.purge_requested_at.is_(None),
         BankTransaction.booking_date >= start_date,
         BankTransaction.booking_date <= end_date
     ).all()
@@ -156,9 +149,10 @@ def dashboard():
     agency_id = session['currentAgency'].get("id")
     try:
         analysis_results = perform_analysis(agency_id)
+        db.session.commit()
         lex_data = LexAcc.query.filter_by(agency_id=agency_id).all()
         manual_data = Manual.query.filter_by(agency_id=agency_id).all()
-        bank_connections = BankConnection.query.filter_by(agency_id=agency_id).all()
+        bank_connections = BankConnection.query.filter_by(agency_id=agency_id, purge_requested_at=None).all()
         google_ads_data = GoogleAdsAccount.query.filter_by(agency_id=agency_id).all()
         
         return render_template("dashboard.html", 
@@ -177,23 +171,27 @@ def dashboard():
 def sync_data():
     agency_id = session['currentAgency'].get("id")
     
-    google_ads_handler = GoogleAdsHandler(os.getenv('GOOGLE_ADS_CREDENTIALS_PATH'))
-    google_ads_handler.sync_campaigns(agency_id)
-    
-    bank_handler = BankHandler(os.getenv('BANK_API_KEY'))
-    bank_handler.sync_transactions(agency_id)
+    # The sync itself runs in the `flask sync-worker` process
+    job = enqueue_sync(agency_id)
     
-    email_handler = EmailHandler()
-    email_handler.sync_emails(agency_id)
-    
-    flash("Data synchronization completed", "success")
-    return redirect(url_for("main.dashboard"))
+    flash("Data synchronization started", "info")
+    return redirect(url_for("main.dashboard", sync_job=job.id))
+
+@bp.route('/sync-status')
+@login_required
+def sync_status():
+    agency_id = session['currentAgency'].get("id")
+    job = get_latest_job(agency_id)
+    if not job:
+        return jsonify({'status': None}), 200
+    return jsonify(job.to_dict()), 200
 
 @bp.route('/analyze-data')
 @login_required
 def analyze_data():
     agency_id = session['currentAgency'].get("id")
     analysis_results = perform_analysis(agency_id)
+    db.session.commit()
     return render_template("analysis_results.html", results=analysis_results)
 
 @bp.route('/lex-main', methods=["GET", "POST"])
@@ -254,6 +252,7 @@ def lex_delete(lexid: int):
     if current_lexacc.eventID:
         unsubscribe_invoice_event(current_lexacc)
     db.session.delete(current_lexacc)
+    invalidate_analysis(current_lexacc.agency_id, 'lex_sev')
     db.session.commit()
     flash(f"{current_lexacc.name} is deleted", "danger")
     return redirect(url_for('main.lex_main'))
@@ -271,6 +270,7 @@ def lex_customer(lexid: int):
         customer_name = request.form.get("customerName")
         try:
             current_lexacc.add_customer(lexID=customer_id, name=customer_name)
+            invalidate_analysis(agency_id, 'lex_sev')
             db.session.commit()
         except CustomerAlreadyExist as e:
             flash(e.msg, e.category)
@@ -381,6 +381,7 @@ def sev_invoice(sevid: int):
             existing_customer = current_sevacc.add_customer(customer_sev_id, customer_name)
         existing_customer.totalGrossAmount += float(res.get("objects", [{}])[0].get("sumGross", 0))
         existing_customer.totalNetAmount += float(res.get("objects", [{}])[0].get("sumNet", 0))
+        invalidate_analysis(agency_id, 'lex_sev')
         db.session.commit()
 
     customers = Customer.query.filter_by(lexAccId=current_sevacc.id).all()
@@ -424,6 +425,7 @@ def manual_entry():
             existing_entry = new_entry
         existing_entry.totalAmount += float(form_data["amount"])
         existing_entry.addedOn = datetime.utcnow()
+        invalidate_analysis(current_agency.id, 'manual')
         db.session.commit()
         flash("Manual entry added successfully", "success")
 
@@ -480,19 +482,32 @@ def visualize_data(agency_id):
         flash("You don't have permission to view this data", "danger")
         return redirect(url_for("main.dashboard"))
     
-    # Fetch and process data for visualization
-    lex_data = LexAcc.query.filter_by(agency_id=agency_id).all()
-    manual_data = Manual.query.filter_by(agency_id=agency_id).all()
-    bank_connections = BankConnection.query.filter_by(agency_id=agency_id).all()
-    
-    # Process the data and prepare it for visualization
-    visualization_data = {
-        'lex': [{'name': lex.name, 'value': sum(customer.totalGrossAmount for customer in lex.customers)} for lex in lex_data],
-        'manual': [{'name': entry.name, 'value': entry.totalAmount} for entry in manual_data],
-        'bank': [{'name': conn.bank_name, 'value': sum(transaction.amount for account in conn.accounts for transaction in account.transactions)} for conn in bank_connections]
-    }
-    
-    return render_template('visualize.html', data=visualization_data)
+    return render_template('visualize.html', data=visualization_totals(agency_id))
+
+@bp.route('/visualize/<int:agency_id>/series')
+@login_required
+def visualize_series(agency_id):
+    agency = db.get_or_404(Agency, agency_id)
+    if agency.id != session['currentAgency'].get("id") and not session['currentAgency'].get("isAdmin"):
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    bucket = request.args.get('bucket', 'month')
+    if bucket not in VISUALIZATION_BUCKETS:
+        return jsonify({'error': f"bucket must be one of {', '.join(VISUALIZATION_BUCKETS)}"}), 400
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        return jsonify({'error': 'start and end must be YYYY-MM-DD dates'}), 400
+
+    # The ETag is a hash of the body: a client sending it back in
+    # If-None-Match gets an empty 304 while the data is unchanged
+    response = jsonify(visualization_series(agency_id, bucket, start, end))
+    db.session.commit()
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @bp.route('/export/<int:agency_id>')
 @login_required
@@ -502,26 +517,40 @@ def export_data(agency_id):
         flash("You don't have permission to export this data", "danger")
         return redirect(url_for("main.dashboard"))
     
-    # Fetch all relevant data
-    lex_data = LexAcc.query.filter_by(agency_id=agency_id).all()
-    manual_data = Manual.query.filter_by(agency_id=agency_id).all()
-    bank_connections = BankConnection.query.filter_by(agency_id=agency_id).all()
-    
-    # Process and format the data for export
-    export_data = {
-        'lex': [{'name': lex.name, 'orgID': lex.orgID, 'customers': [{'name': c.name, 'gross': c.totalGrossAmount, 'net': c.totalNetAmount} for c in lex.customers]} for lex in lex_data],
-        'manual': [{'name': entry.name, 'source': entry.source, 'amount': entry.totalAmount, 'date': entry.addedOn} for entry in manual_data],
-        'bank': [{'bank_name': conn.bank_name, 'accounts': [{'account_name': acc.account_name, 'transactions': [{'amount': t.amount, 'purpose': t.purpose, 'booking_date': t.booking_date} for t in acc.transactions]} for acc in conn.accounts]} for conn in bank_connections]
-    }
-    
-    # Generate a JSON file
-    response = Response(
-        json.dumps(export_data, default=str),
+    # ?format=ndjson gives one record per line instead of a nested document
+    if request.args.get('format') == 'ndjson':
+        return streaming_response(
+            iter_text(iter_agency_ndjson(agency_id)),
+            mimetype='application/x-ndjson',
+            filename=f'agency_{agency_id}_export.ndjson'
+        )
+    return streaming_response(
+        iter_text(iter_agency_json(agency_id)),
         mimetype='application/json',
-        headers={'Content-Disposition': f'attachment;filename=agency_{agency_id}_export.json'}
+        filename=f'agency_{agency_id}_export.json'
+    )
+
+@bp.route('/export/<int:agency_id>/<dataset>.<file_format>')
+@login_required
+def export_dataset(agency_id, dataset, file_format):
+    agency = db.get_or_404(Agency, agency_id)
+    if agency.id != session['currentAgency'].get("id") and not session['currentAgency'].get("isAdmin"):
+        flash("You don't have permission to export this data", "danger")
+        return redirect(url_for("main.dashboard"))
+    if dataset not in DATASETS or file_format not in FILE_FORMATS:
+        abort(404)
+
+    # Parquet writes its footer last, so the file is built before sending;
+    # the temporary file is removed when the response closes it
+    export_file = tempfile.TemporaryFile()
+    write_dataset(dataset, agency_id, export_file, file_format)
+    export_file.seek(0)
+    return send_file(
+        export_file,
+        mimetype=FILE_FORMATS[file_format],
+        as_attachment=True,
+        download_name=f'agency_{agency_id}_{dataset}.{file_format}'
     )
-    
-    return response
 
 @bp.route('/analysis/<int:agency_id>')
 @login_required
@@ -532,6 +561,7 @@ def analysis(agency_id):
         return redirect(url_for("main.dashboard"))
 
     analysis_results = perform_analysis(agency_id)
+    db.session.commit()
     return render_template('analysis.html', results=analysis_results)
 
 @bp.route('/settings')
@@ -117,6 +117,35 @@ document.addEventListener('DOMContentLoaded', function() {
         googleAdsChart.update();
     }
     
+    // Poll the background sync job started from /sync-data
+    var syncStatus = document.getElementById('syncStatus');
+    function pollSyncStatus() {
+        fetch(syncStatus.dataset.statusUrl)
+            .then(response => response.json())
+            .then(job => {
+                if (!job.status) {
+                    return;
+                }
+                var active = job.status === 'queued' || job.status === 'running';
+                syncStatus.classList.remove('d-none', 'alert-info', 'alert-success', 'alert-danger');
+                if (active) {
+                    syncStatus.classList.add('alert-info');
+                    syncStatus.textContent = 'Data synchronization ' + job.status + (job.error ? ' (retrying: ' + job.error + ')' : '') + '...';
+                    setTimeout(pollSyncStatus, 3000);
+                } else if (job.status === 'succeeded') {
+                    syncStatus.classList.add('alert-success');
+                    syncStatus.textContent = 'Data synchronization completed at ' + job.finished_at;
+                } else {
+                    syncStatus.classList.add('alert-danger');
+                    syncStatus.textContent = 'Data synchronization failed: ' + job.error;
+                }
+            })
+            .catch(error => console.error('Error fetching sync status:', error));
+    }
+    if (syncStatus) {
+        pollSyncStatus();
+    }
+
     // Call updateDashboard every 5 minutes
     setInterval(updateDashboard, 300000);
 
@@ -3,6 +3,7 @@
 from app.errors import LoginFunctionUndefined
 from app.models import LexAcc, Customer
 from app.database import db
+from app.data_analysis import invalidate_analysis
 from flask import session, current_app, redirect, url_for, flash
 from functools import wraps
 import requests as rq
@@ -88,6 +89,7 @@ def add_invoice(invoice_data):
             invoice_data.get("totalPrice").get("totalGrossAmount"),
             invoice_data.get("totalPrice").get("totalNetAmount"),
             )
+    invalidate_analysis(currentLexacc.agency_id, "lex_sev")
     db.session.commit()
 
 def fetch_sev_invoice(key, invoiceId):
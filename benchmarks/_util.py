@@ -0,0 +1,50 @@
+# benchmarks/_util.py
+"""Timing and query plan helpers shared by the benchmark scripts."""
+
+from collections import Counter
+from contextlib import contextmanager
+import re
+import time
+
+from sqlalchemy import event
+
+
+@contextmanager
+def captured_statements(engine):
+    """Collect (statement, parameters) of every query run on engine inside the block."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+
+def timed(function, repeat=1):
+    """Run function repeat times; return its last result and the fastest run in milliseconds."""
+    fastest = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = (time.perf_counter() - started) * 1000
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return result, fastest
+
+
+def print_plan(db, statements):
+    """Print the SQLite query plan steps of the SELECT statements, counting repeated steps."""
+    # Per-account subqueries repeat the same steps once per account
+    steps = Counter()
+    raw = db.session.connection().connection.driver_connection
+    for statement, parameters in statements:
+        if statement.lstrip().upper().startswith('SELECT'):
+            steps.update(
+                re.sub(r'anon_\d+', 'anon', row[-1])
+                for row in raw.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            )
+    for step, count in steps.items():
+        print(f"      {step}" + (f"  (x{count})" if count > 1 else ""))
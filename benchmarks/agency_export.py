@@ -0,0 +1,173 @@
+# benchmarks/agency_export.py
+"""Time the /export/<agency_id> JSON export and measure its memory growth on SQLite.
+
+Fills a database with --rows bank transactions over --accounts accounts,
+then builds the export the old way (every row loaded as an ORM object,
+nested into lists and passed to json.dumps at once) and with
+iter_agency_json/iter_agency_ndjson, plain and gzipped. Every variant
+runs in its own process, so the reported peak RSS growth is its own.
+
+    python benchmarks/agency_export.py --rows 1000000
+
+The database is kept (see --database), so a second run skips the fill.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ('old', 'json', 'ndjson', 'json-gzip')
+# fill() creates a single agency
+AGENCY_ID = 1
+INSERT_BATCH = 50_000
+MANUAL_ENTRIES = 1000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--database', default='/tmp/agency_export.db')
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def fill(rows, accounts):
+    from app.database import db
+    from app.models import Agency, BankConnection, BankAccount, BankTransaction, Manual
+
+    agency = Agency(id=None, email='benchmark@example.com', password='benchmark')
+    db.session.add(agency)
+    db.session.flush()
+    connection = BankConnection(
+        id=None, finapi_connection_id=1, bank_name='Benchmark', agency_id=agency.id, last_sync=datetime.utcnow()
+    )
+    db.session.add(connection)
+    db.session.flush()
+    account_ids = []
+    for number in range(accounts):
+        account = BankAccount(
+            id=None, connection_id=connection.id, finapi_account_id=number,
+            account_name=f'Account {number}', iban=f'DE{number:020d}'
+        )
+        db.session.add(account)
+        db.session.flush()
+        account_ids.append(account.id)
+    db.session.execute(db.insert(Manual), [
+        {'agency_id': agency.id, 'identifier': f'manual-{number}', 'source': 'manual', 'name': f'Entry {number}',
+         'totalAmount': number * 1.5, 'addedOn': datetime(2024, 1, 1)}
+        for number in range(MANUAL_ENTRIES)
+    ])
+    db.session.commit()
+
+    batch = []
+    first = datetime(2020, 1, 1)
+    for number in range(rows):
+        booking_date = first + timedelta(minutes=number)
+        batch.append({
+            'account_id': account_ids[number % accounts], 'finapi_transaction_id': number,
+            'amount': -(number % 500) / 10, 'purpose': f'SEPA Lastschrift {number}',
+            'booking_date': booking_date, 'value_date': booking_date
+        })
+        if len(batch) == INSERT_BATCH:
+            db.session.execute(db.insert(BankTransaction), batch)
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(db.insert(BankTransaction), batch)
+        db.session.commit()
+
+
+def old_export(agency_id):
+    """The export as it was built before streaming, with the accounts queried explicitly."""
+    from app.models import LexAcc, Manual, BankConnection, BankAccount, BankTransaction
+
+    lex_data = LexAcc.query.filter_by(agency_id=agency_id).all()
+    manual_data = Manual.query.filter_by(agency_id=agency_id).all()
+    bank_connections = BankConnection.query.filter_by(agency_id=agency_id).all()
+    export_data = {
+        'lex': [{'name': lex.name, 'orgID': lex.orgID, 'customers': [
+            {'name': c.name, 'gross': c.totalGrossAmount, 'net': c.totalNetAmount} for c in lex.customers
+        ]} for lex in lex_data],
+        'manual': [
+            {'name': entry.name, 'source': entry.source, 'amount': entry.totalAmount, 'date': entry.addedOn}
+            for entry in manual_data
+        ],
+        'bank': [{'bank_name': conn.bank_name, 'accounts': [{'account_name': acc.account_name, 'transactions': [
+            {'amount': t.amount, 'purpose': t.purpose, 'booking_date': t.booking_date}
+            for t in BankTransaction.query.filter_by(account_id=acc.id).all()
+        ]} for acc in BankAccount.query.filter_by(connection_id=conn.id).all()]} for conn in bank_connections]
+    }
+    return [json.dumps(export_data, default=str).encode('utf-8')]
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode):
+    from app import create_app
+    from app.helpers.agency_export import iter_agency_json, iter_agency_ndjson
+    from app.helpers.streaming_export import iter_text, gzip_chunks
+
+    app = create_app()
+    with app.app_context():
+        # The old export builds its whole document before the first byte
+        # is written, so timing and RSS are both taken around building and
+        # writing
+        start_rss = max_rss_mb()
+        started = time.perf_counter()
+        if mode == 'old':
+            chunks = old_export(AGENCY_ID)
+        elif mode == 'ndjson':
+            chunks = iter_text(iter_agency_ndjson(AGENCY_ID))
+        elif mode == 'json-gzip':
+            chunks = gzip_chunks(iter_text(iter_agency_json(AGENCY_ID)))
+        else:
+            chunks = iter_text(iter_agency_json(AGENCY_ID))
+        size = sum(len(chunk) for chunk in chunks)
+        seconds = time.perf_counter() - started
+        print(json.dumps({'seconds': seconds, 'bytes': size, 'rss_growth_mb': max_rss_mb() - start_rss}))
+
+
+def main():
+    args = parse_args()
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{args.database}'
+    if args.mode:
+        run_mode(args.mode)
+        return
+
+    from app import create_app
+    from app.database import db
+    from app.models import BankTransaction
+
+    app = create_app()
+    with app.app_context():
+        if db.session.execute(db.select(BankTransaction.id).limit(1)).first() is None:
+            print(f"Filling {args.rows} transactions")
+            fill(args.rows, args.accounts)
+        count = db.session.execute(db.select(db.func.count(BankTransaction.id))).scalar_one()
+    print(f"{count} transactions in {args.accounts} accounts\n")
+
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, __file__, '--database', args.database, '--mode', mode],
+            capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{mode:<10} {result['seconds']:>7.1f} s  {result['bytes'] / 1e6:>7.1f} MB out  "
+            f"peak RSS +{result['rss_growth_mb']:.0f} MB"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# benchmarks/bank_transaction_search.py
+"""Time bank transaction listing, search and the ingest lookup on SQLite.
+
+Fills a database with --rows transactions spread over --accounts accounts,
+then runs each query the old way and the way transaction_search does it,
+and prints the timings and the query plan of the new queries. The old
+queries read bank_transaction NOT INDEXED, which is how they ran before
+the composite, unique and FTS indexes existed.
+
+    python benchmarks/bank_transaction_search.py --rows 10000000
+
+The database is kept (see --database), so a second run skips the fill.
+"""
+
+import argparse
+from datetime import date, datetime, timedelta
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from _util import captured_statements, timed, print_plan
+
+RARE_TERM = 'telekom'
+COMMON_TERM = 'lastschrift'
+# One row in RARE_EVERY mentions RARE_TERM; every row mentions COMMON_TERM
+RARE_EVERY = 2500
+FIRST_DAY = datetime(2020, 1, 1)
+DAYS = 5 * 365
+INSERT_BATCH = 50_000
+LOOKUP_SIZE = 1000
+# Each query runs this often; the fastest run is reported
+REPEAT = 3
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--database', default='/tmp/bank_transaction_search.db')
+    return parser.parse_args()
+
+
+def fill(rows, accounts):
+    from app.database import db
+    from app.models import Agency, BankConnection, BankAccount, BankTransaction
+
+    agency = Agency(id=None, email='benchmark@example.com', password='benchmark')
+    db.session.add(agency)
+    db.session.flush()
+    connection = BankConnection(
+        id=None, finapi_connection_id=1, bank_name='Benchmark', agency_id=agency.id, last_sync=datetime.utcnow()
+    )
+    db.session.add(connection)
+    db.session.flush()
+    account_ids = []
+    for number in range(accounts):
+        account = BankAccount(
+            id=None, connection_id=connection.id, finapi_account_id=number,
+            account_name=f'Account {number}', iban=f'DE{number:020d}'
+        )
+        db.session.add(account)
+        db.session.flush()
+        account_ids.append(account.id)
+    db.session.commit()
+
+    per_account = rows // accounts
+    step = timedelta(days=DAYS) / per_account
+    batch = []
+    for account_id in account_ids:
+        for number in range(per_account):
+            booking_date = FIRST_DAY + step * number
+            purpose = f'SEPA Lastschrift {number}'
+            if number % RARE_EVERY == 0:
+                purpose = f'Telekom Deutschland GmbH {number}'
+            batch.append({
+                'account_id': account_id, 'finapi_transaction_id': number, 'amount': -(number % 500) / 10,
+                'purpose': purpose, 'booking_date': booking_date, 'value_date': booking_date
+            })
+            if len(batch) == INSERT_BATCH:
+                db.session.execute(db.insert(BankTransaction), batch)
+                batch = []
+        db.session.commit()
+        print(f"  filled account {account_id}", flush=True)
+    if batch:
+        db.session.execute(db.insert(BankTransaction), batch)
+        db.session.commit()
+
+
+def compare(db, label, before_sql, after):
+    rows, before_ms = timed(lambda: db.session.execute(text(before_sql)).all(), REPEAT)
+    with captured_statements(db.engine) as statements:
+        result, after_ms = timed(after, REPEAT)
+    print(f"{label:<28} {before_ms:>9.0f} ms -> {after_ms:>7.1f} ms  ({len(rows)} rows before, {len(result)} after)")
+    print("    before:")
+    print_plan(db, [(before_sql, ())])
+    print("    after:")
+    print_plan(db, statements[:len(statements) // REPEAT])
+
+
+def main():
+    args = parse_args()
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{args.database}'
+    from app import create_app
+    from app.database import db
+    from app.models import BankAccount, BankTransaction
+    from app.helpers.transaction_search import transaction_page
+
+    app = create_app()
+    with app.app_context():
+        if db.session.execute(db.select(BankTransaction.id).limit(1)).first() is None:
+            print(f"Filling {args.rows} transactions")
+            _, fill_ms = timed(lambda: fill(args.rows, args.accounts))
+            print(f"  took {fill_ms / 1000:.0f} s")
+        account_ids = db.session.execute(db.select(BankAccount.id).order_by(BankAccount.id)).scalars().all()
+        in_accounts = ', '.join(str(account_id) for account_id in account_ids)
+        count = db.session.execute(db.select(db.func.count(BankTransaction.id))).scalar_one()
+        print(f"{count} transactions in {len(account_ids)} accounts\n")
+
+        old_listing = (
+            f"SELECT * FROM bank_transaction NOT INDEXED WHERE account_id IN ({in_accounts}) "
+            "ORDER BY booking_date DESC"
+        )
+        compare(db, 'listing, page 1', old_listing, lambda: transaction_page(account_ids)[0])
+
+        start, end = date(2023, 1, 1), date(2023, 12, 31)
+        compare(
+            db, '2023 date range',
+            f"SELECT * FROM bank_transaction NOT INDEXED WHERE account_id IN ({in_accounts}) "
+            f"AND booking_date >= '{start}' AND booking_date <= '{end}' ORDER BY booking_date DESC",
+            lambda: transaction_page(account_ids, start_date=start, end_date=end)[0]
+        )
+        for term in (RARE_TERM, COMMON_TERM):
+            compare(
+                db, f"purpose '{term}'",
+                f"SELECT * FROM bank_transaction NOT INDEXED WHERE account_id IN ({in_accounts}) "
+                f"AND lower(purpose) LIKE '%{term}%' ORDER BY booking_date DESC",
+                lambda: transaction_page(account_ids, term=term)[0]
+            )
+
+        # The ingest lookup for one batch of already stored transactions of one account
+        lookup = (
+            "SELECT account_id, finapi_transaction_id FROM bank_transaction{} "
+            f"WHERE account_id = {account_ids[0]} AND finapi_transaction_id IN "
+            f"({', '.join(str(number) for number in range(LOOKUP_SIZE))})"
+        )
+        compare(
+            db, 'ingest duplicate lookup', lookup.format(' NOT INDEXED'),
+            lambda: db.session.execute(text(lookup.format(''))).all()
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# benchmarks/email_search.py
+"""Compare the old ILIKE email search with the full-text index on SQLite.
+
+Fills a database with --rows emails over --accounts mail accounts, each
+with a 60-word body, indexes them with rebuild_search_index and searches
+one account for a common and a rare word. The old search is run against
+email_plain, a copy of the emails with the plain-text content column and
+no indexes, as the email table was before bodies moved to email_body.
+
+    python benchmarks/email_search.py --rows 1000000
+
+The database is kept (see --database), so a second run skips the fill.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import hashlib
+import os
+import random
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from _util import captured_statements, timed, print_plan
+
+COMMON_WORD = 'rechnung'
+RARE_WORD = 'mahnung'
+# Share of bodies that contain each word
+COMMON_SHARE = 0.3
+RARE_SHARE = 0.001
+BODY_WORDS = 60
+VOCABULARY = 20_000
+INSERT_BATCH = 20_000
+REPEAT = 3
+
+_PLAIN_DDL = """CREATE TABLE IF NOT EXISTS email_plain (
+    id INTEGER PRIMARY KEY, subject VARCHAR(255), sender VARCHAR(100), recipient VARCHAR(100),
+    date DATETIME, content TEXT, mail_user_id INTEGER
+)"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--database', default='/tmp/email_search.db')
+    return parser.parse_args()
+
+
+def fill(rows, accounts):
+    from app.database import db
+    from app.models import Agency, MailUser, Email, EmailBody
+
+    rng = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = [''.join(rng.choices(letters, k=rng.randint(4, 10))) for _ in range(VOCABULARY)]
+
+    db.session.execute(db.insert(Agency), [{'email': 'benchmark@example.com', 'password': 'benchmark'}])
+    db.session.execute(db.insert(MailUser), [
+        {'email': f'mail{number}@example.com', 'password': 'secret', 'domain': 'example.com',
+         'folder': 'INBOX', 'agency_id': 1}
+        for number in range(accounts)
+    ])
+    db.session.execute(text(_PLAIN_DDL))
+
+    first = datetime(2020, 1, 1)
+    bodies, emails, plain = [], [], []
+    for number in range(1, rows + 1):
+        words = rng.choices(vocabulary, k=BODY_WORDS)
+        if rng.random() < COMMON_SHARE:
+            words[rng.randrange(BODY_WORDS)] = COMMON_WORD
+        if rng.random() < RARE_SHARE:
+            words[rng.randrange(BODY_WORDS)] = RARE_WORD
+        content = ' '.join(words)
+        encoded = content.encode('utf-8')
+        email = {
+            'id': number, 'subject': ' '.join(rng.choices(vocabulary, k=5)), 'sender': 'a@example.com',
+            'recipient': 'b@example.com', 'date': first + timedelta(minutes=number),
+            'mail_user_id': number % accounts + 1
+        }
+        bodies.append({
+            'id': number, 'content_hash': hashlib.sha256(encoded).hexdigest(),
+            'data': zlib.compress(encoded), 'size': len(encoded)
+        })
+        emails.append({**email, 'body_id': number})
+        plain.append({**email, 'content': content})
+        if len(emails) == INSERT_BATCH or number == rows:
+            db.session.execute(db.insert(EmailBody), bodies)
+            db.session.execute(db.insert(Email), emails)
+            db.session.execute(text(
+                "INSERT INTO email_plain (id, subject, sender, recipient, date, content, mail_user_id) "
+                "VALUES (:id, :subject, :sender, :recipient, :date, :content, :mail_user_id)"
+            ), plain)
+            db.session.commit()
+            bodies, emails, plain = [], [], []
+
+
+def main():
+    args = parse_args()
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{args.database}'
+    from app import create_app
+    from app.database import db
+    from app.models import Email
+    from app.mail.search import rebuild_search_index, search_emails
+
+    app = create_app()
+    with app.app_context():
+        if db.session.execute(db.select(Email.id).limit(1)).first() is None:
+            print(f"Filling {args.rows} emails")
+            fill(args.rows, args.accounts)
+            indexed, index_ms = timed(rebuild_search_index)
+            print(f"Indexed {indexed} emails in {index_ms / 1000:.0f} s")
+        count = db.session.execute(db.select(db.func.count(Email.id))).scalar_one()
+        print(f"{count} emails in {args.accounts} accounts\n")
+
+        mail_user_id = 1
+        for word, pages in ((COMMON_WORD, (1, 20)), (RARE_WORD, (1,))):
+            old_sql = (
+                "SELECT * FROM email_plain WHERE mail_user_id = :mail_user_id "
+                "AND (lower(subject) LIKE lower(:pattern) OR lower(content) LIKE lower(:pattern)) ORDER BY date DESC"
+            )
+            params = {'mail_user_id': mail_user_id, 'pattern': f'%{word}%'}
+            old_rows, old_ms = timed(lambda: db.session.execute(text(old_sql), params).all(), REPEAT)
+            print(f"'{word}': ILIKE {old_ms:.0f} ms ({len(old_rows)} rows)")
+            for page in pages:
+                with captured_statements(db.engine) as statements:
+                    (emails, _), page_ms = timed(lambda: search_emails(mail_user_id, word, page=page), REPEAT)
+                print(f"    full-text page {page}: {page_ms:.1f} ms ({len(emails)} rows)")
+            print_plan(db, statements[:len(statements) // REPEAT])
+
+
+if __name__ == '__main__':
+    main()
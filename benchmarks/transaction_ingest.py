@@ -0,0 +1,128 @@
+# benchmarks/transaction_ingest.py
+"""Compare the old per-row FinAPI transaction loop with ingest_transactions on SQLite.
+
+Builds a FinAPI-shaped payload of --rows transactions over --accounts
+accounts and stores it twice with each implementation: once into an
+empty table (every row is new) and once more on top (every row already
+exists, as in a repeated sync). The old loop is the one /sync_transactions
+ran before the ingest stage: one existence query and one account query
+per transaction, each followed by an ORM insert.
+
+    python benchmarks/transaction_ingest.py --rows 20000
+"""
+
+import argparse
+from datetime import date, datetime, timedelta
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _util import timed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20_000)
+    parser.add_argument('--accounts', type=int, default=4)
+    return parser.parse_args()
+
+
+def add_accounts(accounts):
+    from app.database import db
+    from app.models import Agency, BankConnection, BankAccount
+
+    agency = Agency(id=None, email='benchmark@example.com', password='benchmark')
+    db.session.add(agency)
+    db.session.flush()
+    connection = BankConnection(
+        id=None, finapi_connection_id=1, bank_name='Benchmark', agency_id=agency.id, last_sync=datetime.utcnow()
+    )
+    db.session.add(connection)
+    db.session.flush()
+    for number in range(accounts):
+        db.session.add(BankAccount(
+            id=None, connection_id=connection.id, finapi_account_id=number,
+            account_name=f'Account {number}', iban=f'DE{number:020d}'
+        ))
+    db.session.commit()
+    return agency.id
+
+
+def payload(rows, accounts):
+    first = date.today() - timedelta(days=29)
+    return [
+        {
+            'id': number, 'accountId': number % accounts, 'amount': -(number % 500) / 10,
+            'purpose': f'SEPA Lastschrift {number}',
+            'bookingDate': (first + timedelta(days=number % 30)).isoformat(),
+            'valueDate': (first + timedelta(days=number % 30)).isoformat()
+        }
+        for number in range(rows)
+    ]
+
+
+def old_ingest(transactions):
+    from app.database import db
+    from app.models import BankAccount, BankTransaction
+
+    for transaction in transactions:
+        existing_transaction = BankTransaction.query.filter_by(finapi_transaction_id=transaction['id']).first()
+        if not existing_transaction:
+            db.session.add(BankTransaction(
+                id=None,
+                account_id=BankAccount.query.filter_by(finapi_account_id=transaction['accountId']).first().id,
+                finapi_transaction_id=transaction['id'],
+                amount=transaction['amount'],
+                purpose=transaction.get('purpose'),
+                booking_date=datetime.strptime(transaction['bookingDate'], '%Y-%m-%d').date(),
+                value_date=datetime.strptime(transaction['valueDate'], '%Y-%m-%d').date()
+            ))
+    db.session.commit()
+
+
+def new_ingest(transactions, agency_id):
+    from app.database import db
+    from app.helpers.transaction_ingest import load_account_map, ingest_transactions
+
+    ingest_transactions(transactions, load_account_map(agency_id))
+    db.session.commit()
+
+
+def clear():
+    from app.database import db
+    from app.models import BankTransaction, BankBalanceDay
+
+    db.session.execute(db.delete(BankTransaction))
+    db.session.execute(db.delete(BankBalanceDay))
+    db.session.commit()
+
+
+def report(label, function, rows):
+    _, milliseconds = timed(function)
+    seconds = milliseconds / 1000
+    print(f"{label:<32} {seconds:>7.2f} s  {rows / seconds:>9,.0f} rows/sec")
+
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp()
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'ingest.db')}"
+    from app import create_app
+
+    app = create_app()
+    with app.app_context():
+        agency_id = add_accounts(args.accounts)
+        transactions = payload(args.rows, args.accounts)
+        print(f"{args.rows} transactions over {args.accounts} accounts\n")
+
+        report('old loop, new rows', lambda: old_ingest(transactions), args.rows)
+        report('old loop, stored rows', lambda: old_ingest(transactions), args.rows)
+        clear()
+        report('ingest_transactions, new rows', lambda: new_ingest(transactions, agency_id), args.rows)
+        report('ingest_transactions, stored rows', lambda: new_ingest(transactions, agency_id), args.rows)
+
+
+if __name__ == '__main__':
+    main()
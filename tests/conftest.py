@@ -0,0 +1,17 @@
+# tests/conftest.py
+
+import pytest
+
+from app import create_app
+from app.database import db
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """An app on a fresh SQLite file, with an app context pushed."""
+    monkeypatch.setenv('FLASK_SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'app.db'}")
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        yield app
+        db.session.remove()
@@ -0,0 +1,43 @@
+# tests/test_attachment_cache.py
+
+import os
+
+from app.mail.attachment_cache import AttachmentCache
+
+
+def cached(cache):
+    return sorted(
+        name for root, _, files in os.walk(cache.directory) for name in files if not name.startswith('.tmp-')
+    )
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=30)
+    first, second, third = (cache.put([bytes([number]) * 10]) for number in range(3))
+    assert cache.get(first)
+
+    # Over the cap: the second file is the least recently used
+    fourth = cache.put([b'd' * 10])
+    assert cached(cache) == sorted([first, third, fourth])
+    assert cache.get(second) is None
+
+    # Larger than the cap on its own, but kept as the file just written
+    large = cache.put([b'e' * 40])
+    assert cached(cache) == [large]
+
+
+def test_directory_is_scanned_once(tmp_path, monkeypatch):
+    old = AttachmentCache(str(tmp_path), max_bytes=100)
+    older, newer = old.put([b'a' * 10]), old.put([b'b' * 10])
+    os.utime(old.path(older), (1, 1))
+
+    cache = AttachmentCache(str(tmp_path), max_bytes=25)
+    walk = os.walk
+    walks = []
+    monkeypatch.setattr(os, 'walk', lambda *args: walks.append(args) or walk(*args))
+    latest = cache.put([b'c' * 10])
+    cache.put([b'c' * 10])
+    cache.get(latest)
+    assert len(walks) == 1
+    # The files found on disk count toward the cap in mtime order
+    assert cached(cache) == sorted([newer, latest])
@@ -0,0 +1,134 @@
+# tests/test_balance_ledger.py
+
+from datetime import date, datetime
+
+from app.models import Agency, BankConnection, BankAccount, BankTransaction, BankBalanceDay
+from app.database import db
+from app.bank_handler import BankHandler
+from app.helpers import balance_ledger, transaction_ingest
+from app.helpers.balance_ledger import apply_balance_changes, rebuild_balance_ledger, seed_opening_balances
+from app.helpers.transaction_ingest import ingest_transactions
+
+
+def add_account():
+    agency = Agency(id=None, email='agency@example.com', password='secret')
+    db.session.add(agency)
+    db.session.flush()
+    connection = BankConnection(
+        id=None, finapi_connection_id=1, bank_name='Bank', agency_id=agency.id, last_sync=datetime.utcnow()
+    )
+    db.session.add(connection)
+    db.session.flush()
+    account = BankAccount(
+        id=None, connection_id=connection.id, finapi_account_id=11, account_name='Main', iban='DE00'
+    )
+    db.session.add(account)
+    db.session.commit()
+    return account
+
+
+def finapi_transaction(transaction_id, amount, day):
+    return {
+        'id': transaction_id, 'accountId': 11, 'amount': amount, 'purpose': 'Purpose',
+        'bookingDate': day, 'valueDate': day
+    }
+
+
+def ledger():
+    return db.session.execute(
+        db.select(BankBalanceDay.account_id, BankBalanceDay.day, BankBalanceDay.amount, BankBalanceDay.balance)
+        .order_by(BankBalanceDay.account_id, BankBalanceDay.day)
+    ).all()
+
+
+def assert_ledger_matches_transactions():
+    kept = ledger()
+    rebuild_balance_ledger()
+    assert kept == ledger()
+
+
+def test_ingest_skips_rows_stored_since_the_lookup(app, monkeypatch):
+    account = add_account()
+    ingest_transactions([finapi_transaction(1, 10.0, '2024-01-02')], {11: account.id})
+
+    def concurrent_sync(days):
+        # Another sync stores transaction 3 after this batch's lookup
+        db.session.execute(db.insert(BankTransaction).values(
+            account_id=account.id, finapi_transaction_id=3, amount=5.0, purpose='Purpose',
+            booking_date=datetime(2024, 1, 3), value_date=datetime(2024, 1, 3)
+        ))
+
+    monkeypatch.setattr(transaction_ingest, 'ensure_partitions', concurrent_sync)
+    inserted = ingest_transactions(
+        [finapi_transaction(2, -4.0, '2024-01-03'), finapi_transaction(3, 5.0, '2024-01-03')], {11: account.id}
+    )
+
+    assert inserted == 1
+    # Transaction 3 was stored by the other sync, which books it itself
+    assert [row.amount for row in ledger()] == [10.0, -4.0]
+
+
+def test_plaid_sync_keeps_ledger_in_step(app):
+    account = add_account()
+    handler = BankHandler.__new__(BankHandler)
+    handler._process_transactions(account.connection_id, [
+        {'account_id': 11, 'transaction_id': 1, 'amount': 10, 'name': 'Rent', 'date': '2024-01-02'},
+        {'account_id': 11, 'transaction_id': 2, 'amount': -3, 'name': 'Fee', 'date': '2024-01-05'},
+    ])
+    db.session.commit()
+    assert ledger()[-1].balance == 7.0
+
+    # The bank corrects transaction 1 and books a new one
+    handler._process_transactions(account.connection_id, [
+        {'account_id': 11, 'transaction_id': 1, 'amount': 12, 'name': 'Rent', 'date': '2024-01-02'},
+        {'account_id': 11, 'transaction_id': 3, 'amount': 1, 'name': 'Refund', 'date': '2024-01-03'},
+        {'account_id': 99, 'transaction_id': 4, 'amount': 1, 'name': 'Unknown', 'date': '2024-01-03'},
+    ])
+    db.session.commit()
+
+    assert ledger()[-1].balance == 10.0
+    assert_ledger_matches_transactions()
+
+
+def test_concurrent_syncs_of_a_new_day_share_its_row(app, monkeypatch):
+    account = add_account()
+    balance_before = balance_ledger._balance_before
+
+    def concurrent_sync(account_id, day):
+        # Another sync creates the day's row after this one found none
+        db.session.execute(db.insert(BankBalanceDay).values(account_id=account_id, day=day, amount=5.0, balance=5.0))
+        return balance_before(account_id, day)
+
+    monkeypatch.setattr(balance_ledger, '_balance_before', concurrent_sync)
+    apply_balance_changes({(account.id, date(2024, 1, 2)): 10.0})
+
+    assert ledger() == [(account.id, date(2024, 1, 2), 15.0, 15.0)]
+
+
+def test_opening_balance_is_seeded_once(app):
+    account = add_account()
+    ingest_transactions(
+        [finapi_transaction(1, 10.0, '2024-01-02'), finapi_transaction(2, -4.0, '2024-01-03')], {11: account.id}
+    )
+    assert seed_opening_balances({account.id: 106.0}) == 1
+    assert [row.balance for row in ledger()] == [110.0, 106.0]
+    assert seed_opening_balances({account.id: 0.0}) == 0
+
+    ingest_transactions([finapi_transaction(3, 1.0, '2024-01-01')], {11: account.id})
+    assert [row.balance for row in ledger()] == [101.0, 111.0, 107.0]
+    assert_ledger_matches_transactions()
+
+
+def test_rebuild_keeps_the_days_of_archived_transactions(app):
+    account = add_account()
+    ingest_transactions([
+        finapi_transaction(1, 10.0, '2023-12-30'), finapi_transaction(2, 5.0, '2024-01-02'),
+        finapi_transaction(3, -4.0, '2024-01-03'),
+    ], {11: account.id})
+    kept = ledger()
+    # As archive_partitions leaves it: December's transactions are gone, its ledger day stays
+    db.session.execute(db.delete(BankTransaction).where(BankTransaction.booking_date < datetime(2024, 1, 1)))
+    db.session.execute(db.update(BankBalanceDay).where(BankBalanceDay.day >= date(2024, 1, 1)).values(balance=0))
+
+    rebuild_balance_ledger()
+    assert ledger() == kept
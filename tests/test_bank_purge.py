@@ -0,0 +1,66 @@
+# tests/test_bank_purge.py
+
+from sqlalchemy import text
+
+from app.models import BankConnection, BankAccount, BankTransaction, BankBalanceDay
+from app.database import db
+from app.data_analysis import analyze_bank, visualization_totals
+from app.helpers import bank_purge
+from app.helpers.agency_export import iter_agency_ndjson
+from app.helpers.bank_purge import delete_bank_connection, purge_next_chunk
+from app.helpers.balance_ledger import rebuild_balance_ledger
+from app.helpers.columnar_export import iter_record_batches
+from tests.test_balance_ledger import add_account
+from tests.test_transaction_search import add_transactions
+
+
+def add_connection(transactions):
+    account = add_account()
+    add_transactions(account, transactions)
+    rebuild_balance_ledger()
+    db.session.commit()
+    return account.connection
+
+
+def row_counts():
+    return [
+        db.session.execute(db.select(db.func.count()).select_from(model)).scalar_one()
+        for model in (BankConnection, BankAccount, BankTransaction, BankBalanceDay)
+    ]
+
+
+def test_small_connection_is_purged_inline(app):
+    connection = add_connection(3)
+    assert delete_bank_connection(connection)
+    assert row_counts() == [0, 0, 0, 0]
+
+
+def test_large_connection_is_hidden_and_purged_in_chunks(app, monkeypatch):
+    monkeypatch.setattr(bank_purge, 'INLINE_PURGE_LIMIT', 2)
+    connection = add_connection(5)
+    agency_id = connection.agency_id
+    assert analyze_bank(agency_id)['total_transactions'] == 5
+
+    assert not delete_bank_connection(connection)
+    assert row_counts() == [1, 1, 5, 5]
+    # Hidden from analysis and exports while its rows are purged
+    assert analyze_bank(agency_id)['total_transactions'] == 0
+    assert visualization_totals(agency_id)['bank'] == []
+    assert '"bank_name"' not in ''.join(iter_agency_ndjson(agency_id))
+    _, batches = iter_record_batches('transactions', agency_id)
+    assert sum(batch.num_rows for batch in batches) == 0
+
+    chunks = 0
+    while purge_next_chunk(batch_size=2):
+        chunks += 1
+    # Three chunks of transactions, then one for the ledger, accounts and connection
+    assert chunks == 4
+    assert row_counts() == [0, 0, 0, 0]
+
+
+def test_deleting_a_connection_cascades_to_its_rows(app):
+    connection = add_connection(3)
+    db.session.execute(text("PRAGMA foreign_keys = ON"))
+    db.session.execute(db.delete(BankConnection).where(BankConnection.id == connection.id))
+    db.session.commit()
+    assert row_counts() == [0, 0, 0, 0]
@@ -0,0 +1,254 @@
+# tests/test_data_analysis.py
+
+from datetime import datetime, timedelta
+import random
+
+import pytest
+
+from app.models import (
+    Agency, LexAcc, Customer, Manual, BankConnection, BankAccount, BankTransaction, GoogleAdsAccount,
+    GoogleAdsCampaign, MailUser, Email, DataAnalysis
+)
+from app.database import db
+from app import data_analysis
+
+
+# The implementation the grouped queries replaced, kept as the reference
+
+def legacy_lex_sev(agency_id):
+    lex_accounts = LexAcc.query.filter_by(agency_id=agency_id).all()
+    total_gross = sum(sum(c.totalGrossAmount for c in acc.customers) for acc in lex_accounts)
+    total_net = sum(sum(c.totalNetAmount for c in acc.customers) for acc in lex_accounts)
+    customer_count = sum(len(acc.customers) for acc in lex_accounts)
+    return {
+        'total_gross': total_gross,
+        'total_net': total_net,
+        'customer_count': customer_count,
+        'average_per_customer': total_gross / customer_count if customer_count else 0
+    }
+
+
+def legacy_manual(agency_id):
+    manual_entries = Manual.query.filter_by(agency_id=agency_id).all()
+    total_amount = sum(entry.totalAmount for entry in manual_entries)
+    entry_count = len(manual_entries)
+    return {
+        'total_amount': total_amount,
+        'entry_count': entry_count,
+        'average_per_entry': total_amount / entry_count if entry_count else 0
+    }
+
+
+def legacy_bank(agency_id):
+    total_transactions = 0
+    total_amount = 0
+    for connection in BankConnection.query.filter_by(agency_id=agency_id).all():
+        for account in BankAccount.query.filter_by(connection_id=connection.id).all():
+            transactions = BankTransaction.query.filter_by(account_id=account.id).all()
+            total_transactions += len(transactions)
+            total_amount += sum(t.amount for t in transactions)
+    return {
+        'total_transactions': total_transactions,
+        'total_amount': total_amount,
+        'average_per_transaction': total_amount / total_transactions if total_transactions else 0
+    }
+
+
+def legacy_google_ads(agency_id):
+    ads_accounts = GoogleAdsAccount.query.filter_by(agency_id=agency_id).all()
+    total_budget = sum(sum(c.budget for c in account.campaigns) for account in ads_accounts)
+    total_campaigns = sum(len(account.campaigns) for account in ads_accounts)
+    return {
+        'total_budget': total_budget,
+        'total_campaigns': total_campaigns,
+        'average_budget_per_campaign': total_budget / total_campaigns if total_campaigns else 0
+    }
+
+
+def legacy_emails(agency):
+    total_emails = 0
+    last_week = datetime.now() - timedelta(days=7)
+    for mail_user in MailUser.query.filter_by(agency_id=agency.id).all():
+        total_emails += len(Email.query.filter(Email.mail_user_id == mail_user.id, Email.date >= last_week).all())
+    return {'total_emails_last_week': total_emails}
+
+
+def seed(agency_count=3):
+    """Random data for several agencies; the last agency has no rows at all."""
+    rng = random.Random(1)
+    now = datetime.now()
+    rows = {table: [] for table in (
+        Agency, LexAcc, Customer, Manual, BankConnection, BankAccount, BankTransaction,
+        GoogleAdsAccount, GoogleAdsCampaign, MailUser, Email
+    )}
+    ids = {table: 0 for table in rows}
+
+    def add(table, **values):
+        ids[table] += 1
+        rows[table].append(dict(values, id=ids[table]))
+        return ids[table]
+
+    for number in range(agency_count):
+        agency_id = add(Agency, email=f'agency{number}@example.com', password='secret')
+        if number == agency_count - 1:
+            continue
+        for _ in range(rng.randint(1, 3)):
+            lex_id = add(LexAcc, key=f'key{ids[LexAcc]}', orgID=f'org{ids[LexAcc]}', agency_id=agency_id,
+                         name='Lex', source='lex', added_on=now)
+            for _ in range(rng.randint(0, 20)):
+                add(Customer, lexID=f'c{ids[Customer]}', lexAccId=lex_id, name='Customer', addedOn=now,
+                    totalGrossAmount=round(rng.uniform(0, 5000), 2), totalNetAmount=round(rng.uniform(0, 4000), 2))
+        for _ in range(rng.randint(0, 10)):
+            add(Manual, agency_id=agency_id, identifier=f'm{ids[Manual]}', source='manual', name='Entry',
+                totalAmount=round(rng.uniform(-500, 5000), 2), addedOn=now)
+        for _ in range(rng.randint(1, 2)):
+            connection_id = add(BankConnection, agency_id=agency_id, finapi_connection_id=ids[BankConnection] + 1,
+                                bank_name='Bank', last_sync=now)
+            for _ in range(rng.randint(0, 3)):
+                account_id = add(BankAccount, connection_id=connection_id, finapi_account_id=ids[BankAccount] + 1,
+                                 account_name='Account', iban='DE00')
+                for _ in range(rng.randint(0, 200)):
+                    day = now - timedelta(days=rng.randint(0, 400))
+                    add(BankTransaction, account_id=account_id, finapi_transaction_id=ids[BankTransaction] + 1,
+                        amount=round(rng.uniform(-2000, 2000), 2), purpose='Purpose', booking_date=day, value_date=day)
+        for _ in range(rng.randint(1, 2)):
+            ads_id = add(GoogleAdsAccount, customer_id=f'{ids[GoogleAdsAccount] + 1}', refresh_token='token',
+                         agency_id=agency_id)
+            for _ in range(rng.randint(0, 5)):
+                add(GoogleAdsCampaign, campaign_id=f'{ids[GoogleAdsCampaign] + 1}', name='Campaign',
+                    status='ENABLED', budget=round(rng.uniform(1, 100), 2), account_id=ads_id)
+        mail_user_id = add(MailUser, email=f'mail{number}@example.com', password='secret', domain='gmail.com',
+                           folder='INBOX', agency_id=agency_id)
+        for _ in range(rng.randint(0, 30)):
+            add(Email, subject='Subject', sender='a@example.com', recipient='b@example.com',
+                date=now - timedelta(days=rng.randint(0, 14), hours=1), mail_user_id=mail_user_id)
+
+    for table, table_rows in rows.items():
+        if table_rows:
+            db.session.execute(db.insert(table), table_rows)
+    db.session.commit()
+    return ids[Agency]
+
+
+def assert_same(actual, expected):
+    assert actual.keys() >= expected.keys()
+    for key, value in expected.items():
+        # Only the order floats are summed in differs
+        assert actual[key] == pytest.approx(value), key
+
+
+@pytest.mark.parametrize('legacy, current', [
+    (legacy_lex_sev, data_analysis.analyze_lex_sev),
+    (legacy_manual, data_analysis.analyze_manual),
+    (legacy_bank, data_analysis.analyze_bank),
+    (legacy_google_ads, data_analysis.analyze_google_ads),
+])
+def test_aggregates_match_legacy_implementation(app, legacy, current):
+    agency_count = seed()
+    for agency_id in range(1, agency_count + 1):
+        db.session.expire_all()
+        assert_same(current(agency_id), legacy(agency_id))
+
+
+def test_email_counts_match_legacy_implementation(app):
+    agency_count = seed()
+    for agency_id in range(1, agency_count + 1):
+        agency = db.session.get(Agency, agency_id)
+        assert data_analysis.analyze_emails(agency) == legacy_emails(agency)
+
+
+def test_comparison_matches_legacy_implementation(app):
+    agency_count = seed()
+    for agency_id in range(1, agency_count + 1):
+        legacy = {
+            'lex_sev': legacy_lex_sev(agency_id), 'manual': legacy_manual(agency_id),
+            'bank': legacy_bank(agency_id), 'google_ads': legacy_google_ads(agency_id)
+        }
+        results = data_analysis.perform_analysis(agency_id, use_cache=False)
+        assert_same(results['comparison'], data_analysis.compare_all_sources(legacy))
+
+
+def cached_types(agency_id):
+    return db.session.execute(
+        db.select(DataAnalysis.analysis_type).filter_by(agency_id=agency_id)
+    ).scalars().all()
+
+
+def test_cache_write_leaves_the_commit_to_the_caller(app):
+    seed()
+    db.session.get(Agency, 1).email = 'changed@example.com'
+    data_analysis.get_cached_analysis(1, 'manual', data_analysis.analyze_manual)
+    db.session.rollback()
+    assert db.session.get(Agency, 1).email != 'changed@example.com'
+    assert cached_types(1) == []
+
+    data_analysis.get_cached_analysis(1, 'manual', data_analysis.analyze_manual)
+    db.session.commit()
+    assert cached_types(1) == ['manual']
+
+
+def test_failed_cache_write_keeps_the_callers_changes(app):
+    seed()
+    db.session.get(Agency, 1).email = 'changed@example.com'
+    # json.dumps rejects the result, so the savepoint is rolled back
+    result = data_analysis.get_cached_analysis(1, 'manual', lambda agency_id: {'value': object()})
+    assert 'value' in result
+    db.session.commit()
+    db.session.expire_all()
+    assert db.session.get(Agency, 1).email == 'changed@example.com'
+    assert cached_types(1) == []
+
+
+def series_client(app):
+    # routes.py takes login_required from flask_login; the view checks the session itself
+    app.config['LOGIN_DISABLED'] = True
+    app.secret_key = 'test'
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['currentAgency'] = {'id': 1, 'isAdmin': False}
+    return client
+
+
+def add_manual(amount):
+    db.session.execute(db.insert(Manual), [{
+        'agency_id': 1, 'identifier': f'm{amount}', 'source': 'manual', 'name': 'Entry',
+        'totalAmount': amount, 'addedOn': datetime.now()
+    }])
+
+
+def test_series_etag_until_the_data_changes(app):
+    db.session.execute(db.insert(Agency), [{'email': 'agency@example.com', 'password': 'secret'}])
+    add_manual(100)
+    db.session.commit()
+    client = series_client(app)
+
+    first = client.get('/visualize/1/series?bucket=day')
+    assert first.status_code == 200
+    assert first.json['series']['manual'][-1]['value'] == 100
+    repeat = client.get('/visualize/1/series?bucket=day', headers={'If-None-Match': first.headers['ETag']})
+    assert repeat.status_code == 304
+
+    add_manual(50)
+    data_analysis.invalidate_analysis(1, 'manual')
+    db.session.commit()
+    changed = client.get('/visualize/1/series?bucket=day', headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200
+    assert changed.json['series']['manual'][-1]['value'] == 150
+    assert changed.headers['ETag'] != first.headers['ETag']
+
+
+def test_series_cache_is_bounded(app):
+    db.session.execute(db.insert(Agency), [{'email': 'agency@example.com', 'password': 'secret'}])
+    db.session.commit()
+    client = series_client(app)
+
+    # Dates within the same months share one entry
+    for start, end in (('2024-01-03', '2024-03-10'), ('2024-01-20', '2024-03-31')):
+        response = client.get(f'/visualize/1/series?bucket=month&start={start}&end={end}')
+        assert (response.json['start'], response.json['end']) == ('2024-01-01', '2024-03-31')
+    assert len(cached_types(1)) == 1
+
+    for day in range(1, 30):
+        client.get(f'/visualize/1/series?bucket=day&start=2024-01-{day:02d}&end=2024-02-01')
+    assert len(cached_types(1)) == data_analysis.VISUALIZATION_CACHE_ENTRIES
+    assert 'visualize:day:2024-01-29:2024-02-01' in cached_types(1)
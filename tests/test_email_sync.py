@@ -0,0 +1,252 @@
+# tests/test_email_sync.py
+
+from datetime import datetime, timezone
+import re
+import sqlite3
+import threading
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+from app.models import Agency, MailUser, Email, EmailBody
+from app.database import db
+from app.mail.email_handler import EmailHandler
+
+
+def make_message(number, subject=None):
+    return (
+        f"Message-ID: <{number}@example.com>\r\n"
+        f"Subject: {subject or f'Message {number}'}\r\n"
+        "From: sender@example.com\r\n"
+        "To: agency@gmail.com\r\n"
+        f"Date: Mon, 0{number % 9 + 1} Jan 2024 10:00:00 +0000\r\n"
+        "\r\n"
+        f"Body of message {number}\r\n"
+    ).encode()
+
+
+class ImapStub:
+    """Answers the commands EmailHandler sends, for one folder of messages."""
+
+    def __init__(self, messages, uid_validity=7):
+        self.messages = messages
+        self.uid_validity = uid_validity
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def login(self, user, password):
+        return 'OK', [b'Logged in']
+
+    def select(self, folder, readonly=False):
+        return 'OK', [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        return code, [str(self.uid_validity).encode()]
+
+    def uid(self, command, *args):
+        self.commands.append((command, args))
+        if command == 'search':
+            first = int(re.match(r'UID (\d+):\*', args[1]).group(1))
+            matched = [uid for uid in sorted(self.messages) if uid >= first] or sorted(self.messages)[-1:]
+            return 'OK', [' '.join(str(uid) for uid in matched).encode()]
+        uids = self._uids(args[0])
+        data = []
+        for sequence, uid in enumerate(uids, 1):
+            if 'RFC822' in args[1]:
+                name, literal = 'RFC822', self.messages[uid]
+            elif 'HEADER.FIELDS' in args[1]:
+                header = self.messages[uid].split(b'\r\n\r\n')[0] + b'\r\n\r\n'
+                structure = '("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 20 1)'
+                name, literal = f'BODYSTRUCTURE {structure} BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT FROM TO DATE)]', header
+            else:
+                name, literal = 'BODY[1]', self.messages[uid].split(b'\r\n\r\n', 1)[1]
+            data.append((f'{sequence} (UID {uid} {name} {{{len(literal)}}}'.encode(), literal))
+            data.append(b')')
+        return 'OK', data
+
+    def _uids(self, uid_set):
+        uids = []
+        for part in uid_set.split(','):
+            first, _, last = part.partition(':')
+            uids.extend(range(int(first), int(last or first) + 1))
+        return [uid for uid in uids if uid in self.messages]
+
+
+class StubEmailHandler(EmailHandler):
+    def __init__(self, imap, fetch_mode="batched"):
+        super().__init__(fetch_mode)
+        self.imap = imap
+
+    def _connect(self, imap_server):
+        return self.imap
+
+
+def add_mail_user():
+    agency = Agency(id=None, email='agency@example.com', password='secret')
+    mail_user = MailUser(
+        email='agency@gmail.com', password='secret', domain='gmail.com', folder='INBOX',
+        agency_id=None, agency=agency
+    )
+    db.session.add(mail_user)
+    db.session.commit()
+    return mail_user
+
+
+def fetched_uids(imap):
+    return [args[0] for command, args in imap.commands if command == 'fetch']
+
+
+def test_sync_fetches_only_new_uids(app):
+    mail_user = add_mail_user()
+    imap = ImapStub({uid: make_message(uid) for uid in (3, 4, 5)})
+    handler = StubEmailHandler(imap)
+
+    assert handler._fetch_emails(mail_user) == (3, 3)
+    assert (mail_user.uid_validity, mail_user.last_uid) == (7, 5)
+
+    imap.messages[6] = make_message(6)
+    imap.commands.clear()
+    assert handler._fetch_emails(mail_user) == (1, 1)
+    assert imap.commands[0] == ('search', (None, 'UID 6:*'))
+    assert fetched_uids(imap) == ['6', '6']
+
+    # Nothing new: "6:*" still returns UID 6, which must not be fetched again
+    imap.commands.clear()
+    assert handler._fetch_emails(mail_user) == (0, 0)
+    assert fetched_uids(imap) == []
+
+    emails = db.session.execute(db.select(Email).order_by(Email.uid)).scalars().all()
+    assert [(email.uid, email.message_id) for email in emails] == [
+        (uid, f'<{uid}@example.com>') for uid in (3, 4, 5, 6)
+    ]
+    assert emails[0].content == 'Body of message 3\r\n'
+
+
+def test_uid_validity_change_rescans_without_duplicates(app):
+    mail_user = add_mail_user()
+    imap = ImapStub({uid: make_message(uid) for uid in (1, 2)})
+    handler = StubEmailHandler(imap, fetch_mode="full")
+    handler._fetch_emails(mail_user)
+
+    # The server renumbered the folder; Message-IDs still identify the messages
+    imap.uid_validity = 8
+    imap.messages = {10: make_message(1), 11: make_message(2), 12: make_message(3)}
+    assert handler._fetch_emails(mail_user) == (3, 1)
+    assert (mail_user.uid_validity, mail_user.last_uid) == (8, 12)
+    assert db.session.execute(db.select(db.func.count(Email.id))).scalar() == 3
+
+
+def test_first_sync_claims_emails_stored_by_the_old_sync(app):
+    mail_user = add_mail_user()
+    # Stored before UIDs and Message-IDs were recorded
+    db.session.add(Email(
+        subject='Message 1', sender='sender@example.com', recipient='agency@gmail.com',
+        date=datetime(2024, 1, 2, 10, tzinfo=timezone.utc), mail_user_id=mail_user.id, mail_user=mail_user
+    ))
+    db.session.commit()
+
+    imap = ImapStub({1: make_message(1), 2: make_message(2)})
+    assert StubEmailHandler(imap)._fetch_emails(mail_user) == (2, 1)
+
+    emails = db.session.execute(db.select(Email).order_by(Email.id)).scalars().all()
+    assert [(email.subject, email.uid, email.message_id) for email in emails] == [
+        ('Message 1', 1, '<1@example.com>'),
+        ('Message 2', 2, '<2@example.com>'),
+    ]
+    assert mail_user.last_uid == 2
+
+
+class LockedOnceEmailHandler(StubEmailHandler):
+    """Finds the database locked when storing the first batch, as another account worker holds it."""
+
+    LOCKED_RETRY_DELAY = 0
+    locked = False
+
+    def _store_chunk(self, imap, mail_user, chunk):
+        new = super()._store_chunk(imap, mail_user, chunk)
+        if not self.locked:
+            self.locked = True
+            raise OperationalError('COMMIT', {}, sqlite3.OperationalError('database is locked'))
+        return new
+
+
+def test_locked_batch_is_stored_again(app):
+    assert db.session.execute(text("PRAGMA journal_mode")).scalar() == 'wal'
+    mail_user = add_mail_user()
+    imap = ImapStub({uid: make_message(uid) for uid in (1, 2, 3)})
+    handler = LockedOnceEmailHandler(imap)
+    handler.FETCH_BATCH_SIZE = 2
+
+    assert handler._fetch_emails(mail_user) == (3, 3)
+    assert (mail_user.uid_validity, mail_user.last_uid) == (7, 3)
+    uids = db.session.execute(db.select(Email.uid).order_by(Email.uid)).scalars().all()
+    assert uids == [1, 2, 3]
+
+
+def test_accounts_storing_the_same_body_share_one_row(app):
+    mail_user = add_mail_user()
+    other = MailUser(
+        email='other@gmail.com', password='secret', domain='gmail.com', folder='INBOX',
+        agency_id=mail_user.agency_id, agency=mail_user.agency
+    )
+    db.session.add(other)
+    db.session.commit()
+    other_id = other.id
+
+    def sync_other_account():
+        with app.app_context():
+            StubEmailHandler(ImapStub({1: make_message(1)}))._fetch_emails(db.session.get(MailUser, other_id))
+            db.session.remove()
+
+    # The other account's worker stores the same body just before this one does
+    raced = []
+
+    def race(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO email_body') and not raced:
+            raced.append(True)
+            worker = threading.Thread(target=sync_other_account)
+            worker.start()
+            worker.join()
+
+    event.listen(db.engine, 'before_cursor_execute', race)
+    try:
+        assert StubEmailHandler(ImapStub({1: make_message(1)}))._fetch_emails(mail_user) == (1, 1)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', race)
+
+    assert raced
+    body_ids = db.session.execute(db.select(Email.body_id)).scalars().all()
+    assert len(body_ids) == 2 and len(set(body_ids)) == 1
+    assert db.session.execute(db.select(db.func.count(EmailBody.id))).scalar() == 1
+
+
+def test_unmatched_legacy_emails_stop_being_looked_up(app):
+    mail_user = add_mail_user()
+    # Deleted on the server, so no message ever claims it
+    db.session.add(Email(
+        subject='Gone', sender='sender@example.com', recipient='agency@gmail.com',
+        date=datetime(2023, 5, 1, 10, tzinfo=timezone.utc), mail_user_id=mail_user.id, mail_user=mail_user
+    ))
+    db.session.commit()
+    imap = ImapStub({1: make_message(1), 2: make_message(2)})
+    handler = StubEmailHandler(imap)
+    assert handler._fetch_emails(mail_user) == (2, 2)
+    assert mail_user.legacy_emails_claimed
+
+    imap.messages[3] = make_message(3)
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        assert handler._fetch_emails(mail_user) == (1, 1)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+    assert not [statement for statement in statements if 'message_id IS NULL' in statement]
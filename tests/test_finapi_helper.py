@@ -0,0 +1,98 @@
+# tests/test_finapi_helper.py
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from app.database import db
+from app.helpers.finapi_helper import FinAPIHelper
+from app.models import BankTransaction
+from tests.test_balance_ledger import add_account, finapi_transaction
+
+PAGE_COUNT = 9
+PER_PAGE = 3
+
+
+class FinAPIStub(ThreadingHTTPServer):
+    """Serves paged /transactions responses and records how many overlap."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), TransactionsHandler)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.pages = []
+
+
+class TransactionsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        page = int(parse_qs(urlparse(self.path).query)['page'][0])
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.pages.append(page)
+        # Later pages answer first, so out-of-order completion would show
+        time.sleep(0.05 * (PAGE_COUNT - page) / PAGE_COUNT)
+        body = json.dumps({
+            'transactions': [finapi_transaction(page * 100 + number, 1.0, '2024-01-15') for number in range(PER_PAGE)],
+            'paging': {'page': page, 'pageCount': PAGE_COUNT},
+        }).encode()
+        with server.lock:
+            server.in_flight -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def finapi(app):
+    server = FinAPIStub()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    app.config['FINAPI_BASE_URL'] = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_iter_transactions_returns_every_page_in_order(finapi):
+    transactions = list(FinAPIHelper.iter_transactions(
+        'token', [1, 2], '2024-01-01', '2024-01-31', per_page=PER_PAGE, max_workers=3
+    ))
+
+    assert [transaction['id'] for transaction in transactions] == [
+        page * 100 + number for page in range(1, PAGE_COUNT + 1) for number in range(PER_PAGE)
+    ]
+    assert sorted(finapi.pages) == list(range(1, PAGE_COUNT + 1))
+    assert 1 < finapi.max_in_flight <= 3
+
+
+def test_fetch_transactions_view_stores_every_page(app, finapi, monkeypatch):
+    account = add_account()
+    # Already seeded, so the view does not ask FinAPI for balances
+    account.opening_balance = 0
+    db.session.commit()
+    monkeypatch.setattr(FinAPIHelper, 'get_access_token', classmethod(lambda cls: 'token'))
+    app.secret_key = 'test'
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['currentAgency'] = {'id': account.connection.agency_id}
+
+    response = client.get(f'/finapi/fetch-transactions?connection_id={account.connection_id}')
+    assert response.status_code == 200
+    assert f'Fetched {PAGE_COUNT * PER_PAGE} new transactions'.encode() in response.data
+    stored = db.session.execute(db.select(db.func.count(BankTransaction.id))).scalar()
+    assert stored == PAGE_COUNT * PER_PAGE
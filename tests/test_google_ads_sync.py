@@ -0,0 +1,119 @@
+# tests/test_google_ads_sync.py
+
+from datetime import date, timedelta
+import threading
+import time
+from types import SimpleNamespace
+
+from app.models import Agency, GoogleAdsAccount, GoogleAdsCampaign, GoogleAdsCampaignDay
+from app.database import db
+from app.google_ads.google_ads_handler import GoogleAdsHandler
+
+
+def add_accounts(*customer_ids):
+    agency = Agency(id=None, email='agency@example.com', password='secret')
+    db.session.add(agency)
+    db.session.flush()
+    accounts = [
+        GoogleAdsAccount(
+            id=None, customer_id=customer_id, refresh_token=f'token-{customer_id}', agency_id=agency.id,
+            agency=agency, campaigns=[]
+        )
+        for customer_id in customer_ids
+    ]
+    db.session.add_all(accounts)
+    db.session.commit()
+    return accounts
+
+
+def fetched(budget):
+    return {
+        'name': 'Account',
+        'campaigns': [{'campaign_id': '42', 'name': 'Brand', 'status': 'ENABLED', 'budget': budget}],
+        'days': {('42', date(2024, 1, 2)): (100, 10, 2_500_000)},
+    }
+
+
+def test_campaigns_are_stored_per_account(app):
+    first, second = add_accounts('111', '222')
+    handler = GoogleAdsHandler()
+
+    handler._store_account_campaigns(first, fetched(10.0), date(2024, 1, 2), date(2024, 1, 3))
+    handler._store_account_campaigns(second, fetched(20.0), date(2024, 1, 2), date(2024, 1, 3))
+    handler._store_account_campaigns(first, fetched(15.0), date(2024, 1, 2), date(2024, 1, 3))
+
+    campaigns = db.session.execute(
+        db.select(GoogleAdsCampaign.account_id, GoogleAdsCampaign.campaign_id, GoogleAdsCampaign.budget)
+        .order_by(GoogleAdsCampaign.account_id)
+    ).all()
+    assert campaigns == [(first.id, '42', 15.0), (second.id, '42', 20.0)]
+    assert db.session.execute(
+        db.select(GoogleAdsCampaignDay.account_id).order_by(GoogleAdsCampaignDay.account_id)
+    ).scalars().all() == [first.id, second.id]
+
+
+def test_client_errors_on_worker_threads_are_reported(app, tmp_path, monkeypatch):
+    add_accounts('111')
+    monkeypatch.setenv('GOOGLE_ADS_YAML_FILE_PATH', str(tmp_path / 'missing.yaml'))
+
+    [result] = GoogleAdsHandler().sync_campaigns(1)
+
+    # The client's own error, not "Working outside of application context"
+    assert 'application context' not in result['error']
+    assert 'missing.yaml' in result['error']
+
+
+class FakeGoogleAdsService:
+    """Streams two campaigns over two days for every customer, slowest for the first."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def search_stream(self, customer_id, query):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # Later customers finish first, so accounts complete out of order
+        time.sleep(0.1 / int(customer_id[0]))
+        with self.lock:
+            self.in_flight -= 1
+        today = date.today()
+        rows = [
+            SimpleNamespace(
+                customer=SimpleNamespace(descriptive_name=f'Customer {customer_id}'),
+                campaign=SimpleNamespace(
+                    id=int(f'{customer_id}{number}'), name=f'Campaign {number}', status=SimpleNamespace(name='ENABLED')
+                ),
+                campaign_budget=SimpleNamespace(amount_micros=number * 1_000_000),
+                segments=SimpleNamespace(date=day.isoformat()),
+                metrics=SimpleNamespace(impressions=100, clicks=10, cost_micros=1_000_000),
+            )
+            for day in (today - timedelta(days=1), today)
+            for number in (1, 2)
+        ]
+        return [SimpleNamespace(results=rows[:2]), SimpleNamespace(results=rows[2:])]
+
+
+def test_accounts_are_synced_concurrently(app, monkeypatch):
+    accounts = add_accounts('111', '222', '333', '444')
+    service = FakeGoogleAdsService()
+    monkeypatch.setattr(GoogleAdsHandler, 'get_service', classmethod(lambda cls, refresh_token=None: service))
+
+    results = GoogleAdsHandler().sync_campaigns(accounts[0].agency_id, max_workers=4)
+
+    assert [result['error'] for result in results] == [None] * 4
+    assert service.max_in_flight > 1
+    campaigns = db.session.execute(
+        db.select(GoogleAdsCampaign.account_id, GoogleAdsCampaign.campaign_id)
+        .order_by(GoogleAdsCampaign.account_id, GoogleAdsCampaign.campaign_id)
+    ).all()
+    assert campaigns == [
+        (account.id, f'{account.customer_id}{number}') for account in accounts for number in (1, 2)
+    ]
+    # Two campaigns over two days per account
+    assert db.session.execute(
+        db.select(GoogleAdsCampaignDay.account_id, db.func.count())
+        .group_by(GoogleAdsCampaignDay.account_id).order_by(GoogleAdsCampaignDay.account_id)
+    ).all() == [(account.id, 4) for account in accounts]
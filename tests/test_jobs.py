@@ -0,0 +1,150 @@
+# tests/test_jobs.py
+
+from datetime import datetime, timedelta
+import json
+import time
+
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+
+from app import create_app, jobs
+from app.models import Agency, SyncJob
+from app.database import db
+
+
+def add_agency():
+    agency = Agency(id=None, email='agency@example.com', password='secret')
+    db.session.add(agency)
+    db.session.commit()
+    return agency.id
+
+
+def active_jobs(agency_id):
+    return db.session.execute(
+        db.select(SyncJob.id).where(SyncJob.agency_id == agency_id, SyncJob.status.in_(jobs.ACTIVE_STATUSES))
+    ).scalars().all()
+
+
+def test_enqueue_reuses_the_active_job(app):
+    agency_id = add_agency()
+    job = jobs.enqueue_sync(agency_id)
+    assert jobs.enqueue_sync(agency_id).id == job.id
+
+    job.status = "succeeded"
+    db.session.commit()
+    assert jobs.enqueue_sync(agency_id).id != job.id
+
+
+def test_enqueue_returns_the_job_of_a_concurrent_request(app, monkeypatch):
+    agency_id = add_agency()
+    lookup = jobs._active_job
+    lookups = []
+
+    def concurrent_enqueue(agency_id):
+        lookups.append(agency_id)
+        if len(lookups) == 1:
+            # Another request inserts its job after this request's lookup
+            with Session(db.engine) as other:
+                other.add(SyncJob(agency_id=agency_id))
+                other.commit()
+            return None
+        return lookup(agency_id)
+
+    monkeypatch.setattr(jobs, '_active_job', concurrent_enqueue)
+    job = jobs.enqueue_sync(agency_id)
+    assert job is not None
+    assert active_jobs(agency_id) == [job.id]
+
+
+def unique_index_exists():
+    indexes = inspect(db.session.connection()).get_indexes('sync_job')
+    return 'uq_sync_job_agency_type_active' in {index['name'] for index in indexes}
+
+
+def test_unique_index_waits_for_duplicate_jobs_to_finish(app):
+    agency_id = add_agency()
+    db.session.execute(text("DROP INDEX uq_sync_job_agency_type_active"))
+    for _ in range(2):
+        db.session.add(SyncJob(agency_id=agency_id))
+    db.session.commit()
+    db.session.remove()
+
+    create_app()
+    assert len(active_jobs(agency_id)) == 2
+    assert not unique_index_exists()
+
+    db.session.execute(db.update(SyncJob).where(SyncJob.id == min(active_jobs(agency_id))).values(status="succeeded"))
+    db.session.commit()
+    db.session.remove()
+    create_app()
+    assert unique_index_exists()
+
+
+def test_heartbeat_keeps_a_long_job_from_being_claimed_again(app, monkeypatch):
+    app.config.update(SYNC_JOB_HEARTBEAT_SECONDS=0.05, SYNC_JOB_LEASE_SECONDS=0.3)
+    agency_id = add_agency()
+    jobs.enqueue_sync(agency_id)
+    reclaimed = []
+
+    def long_sync(agency_id):
+        # Outlasts the lease; only the heartbeat keeps the job claimed
+        time.sleep(0.6)
+        reclaimed.append(jobs.claim_next_job())
+        return {}
+
+    monkeypatch.setattr(jobs, 'run_sync', long_sync)
+    job = jobs.run_job(jobs.claim_next_job())
+
+    assert reclaimed == [None]
+    assert (job.status, job.attempts) == ("succeeded", 1)
+
+
+def test_abandoned_jobs_are_retried_until_attempts_run_out(app):
+    agency_id = add_agency()
+    stale = datetime.utcnow() - timedelta(hours=1)
+    for attempts in (3, 1):
+        db.session.add(SyncJob(
+            agency_id=agency_id, job_type=f"attempts_{attempts}", status="running", attempts=attempts,
+            started_at=stale, heartbeat_at=stale
+        ))
+    db.session.commit()
+
+    job = jobs.claim_next_job()
+    assert (job.job_type, job.attempts) == ("attempts_1", 2)
+    assert jobs.claim_next_job() is None
+    exhausted = db.session.execute(db.select(SyncJob).filter_by(job_type="attempts_3")).scalar_one()
+    assert (exhausted.status, exhausted.error) == ("failed", jobs.LEASE_EXPIRED_ERROR)
+
+
+class FakeHandler:
+    def __init__(self, results):
+        self.results = results
+
+    def __call__(self):
+        return self
+
+    def sync_campaigns(self, agency_id):
+        return self.results
+
+    sync_transactions = sync_emails = sync_campaigns
+
+
+def test_sync_with_account_errors_is_retried(app, monkeypatch):
+    agency_id = add_agency()
+    monkeypatch.setattr(jobs, 'GoogleAdsHandler', FakeHandler([{'account_id': 1, 'error': 'invalid_grant'}]))
+    monkeypatch.setattr(jobs, 'BankHandler', FakeHandler([{'connection_id': 1, 'error': None}]))
+    mail = FakeHandler([{'mail_user_id': 1, 'errors': ['IMAP down']}])
+    monkeypatch.setattr(jobs, 'EmailHandler', mail)
+    jobs.enqueue_sync(agency_id)
+
+    job = jobs.run_job(jobs.claim_next_job())
+    assert (job.status, job.attempts) == ("queued", 1)
+    assert job.error == "google_ads: invalid_grant; mail: IMAP down"
+    assert json.loads(job.result)['mail'][0]['errors'] == ['IMAP down']
+
+    monkeypatch.setattr(jobs, 'GoogleAdsHandler', FakeHandler([{'account_id': 1, 'error': None}]))
+    mail.results = [{'mail_user_id': 1, 'errors': []}]
+    job.run_after = datetime.utcnow()
+    db.session.commit()
+    job = jobs.run_job(jobs.claim_next_job())
+    assert (job.status, job.attempts, job.error) == ("succeeded", 2, None)
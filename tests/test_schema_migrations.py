@@ -0,0 +1,157 @@
+# tests/test_schema_migrations.py
+
+import threading
+
+from sqlalchemy import inspect, text
+
+from app.database import db, schema_lock
+from app.google_ads.metrics import add_account_columns, scope_campaign_ids
+from app.mail.attachment_cache import add_attachment_columns
+from app.mail.body_migration import add_body_column, body_migration_pending, migrate_email_bodies
+from app.mail.uid_migration import add_uid_columns
+from app.models import Email
+
+
+def replace_table(name, ddl):
+    """Swap a table for the definition an older release created."""
+    db.session.execute(text(f"DROP TABLE {name}"))
+    db.session.execute(text(ddl))
+    db.session.commit()
+
+
+def column_names(table):
+    return {column['name'] for column in inspect(db.engine).get_columns(table)}
+
+
+def test_add_attachment_columns(app):
+    replace_table('attachment', """
+        CREATE TABLE attachment (
+            id INTEGER NOT NULL PRIMARY KEY,
+            filename VARCHAR(255) NOT NULL,
+            content_type VARCHAR(100) NOT NULL,
+            data BLOB NOT NULL,
+            email_id INTEGER NOT NULL REFERENCES email (id)
+        )""")
+
+    assert add_attachment_columns() == ['part_number', 'size', 'encoding', 'content_hash', 'data']
+    assert column_names('attachment') == {
+        'id', 'filename', 'content_type', 'email_id', 'part_number', 'size', 'encoding', 'content_hash'
+    }
+    db.session.execute(text(
+        "INSERT INTO attachment (filename, content_type, email_id, part_number) VALUES ('a.pdf', 'application/pdf', 1, '2')"
+    ))
+    assert add_attachment_columns() == []
+
+
+def test_add_uid_columns_leaves_legacy_claims_pending(app):
+    replace_table('mail_user', """
+        CREATE TABLE mail_user (
+            id INTEGER NOT NULL PRIMARY KEY,
+            email VARCHAR(120) NOT NULL UNIQUE,
+            password VARCHAR(255) NOT NULL,
+            domain VARCHAR(50) NOT NULL,
+            folder VARCHAR(50) NOT NULL,
+            agency_id INTEGER NOT NULL REFERENCES agency (id)
+        )""")
+    db.session.execute(text(
+        "INSERT INTO mail_user (email, password, domain, folder, agency_id) VALUES ('a@gmail.com', 's', 'gmail.com', 'INBOX', 1)"
+    ))
+
+    assert add_uid_columns() == 3
+    assert db.session.execute(text("SELECT legacy_emails_claimed FROM mail_user")).scalar_one() == 0
+    assert add_uid_columns() == 0
+
+LEGACY_EMAIL_TABLE = """
+    CREATE TABLE email (
+        id INTEGER NOT NULL PRIMARY KEY,
+        subject VARCHAR(255) NOT NULL,
+        sender VARCHAR(100) NOT NULL,
+        recipient VARCHAR(100) NOT NULL,
+        date DATETIME NOT NULL,
+        content TEXT NOT NULL,
+        mail_user_id INTEGER NOT NULL REFERENCES mail_user (id),
+        message_id VARCHAR(255),
+        uid BIGINT
+    )"""
+
+
+def test_add_body_column_drops_content_of_empty_table(app):
+    replace_table('email', LEGACY_EMAIL_TABLE)
+
+    assert 'content' not in add_body_column()
+    assert not body_migration_pending()
+    assert 'body_id' in column_names('email') and 'content' not in column_names('email')
+
+
+def test_sync_waits_for_body_migration(app):
+    replace_table('email', LEGACY_EMAIL_TABLE)
+    db.session.execute(text(
+        "INSERT INTO email (subject, sender, recipient, date, content, mail_user_id) "
+        "VALUES ('Hello', 'a@example.com', 'b@example.com', '2024-01-02 10:00:00', 'Old body', 1)"
+    ))
+    db.session.commit()
+
+    add_body_column()
+    assert body_migration_pending()
+
+    assert migrate_email_bodies() == 1
+    assert not body_migration_pending()
+    assert db.session.execute(db.select(Email)).scalar_one().content == 'Old body'
+
+
+def test_add_account_columns(app):
+    replace_table('google_ads_account', """
+        CREATE TABLE google_ads_account (
+            id INTEGER NOT NULL PRIMARY KEY,
+            customer_id VARCHAR(20) NOT NULL UNIQUE,
+            refresh_token VARCHAR(256) NOT NULL,
+            agency_id INTEGER NOT NULL REFERENCES agency (id)
+        )""")
+
+    add_account_columns()
+    add_account_columns()
+    assert {'descriptive_name', 'metrics_synced_through'} <= column_names('google_ads_account')
+
+
+def test_scope_campaign_ids(app):
+    replace_table('google_ads_campaign', """
+        CREATE TABLE google_ads_campaign (
+            id INTEGER NOT NULL PRIMARY KEY,
+            campaign_id VARCHAR(20) NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            budget FLOAT NOT NULL,
+            account_id INTEGER NOT NULL REFERENCES google_ads_account (id),
+            UNIQUE (campaign_id)
+        )""")
+    db.session.execute(text(
+        "INSERT INTO google_ads_campaign VALUES (7, '42', 'Brand', 'ENABLED', 10.0, 1)"
+    ))
+    db.session.commit()
+
+    assert scope_campaign_ids()
+    assert not scope_campaign_ids()
+    db.session.execute(text(
+        "INSERT INTO google_ads_campaign VALUES (8, '42', 'Brand', 'ENABLED', 10.0, 2)"
+    ))
+    assert db.session.execute(text("SELECT id FROM google_ads_campaign ORDER BY id")).scalars().all() == [7, 8]
+
+
+def test_schema_lock_serialises_startups(app):
+    order = []
+    locked = threading.Event()
+
+    def other_worker():
+        with app.app_context():
+            locked.wait()
+            with schema_lock():
+                order.append('other')
+
+    thread = threading.Thread(target=other_worker)
+    thread.start()
+    with schema_lock():
+        locked.set()
+        thread.join(timeout=0.5)
+        order.append('first')
+    thread.join()
+    assert order == ['first', 'other']
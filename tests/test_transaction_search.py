@@ -0,0 +1,110 @@
+# tests/test_transaction_search.py
+
+from datetime import datetime, timedelta
+
+import pytest
+from flask import render_template, url_for
+from sqlalchemy import inspect, text
+
+from app import create_app
+from app.models import BankTransaction, BankBalanceDay
+from app.database import db
+from app.helpers.transaction_search import (
+    TRANSACTION_PAGE_SIZE, transaction_page, drop_duplicate_transactions, purpose_index_exists, create_purpose_index
+)
+from app.helpers.balance_ledger import account_balances, rebuild_balance_ledger
+from app.bank_transactions import MAX_CATEGORY_LIMIT, TRANSACTION_CATEGORY_LIMIT, requested_category_limit
+from tests.test_balance_ledger import add_account
+
+
+def add_transactions(account, count):
+    first = datetime(2024, 1, 1)
+    db.session.execute(db.insert(BankTransaction), [
+        {
+            'account_id': account.id, 'finapi_transaction_id': number, 'amount': 1.0, 'purpose': 'Purpose',
+            'booking_date': first + timedelta(days=number), 'value_date': first + timedelta(days=number)
+        }
+        for number in range(count)
+    ])
+    db.session.commit()
+
+
+def test_transactions_page_links_to_the_next_page(app):
+    account = add_account()
+    add_transactions(account, TRANSACTION_PAGE_SIZE + 1)
+    transactions, next_cursor = transaction_page([account.id])
+
+    with app.test_request_context(f'/bank/transactions/{account.connection_id}'):
+        page = render_template(
+            'bank/transactions.html', bank_connection=account.connection,
+            transactions=transactions, next_cursor=next_cursor
+        )
+        assert url_for('bank.transactions', connection_id=account.connection_id, cursor=next_cursor) in page
+
+    transactions, next_cursor = transaction_page([account.id], cursor=next_cursor)
+    assert len(transactions) == 1 and next_cursor is None
+    with app.test_request_context(f'/bank/transactions/{account.connection_id}?cursor=x'):
+        page = render_template(
+            'bank/transactions.html', bank_connection=account.connection,
+            transactions=transactions, next_cursor=next_cursor
+        )
+    assert 'Next Page' not in page and 'First Page' in page
+
+
+def unique_index_exists():
+    indexes = inspect(db.session.connection()).get_indexes('bank_transaction')
+    return 'uq_bank_transaction_account_finapi' in {index['name'] for index in indexes}
+
+
+def test_duplicates_are_only_dropped_by_the_command(app):
+    account = add_account()
+    add_transactions(account, 2)
+    db.session.execute(text("DROP INDEX uq_bank_transaction_account_finapi"))
+    db.session.execute(text(
+        "INSERT INTO bank_transaction (account_id, finapi_transaction_id, amount, purpose, booking_date, value_date) "
+        "SELECT account_id, finapi_transaction_id, amount, purpose, booking_date, value_date FROM bank_transaction"
+    ))
+    db.session.commit()
+    db.session.remove()
+
+    # Startup keeps every row and leaves the unique index out
+    create_app()
+    assert db.session.execute(db.select(db.func.count(BankTransaction.id))).scalar_one() == 4
+    assert not unique_index_exists()
+
+    assert drop_duplicate_transactions() == 2
+    assert db.session.execute(db.select(db.func.count(BankTransaction.id))).scalar_one() == 2
+    db.session.remove()
+    assert unique_index_exists()
+    assert drop_duplicate_transactions() == 0
+
+
+def test_startup_leaves_indexing_stored_transactions_to_the_cli(app):
+    account = add_account()
+    account_id = account.id
+    add_transactions(account, 3)
+    db.session.execute(text("DROP TABLE bank_transaction_fts"))
+    db.session.execute(db.delete(BankBalanceDay))
+    db.session.commit()
+    db.session.remove()
+
+    create_app()
+    assert not purpose_index_exists()
+    assert account_balances([account_id]) == {}
+    # Search scans the account until the index exists
+    assert len(transaction_page([account_id], term='purpose')[0]) == 3
+
+    create_purpose_index()
+    rebuild_balance_ledger()
+    db.session.commit()
+    assert len(transaction_page([account_id], term='purpose')[0]) == 3
+    assert account_balances([account_id]) == {account_id: 3.0}
+
+
+@pytest.mark.parametrize('query, limit', [
+    ('', TRANSACTION_CATEGORY_LIMIT), ('?categories=10', 10), ('?categories=0', 1),
+    ('?categories=-5', 1), ('?categories=x', TRANSACTION_CATEGORY_LIMIT), (f'?categories={10 ** 9}', MAX_CATEGORY_LIMIT),
+])
+def test_category_limit_is_clamped(app, query, limit):
+    with app.test_request_context(f'/bank/transaction_summary/1{query}'):
+        assert requested_category_limit() == limit